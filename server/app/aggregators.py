@@ -0,0 +1,233 @@
+"""
+数据大屏分区聚合器
+一次扫描时间窗口内的数据，把每一行交给各分区的聚合器，
+组合接口（/snapshot）和单独的接口共用同一套聚合与输出逻辑
+"""
+from abc import ABC, abstractmethod
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from datetime import datetime
+from app.database import CollectedData, Device
+from app.downsample import SeriesDownsampler
+from app import archive, devices, geo, rollups, sessions
+from app.telemetry import ROWS_SCANNED
+
+
+def _number(value):
+    """指标列为浮点数，整数值按整数返回"""
+    if value is not None and float(value).is_integer():
+        return int(value)
+    return value
+
+
+class SectionAggregator(ABC):
+    """
+    分区聚合器基类
+
+    columns 为需要从窗口扫描中读取的列，需要逐行数据的聚合器重写 add()，依次接收按创建时间升序的每一行；
+    result() 输出与对应单独接口相同结构的结果
+    """
+    name = ""
+    columns = ()
+
+    def __init__(self, start_time: datetime, end_time: datetime, params: dict):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.params = params
+
+    def add(self, row):
+        """默认不需要逐行数据，scan_window 不会把行交给没有重写 add() 的聚合器"""
+
+    @abstractmethod
+    def result(self, db: Session) -> dict:
+        """输出分区结果"""
+
+
+class OverviewAggregator(SectionAggregator):
+    """记录数从预聚合表读取，设备数从设备登记表读取，不需要逐行数据"""
+    name = "overview"
+    columns = ()
+
+    def result(self, db):
+        # 最新数据时间（idx_created_at 上直接取最大值）
+        latest_time = db.query(func.max(CollectedData.created_at)).scalar()
+        return {
+            "total_count": rollups.total_count(db),
+            "recent_count": rollups.count_in_window(db, self.start_time, self.end_time),
+            "active_devices": devices.active_devices(db, self.start_time),
+            "total_devices": devices.total_devices(db),
+            "latest_time": latest_time.isoformat() if latest_time else None,
+            "time_range": {
+                "start": self.start_time.isoformat(),
+                "end": self.end_time.isoformat()
+            }
+        }
+
+
+class TimelineAggregator(SectionAggregator):
+    """按小时或按天从预聚合表汇总，不需要逐行数据"""
+    name = "timeline"
+    columns = ()
+
+    def __init__(self, start_time, end_time, params):
+        super().__init__(start_time, end_time, params)
+        self.interval = "hour" if params.get("interval", "hour") == "hour" else "day"
+
+    def result(self, db):
+        time_format = '%Y-%m-%d %H:00:00' if self.interval == "hour" else '%Y-%m-%d'
+        return {
+            "timeline": [
+                {"time": bucket_start.strftime(time_format), "count": count}
+                for bucket_start, count in rollups.count_series(db, self.start_time, self.end_time, self.interval)
+            ]
+        }
+
+
+class DevicesAggregator(SectionAggregator):
+    """设备统计不限时间窗口，直接读取设备登记表"""
+    name = "devices"
+    columns = ()
+
+    def result(self, db):
+        device_stats = db.query(Device).order_by(
+            Device.sample_count.desc(), Device.device_id
+        ).limit(self.params.get("limit", 10)).all()
+        return {
+            "devices": [
+                {
+                    "device_id": device.device_id or None,
+                    "count": device.sample_count,
+                    "last_seen": device.last_seen.isoformat() if device.last_seen else None
+                }
+                for device in device_stats
+            ]
+        }
+
+
+class BatteryAggregator(SectionAggregator):
+    name = "battery"
+    columns = ("timestamp", "battery_level", "battery_charging")
+
+    def __init__(self, start_time, end_time, params):
+        super().__init__(start_time, end_time, params)
+        self.sampler = SeriesDownsampler(start_time, end_time, params.get("max_points", 100))
+
+    def add(self, row):
+        if row.battery_level is not None:
+            self.sampler.add(row.created_at, row.battery_level, row)
+
+    def result(self, db):
+        points = self.sampler.points(lambda row: {
+            "time": row.created_at.isoformat() if row.created_at else None,
+            "timestamp": row.timestamp,
+            "level": _number(row.battery_level),
+            "isCharging": bool(row.battery_charging)
+        })
+        return {
+            "points": points,
+            "count": len(points),
+            "total": self.sampler.count,
+            "stats": {key: _number(value) for key, value in self.sampler.stats().items()}
+        }
+
+
+class NetworkAggregator(SectionAggregator):
+    name = "network"
+    columns = ("timestamp", "wifi_signal", "wifi_ssid", "network_type")
+
+    def __init__(self, start_time, end_time, params):
+        super().__init__(start_time, end_time, params)
+        self.sampler = SeriesDownsampler(start_time, end_time, params.get("max_points", 100))
+
+    def add(self, row):
+        if row.wifi_signal is not None:
+            self.sampler.add(row.created_at, row.wifi_signal, row)
+
+    def result(self, db):
+        points = self.sampler.points(lambda row: {
+            "time": row.created_at.isoformat() if row.created_at else None,
+            "timestamp": row.timestamp,
+            "signalStrength": _number(row.wifi_signal),
+            "ssid": row.wifi_ssid,
+            "networkType": row.network_type
+        })
+        return {
+            "points": points,
+            "count": len(points),
+            "total": self.sampler.count,
+            "stats": {key: _number(value) for key, value in self.sampler.stats().items()}
+        }
+
+
+class LocationAggregator(SectionAggregator):
+    """位置按网格单元在数据库中分组（见 app/geo.py），不需要逐行数据；大屏快照使用全球视口"""
+    name = "location"
+    columns = ()
+
+    def result(self, db):
+        bbox = self.params.get("bbox") or geo.WORLD_BBOX
+        zoom = self.params.get("zoom")
+        return geo.cluster(db, self.start_time, bbox, geo.fit_zoom(bbox) if zoom is None else zoom)
+
+
+class AppsAggregator(SectionAggregator):
+    """应用使用时长读取 app_sessions 表，不需要逐行数据"""
+    name = "apps"
+    columns = ()
+
+    def result(self, db):
+        return sessions.app_usage(db, self.start_time, self.end_time, self.params.get("limit", 10))
+
+
+# 可用的分区，按名称注册
+AGGREGATORS = {
+    aggregator.name: aggregator
+    for aggregator in (
+        OverviewAggregator,
+        TimelineAggregator,
+        DevicesAggregator,
+        BatteryAggregator,
+        NetworkAggregator,
+        LocationAggregator,
+        AppsAggregator,
+    )
+}
+
+
+def scan_window(db: Session, start_time: datetime, aggregators: list[SectionAggregator], filters=()):
+    """
+    按创建时间升序扫描一次窗口内的数据，逐行交给所有聚合器
+
+    只读取各聚合器声明需要的列；没有聚合器需要逐行数据时不扫描。
+    窗口涉及已归档的日期时先读取归档文件，再接着读取数据库中的热数据；
+    filters 只作用于热数据，聚合器需要自己跳过不需要的行
+    """
+    names = ["created_at"]
+    for aggregator in aggregators:
+        for column in aggregator.columns:
+            if column not in names:
+                names.append(column)
+
+    feeding = [a for a in aggregators if type(a).add is not SectionAggregator.add]
+    if not feeding:
+        return
+
+    if archive.covers(start_time):
+        scanned = 0
+        for row in archive.scan(start_time, archive.archive_boundary(), names):
+            scanned += 1
+            for aggregator in feeding:
+                aggregator.add(row)
+        ROWS_SCANNED.inc(("archive",), scanned)
+
+    rows = db.query(*[getattr(CollectedData, name) for name in names]).filter(
+        CollectedData.created_at >= archive.hot_start(start_time),
+        *filters
+    ).order_by(CollectedData.created_at.asc()).yield_per(1000)
+
+    scanned = 0
+    for row in rows:
+        scanned += 1
+        for aggregator in feeding:
+            aggregator.add(row)
+    ROWS_SCANNED.inc(("database",), scanned)
@@ -0,0 +1,380 @@
+"""
+冷数据归档
+把超过 ARCHIVE_AFTER_DAYS 天的原始数据按天、按设备分组写入 Parquet 文件（zstd 压缩），
+再从数据库中删除，数据库文件只保留近期的热数据。
+
+目录结构：ARCHIVE_DIR/date=YYYY-MM-DD/group=NN.parquet，一天全部写完后生成 _SUCCESS 标记，
+没有标记的日期（归档中途失败）不会被读取，数据仍从数据库读取，下次归档时继续。
+每个文件内按创建时间排序，每个 row group 自带 created_at 的最小/最大值统计，
+读取时只打开时间窗口覆盖的日期目录（按设备筛选时只打开该设备所在分组的文件），
+只读取需要的列，并按统计值跳过窗口外的 row group。
+
+数据大屏扫描（app/aggregators.py）、导出接口、预聚合和设备登记表的重建都会把归档数据与
+数据库中的热数据拼接起来；归档边界（最后一个归档日期的次日零点）之前的数据只从归档中读取。
+需要安装 pyarrow。
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import shutil
+import zlib
+from app.database import SessionLocal, CollectedData, delete_in_batches
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = ds = pq = None
+
+logger = logging.getLogger(__name__)
+
+# 归档目录
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+# 超过N天的数据移入归档，0 表示不归档
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+# 每天的数据按设备ID哈希分成的文件数
+ARCHIVE_DEVICE_GROUPS = int(os.getenv("ARCHIVE_DEVICE_GROUPS", "8"))
+# 每个 row group 的最大行数（越小按时间跳过得越精细，文件略大）
+ARCHIVE_ROW_GROUP_SIZE = int(os.getenv("ARCHIVE_ROW_GROUP_SIZE", "20000"))
+# 每次从数据库读取的记录数
+ARCHIVE_READ_BATCH = 5000
+# 一天的数据全部写完后生成的标记文件
+SUCCESS_MARKER = "_SUCCESS"
+
+# 已归档日期和归档边界的缓存：(归档目录的修改时间, 日期列表, 归档边界)
+_days_cache = None
+
+ARCHIVE_COLUMNS = (
+    "id", "device_id", "timestamp", "created_at", "data",
+    "battery_level", "battery_charging", "wifi_signal", "wifi_ssid", "network_type",
+    "latitude", "longitude", "foreground_app",
+)
+
+
+def _schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("device_id", pa.string()),
+        ("timestamp", pa.int64()),
+        ("created_at", pa.timestamp("us")),
+        ("data", pa.string()),
+        ("battery_level", pa.float64()),
+        ("battery_charging", pa.bool_()),
+        ("wifi_signal", pa.float64()),
+        ("wifi_ssid", pa.string()),
+        ("network_type", pa.string()),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+        ("foreground_app", pa.string()),
+    ])
+
+
+def device_group(device_id) -> int:
+    """设备所在的分组（跨进程稳定的哈希）"""
+    return zlib.crc32((device_id or "").encode("utf-8")) % max(1, ARCHIVE_DEVICE_GROUPS)
+
+
+def _day_dir(day: datetime) -> str:
+    return os.path.join(ARCHIVE_DIR, f"date={day:%Y-%m-%d}")
+
+
+def _day_files(day: datetime, device_id=...) -> list[str]:
+    """某一天的归档文件，给出 device_id 时只返回该设备所在分组的文件"""
+    day_dir = _day_dir(day)
+    if device_id is not ...:
+        path = os.path.join(day_dir, f"group={device_group(device_id):02d}.parquet")
+        return [path] if os.path.exists(path) else []
+    return sorted(
+        os.path.join(day_dir, name) for name in os.listdir(day_dir)
+        if name.startswith("group=") and name.endswith(".parquet")
+    )
+
+
+def _archive_mtime():
+    try:
+        return os.stat(ARCHIVE_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+
+def invalidate_cache():
+    """归档或删除日期目录后清空已归档日期的缓存"""
+    global _days_cache
+    _days_cache = None
+
+
+def _cached_days() -> tuple:
+    """
+    读取已归档日期和归档边界，结果缓存在内存中
+
+    本进程归档、删除日期后主动清空缓存；归档目录的修改时间变化时也会重新扫描，
+    其它进程（多进程部署时定时任务只在一个进程中运行）的改动同样能看到
+    """
+    global _days_cache
+    mtime = _archive_mtime()
+    cache = _days_cache
+    if cache is not None and cache[0] == mtime:
+        return cache
+    days = []
+    if mtime is not None:
+        for name in os.listdir(ARCHIVE_DIR):
+            if name.startswith("date=") and os.path.exists(os.path.join(ARCHIVE_DIR, name, SUCCESS_MARKER)):
+                try:
+                    days.append(datetime.strptime(name[5:], "%Y-%m-%d"))
+                except ValueError:
+                    continue
+    days.sort()
+    cache = _days_cache = (mtime, tuple(days), days[-1] + timedelta(days=1) if days else None)
+    return cache
+
+
+def archived_days() -> list[datetime]:
+    """已完整归档的日期（升序）"""
+    return list(_cached_days()[1])
+
+
+def archive_boundary():
+    """归档边界：早于该时间的数据只在归档中，没有归档时返回 None"""
+    return _cached_days()[2]
+
+
+def covers(start_time: datetime) -> bool:
+    """时间窗口是否涉及归档数据"""
+    boundary = archive_boundary()
+    return boundary is not None and (start_time is None or start_time < boundary)
+
+
+def hot_start(start_time):
+    """热数据的查询起点：归档边界之前的数据已在归档中读取"""
+    boundary = archive_boundary()
+    if boundary is None:
+        return start_time
+    return boundary if start_time is None or start_time < boundary else start_time
+
+
+def scan(start_time, end_time=None, columns=ARCHIVE_COLUMNS, device_id=...):
+    """
+    按创建时间升序逐行读取 [start_time, end_time) 内的归档数据（逐天读取，内存占用以一天为上限）
+
+    给出 device_id（可以为 None，即无设备ID的数据）时只读取该设备；
+    返回的行支持按列名取属性，data 列会解析回 dict
+    """
+    days = archived_days()
+    if not days:
+        return
+    if pa is None:
+        raise RuntimeError("读取归档数据需要安装 pyarrow")
+
+    columns = list(dict.fromkeys(("id", "created_at", *columns)))
+    Row = namedtuple("ArchivedRow", columns)
+    decode_data = "data" in columns
+
+    for day in days:
+        day_end = day + timedelta(days=1)
+        if start_time is not None and day_end <= start_time:
+            continue
+        if end_time is not None and day >= end_time:
+            break
+
+        files = _day_files(day, device_id)
+        if not files:
+            continue
+        dataset = ds.dataset(files, format="parquet", schema=_schema())
+
+        condition = None
+        if start_time is not None and start_time > day:
+            condition = ds.field("created_at") >= pa.scalar(start_time, pa.timestamp("us"))
+        if end_time is not None and end_time < day_end:
+            upper = ds.field("created_at") < pa.scalar(end_time, pa.timestamp("us"))
+            condition = upper if condition is None else condition & upper
+        if device_id is not ...:
+            same_device = ds.field("device_id").is_null() if device_id is None else ds.field("device_id") == device_id
+            condition = same_device if condition is None else condition & same_device
+
+        table = dataset.to_table(columns=columns, filter=condition)
+        if table.num_rows == 0:
+            continue
+        table = table.sort_by([("created_at", "ascending"), ("id", "ascending")])
+
+        for batch in table.to_batches(ARCHIVE_READ_BATCH):
+            values = [batch.column(name).to_pylist() for name in columns]
+            if decode_data:
+                index = columns.index("data")
+                values[index] = [json.loads(item) if item is not None else None for item in values[index]]
+            for row in zip(*values):
+                yield Row(*row)
+
+
+def device_stats() -> dict:
+    """归档中每个设备的 (记录数, 最早创建时间)，只读取 device_id 和 created_at 两列"""
+    files = [path for day in archived_days() for path in _day_files(day)]
+    if not files:
+        return {}
+    if pa is None:
+        raise RuntimeError("读取归档数据需要安装 pyarrow")
+    table = ds.dataset(files, format="parquet", schema=_schema()).to_table(
+        columns=["device_id", "created_at"]
+    )
+    table = table.set_column(0, "device_id", pc.fill_null(table.column("device_id"), ""))
+    grouped = table.group_by("device_id").aggregate([("created_at", "count"), ("created_at", "min")])
+    return {
+        device_id: (count, first_seen)
+        for device_id, count, first_seen in zip(
+            grouped.column("device_id").to_pylist(),
+            grouped.column("created_at_count").to_pylist(),
+            grouped.column("created_at_min").to_pylist(),
+        )
+    }
+
+
+class _GroupWriter:
+    """一个设备分组的归档文件，先写临时文件，完成后替换"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # 以 . 开头的文件不会被当作归档文件读取
+        directory, name = os.path.split(path)
+        self.tmp_path = os.path.join(directory, f".{name}.tmp")
+        self.writer = pq.ParquetWriter(self.tmp_path, _schema(), compression="zstd")
+        self.buffer = []
+        self.written_ids = set()
+        self.rows = 0
+        # 上次归档中途失败时文件已存在：保留原有内容，数据库中残留的同一批记录不再重复写入
+        if os.path.exists(path):
+            existing = pq.ParquetFile(path)
+            for index in range(existing.num_row_groups):
+                group = existing.read_row_group(index)
+                self.writer.write_table(group)
+                self.written_ids.update(group.column("id").to_pylist())
+                self.rows += group.num_rows
+
+    def add(self, row):
+        if row.id in self.written_ids:
+            return
+        self.buffer.append(row)
+        if len(self.buffer) >= ARCHIVE_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows = self.buffer
+        self.buffer = []
+        columns = {name: [getattr(row, name) for row in rows] for name in ARCHIVE_COLUMNS}
+        columns["data"] = [
+            json.dumps(item, ensure_ascii=False, separators=(",", ":")) if item is not None else None
+            for item in columns["data"]
+        ]
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=_schema()), row_group_size=ARCHIVE_ROW_GROUP_SIZE)
+        self.rows += len(rows)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def archive_day(day: datetime) -> int:
+    """
+    归档一天的数据：写入该日期目录下各分组的文件，全部写完后再从数据库中删除
+
+    返回归档的记录数
+    """
+    day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    day_end = day_start + timedelta(days=1)
+    day_dir = _day_dir(day_start)
+
+    writers = {}
+    db = SessionLocal()
+    try:
+        rows = db.query(*[getattr(CollectedData, name) for name in ARCHIVE_COLUMNS]).filter(
+            CollectedData.created_at >= day_start,
+            CollectedData.created_at < day_end
+        ).order_by(CollectedData.created_at, CollectedData.id).yield_per(ARCHIVE_READ_BATCH)
+
+        count = 0
+        for row in rows:
+            group = device_group(row.device_id)
+            writer = writers.get(group)
+            if writer is None:
+                os.makedirs(day_dir, exist_ok=True)
+                writer = writers[group] = _GroupWriter(os.path.join(day_dir, f"group={group:02d}.parquet"))
+            writer.add(row)
+            count += 1
+    except Exception:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    finally:
+        db.close()
+
+    if not writers:
+        return 0
+    for writer in writers.values():
+        writer.close()
+    with open(os.path.join(day_dir, SUCCESS_MARKER), "w"):
+        pass
+    # 标记文件写在日期目录里，归档目录的修改时间不会变，需要手动更新让其它进程重新扫描
+    os.utime(ARCHIVE_DIR)
+    invalidate_cache()
+
+    # 文件已落盘，再分批删除数据库中的记录（预聚合和设备登记表保持不变）
+    delete_in_batches(CollectedData.created_at >= day_start, CollectedData.created_at < day_end)
+    return count
+
+
+def archive_old_data(now: datetime = None) -> int:
+    """
+    把 ARCHIVE_AFTER_DAYS 天之前的完整日期逐天移入归档，返回归档的记录数
+
+    未开启归档或未安装 pyarrow 时不做任何事
+    """
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    if pa is None:
+        logger.warning("未安装 pyarrow，跳过冷数据归档")
+        return 0
+
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=ARCHIVE_AFTER_DAYS)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    db = SessionLocal()
+    try:
+        first = db.query(CollectedData.created_at).order_by(CollectedData.created_at).first()
+    finally:
+        db.close()
+    if first is None:
+        return 0
+
+    archived = 0
+    day = first.created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < cutoff:
+        count = archive_day(day)
+        if count:
+            logger.info(f"已归档 {day:%Y-%m-%d} 的 {count} 条数据")
+        archived += count
+        day += timedelta(days=1)
+    return archived
+
+
+def drop_expired(before: datetime) -> int:
+    """删除早于 before 所在日期的归档目录（整天删除），返回删除的天数"""
+    boundary = before.replace(hour=0, minute=0, second=0, microsecond=0)
+    dropped = 0
+    for day in archived_days():
+        if day >= boundary:
+            break
+        shutil.rmtree(_day_dir(day), ignore_errors=True)
+        dropped += 1
+    if dropped:
+        invalidate_cache()
+    return dropped
@@ -0,0 +1,221 @@
+"""
+数据大屏响应缓存
+按接口路径和查询参数缓存 GET 响应，TTL 过期 + LRU 淘汰 + 内存上限，
+每次写入新数据时递增代数（generation），旧代数的缓存随即失效；
+响应带 ETag，客户端携带 If-None-Match 且内容未变化时返回 304
+"""
+from collections import OrderedDict
+from starlette.datastructures import Headers, MutableHeaders
+from app.profiling import profiling_active
+import hashlib
+import os
+import threading
+import time
+
+# 缓存有效期（秒），0 表示关闭缓存
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "10"))
+# 最多缓存的响应数
+DASHBOARD_CACHE_MAX_ENTRIES = int(os.getenv("DASHBOARD_CACHE_MAX_ENTRIES", "256"))
+# 缓存占用的内存上限（字节）
+DASHBOARD_CACHE_MAX_BYTES = int(os.getenv("DASHBOARD_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+class CacheEntry:
+    """一条缓存的响应"""
+    __slots__ = ("body", "headers", "etag", "generation", "expires_at")
+
+    def __init__(self, body: bytes, headers: list, etag: str, generation: int, expires_at: float):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.generation = generation
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """进程内 LRU 响应缓存"""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def bump_generation(self):
+        """有新数据写入，之前缓存的响应全部失效"""
+        with self._lock:
+            self.generation += 1
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.generation != self.generation or entry.expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        size = len(entry.body)
+        # 单个响应过大时不缓存，避免挤掉其它所有条目
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            if entry.generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "generation": self.generation,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+response_cache = ResponseCache(DASHBOARD_CACHE_TTL, DASHBOARD_CACHE_MAX_ENTRIES, DASHBOARD_CACHE_MAX_BYTES)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ResponseCacheMiddleware:
+    """
+    缓存指定路径前缀下的 GET 响应（ASGI 中间件）
+
+    只缓存状态码为 200 的响应；exclude 中的路径（如长连接推送）不经过缓存
+    """
+
+    def __init__(self, app, cache: ResponseCache = response_cache,
+                 prefix: str = "/api/dashboard/", exclude: tuple = ()):
+        self.app = app
+        self.cache = cache
+        self.prefix = prefix
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or not self.cache.enabled
+            or not scope["path"].startswith(self.prefix)
+            or scope["path"].startswith(self.exclude)
+            # 采样分析需要实际执行一次，结果也不能进入缓存
+            or profiling_active()
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        query = "&".join(sorted(scope["query_string"].decode("latin-1").split("&")))
+        key = f"{scope['path']}?{query}|{request_headers.get('accept', '')}"
+        if_none_match = request_headers.get("if-none-match", "")
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            await self._send_entry(send, entry, if_none_match, "HIT")
+            return
+
+        # 先记下代数，计算期间有新数据写入时这次的结果不会进入缓存
+        generation = self.cache.generation
+        start_message = None
+        body = bytearray()
+
+        async def capture(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+            elif message["type"] == "http.response.body":
+                body.extend(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+
+        if start_message is None:
+            return
+
+        if start_message["status"] != 200:
+            await send(start_message)
+            await send({"type": "http.response.body", "body": bytes(body)})
+            return
+
+        headers = [
+            (name, value) for name, value in start_message.get("headers", [])
+            if name.lower() not in (b"content-length", b"etag")
+        ]
+        entry = CacheEntry(
+            body=bytes(body),
+            headers=headers,
+            etag=f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"',
+            generation=generation,
+            expires_at=time.monotonic() + self.cache.ttl
+        )
+        self.cache.put(key, entry)
+        await self._send_entry(send, entry, if_none_match, "MISS")
+
+    async def _send_entry(self, send, entry: CacheEntry, if_none_match: str, cache_status: str):
+        not_modified = _etag_matches(if_none_match, entry.etag)
+        headers = MutableHeaders(raw=list(entry.headers))
+        headers["ETag"] = entry.etag
+        headers["Cache-Control"] = "no-cache"
+        headers["X-Cache"] = cache_status
+
+        if not_modified:
+            self.cache.record_not_modified()
+            del headers["content-type"]
+            await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        headers["Content-Length"] = str(len(entry.body))
+        await send({"type": "http.response.start", "status": 200, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": entry.body})
@@ -0,0 +1,311 @@
+"""
+多进程部署
+多个 uvicorn 工作进程共用一个 SQLite 数据库时（CLUSTER_MODE）：
+- 各工作进程通过本地文件锁选主，只有拿到锁的进程运行定时任务；它退出后锁由操作系统释放，其它进程接替
+- 数据提交和删除经 Unix socket 交给唯一的写入进程（app/writer.py）执行，各进程不再争抢 SQLite 的写锁；
+  写入进程把提交后的推送事件和缓存失效通知广播给所有工作进程
+"""
+from contextlib import suppress
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from app.cache import response_cache
+from app.pubsub import broker
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# 多进程模式，`python main.py` 在 WORKERS > 1 时自动开启
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0").lower() in ("1", "true", "yes")
+# 工作进程数（`python main.py` 使用）
+WORKERS = int(os.getenv("WORKERS", "1"))
+# 选主锁文件、写入进程锁文件和 socket 所在目录
+CLUSTER_RUN_DIR = os.getenv("CLUSTER_RUN_DIR", "./run")
+WRITER_SOCKET = os.path.join(CLUSTER_RUN_DIR, "writer.sock")
+WRITER_LOCK_FILE = os.path.join(CLUSTER_RUN_DIR, "writer.lock")
+LEADER_LOCK_FILE = os.path.join(CLUSTER_RUN_DIR, "scheduler.lock")
+# 未当选的进程重新尝试选主的间隔（秒）
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "5"))
+# 等待写入进程连接和响应的最长时间（秒）
+WRITER_TIMEOUT_SECONDS = float(os.getenv("WRITER_TIMEOUT_SECONDS", "30"))
+
+# 消息格式：4 字节长度（大端）+ JSON
+_HEADER = struct.Struct("!I")
+
+
+class WriterError(Exception):
+    """写入进程返回错误或连接失败"""
+
+
+def encode_frame(message: dict) -> bytes:
+    if orjson is not None:
+        body = orjson.dumps(message)
+    else:
+        body = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return _HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """读取一条消息，连接关闭时返回 None"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        body = await reader.readexactly(_HEADER.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def try_lock(path: str):
+    """以非阻塞方式对文件加排他锁，成功时返回文件描述符（保持打开即持有锁），否则返回 None"""
+    if fcntl is None:
+        raise RuntimeError("多进程模式需要 fcntl 文件锁，仅支持 Linux / macOS")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    # 记下持有锁的进程，便于排查
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    return fd
+
+
+def release_lock(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+class LeaderElection:
+    """
+    文件锁选主
+
+    后台线程反复尝试加锁，拿到锁后调用 on_elected；进程退出（包括崩溃）时锁由操作系统释放，
+    其它进程在 LEADER_RETRY_SECONDS 内接替
+    """
+
+    def __init__(self, path: str, on_elected, on_resigned):
+        self.path = path
+        self.on_elected = on_elected
+        self.on_resigned = on_resigned
+        self.is_leader = False
+        self._fd = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            fd = try_lock(self.path)
+            if fd is not None:
+                self._fd = fd
+                self.is_leader = True
+                logger.info(f"进程 {os.getpid()} 当选主进程，负责运行定时任务")
+                self.on_elected()
+                return
+            if self._stopping.wait(LEADER_RETRY_SECONDS):
+                return
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            self.on_resigned()
+            release_lock(self._fd)
+            self._fd = None
+            self.is_leader = False
+
+
+class WriterClient:
+    """
+    工作进程到写入进程的连接
+
+    一条长连接上同时收发：请求按 id 对应响应，其余消息是写入进程广播的推送事件和缓存失效通知。
+    连接断开后自动重连，期间可能错过通知，重连后本进程的大屏缓存全部失效
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.loop = None
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._pending = {}
+        self._next_id = 0
+        self._task = None
+        self._closing = False
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(0.5)
+                continue
+            self._writer = writer
+            self._connected.set()
+            response_cache.bump_generation()
+            logger.info("已连接写入进程")
+            try:
+                while True:
+                    message = await read_frame(reader)
+                    if message is None:
+                        break
+                    self._dispatch(message)
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(WriterError("与写入进程的连接已断开"))
+                self._pending.clear()
+            if not self._closing:
+                logger.warning("与写入进程的连接已断开，正在重连")
+                await asyncio.sleep(0.5)
+
+    def _dispatch(self, message: dict):
+        if "id" in message:
+            future = self._pending.pop(message["id"], None)
+            if future is None or future.done():
+                return
+            if message.get("ok"):
+                future.set_result(message.get("result"))
+            else:
+                future.set_exception(WriterError(message.get("error") or "写入失败"))
+        elif message.get("type") == "events":
+            # 与单进程时 store_submissions 提交后的处理一致
+            response_cache.bump_generation()
+            broker.publish(message["events"])
+        elif message.get("type") == "invalidate":
+            response_cache.bump_generation()
+
+    async def call(self, op: str, **params):
+        """发送一个请求并等待结果"""
+        try:
+            await asyncio.wait_for(self._connected.wait(), WRITER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise WriterError("无法连接写入进程")
+        self._next_id += 1
+        request_id = self._next_id
+        future = self.loop.create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(encode_frame({"id": request_id, "op": op, **params}))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, WRITER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise WriterError("等待写入进程响应超时")
+        finally:
+            self._pending.pop(request_id, None)
+
+    def call_from_thread(self, op: str, **params):
+        """在其它线程（如写入队列的后台线程）中调用"""
+        return asyncio.run_coroutine_threadsafe(self.call(op, **params), self.loop).result()
+
+
+writer_client = None
+_election = None
+
+
+def start_cluster(on_elected, on_resigned):
+    """CLUSTER_MODE 下连接写入进程并参与选主，当选后调用 on_elected（需在事件循环中调用）"""
+    global writer_client, _election
+
+    if not CLUSTER_MODE or writer_client is not None:
+        return
+
+    writer_client = WriterClient(WRITER_SOCKET)
+    writer_client.start()
+    _election = LeaderElection(LEADER_LOCK_FILE, on_elected, on_resigned)
+    _election.start()
+    logger.info(f"多进程模式：写入进程 {WRITER_SOCKET}，选主锁 {LEADER_LOCK_FILE}")
+
+
+async def stop_cluster():
+    """放弃主进程身份并断开与写入进程的连接"""
+    global writer_client, _election
+
+    if _election is not None:
+        _election.stop()
+        _election = None
+    if writer_client is not None:
+        await writer_client.stop()
+        writer_client = None
+
+
+def cluster_stats() -> dict:
+    return {
+        "enabled": CLUSTER_MODE,
+        "pid": os.getpid(),
+        "leader": _election is not None and _election.is_leader,
+        "writer_connected": writer_client is not None and writer_client._connected.is_set(),
+    }
+
+
+def _wait_for_writer(process: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"写入进程启动失败（退出码 {process.returncode}）")
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(WRITER_SOCKET)
+                return
+            except OSError:
+                time.sleep(0.2)
+    raise RuntimeError("等待写入进程启动超时")
+
+
+def run_workers(app: str, host: str, port: int, workers: int):
+    """启动写入进程和 workers 个 uvicorn 工作进程，退出时一起停止"""
+    import uvicorn
+
+    # 工作进程和写入进程从环境变量读取配置
+    os.environ["CLUSTER_MODE"] = "1"
+    # 多个进程同时读写，使用 WAL 读写才不互相阻塞
+    os.environ.setdefault("DB_PROFILE", "production")
+
+    writer = subprocess.Popen([sys.executable, "-m", "app.writer"])
+    try:
+        _wait_for_writer(writer)
+        uvicorn.run(app, host=host, port=port, workers=workers)
+    finally:
+        writer.terminate()
+        try:
+            writer.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            writer.kill()
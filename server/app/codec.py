@@ -0,0 +1,275 @@
+"""
+原始数据（collected_data.data）的存储编码
+
+APP 每次上报都带着同样冗长的字段名，以 JSON 文本存储时数据库文件和页缓存大部分被重复的键名占用。
+PAYLOAD_CODEC 可选：
+- json（默认）：与之前一样存储为 JSON 文本
+- msgpack：存储为 msgpack 二进制
+- zstd：msgpack 之后再用 zstd 压缩；训练过字典（`python manage.py train-payload-dictionary`）时使用最新的字典
+
+读取时按内容自动识别：文本为 JSON，以 MAGIC 开头的二进制为编码后的数据（zstd 帧头中带有字典ID），
+所以切换编码后新旧数据可以共存，`python manage.py migrate-payloads` 把已有数据转换为当前编码。
+去重保存的静态部分（app/sections.py）也在读取时还原。
+只对 SQLite 生效，其它数据库仍使用原生 JSON 列。需要安装 msgpack / zstandard。
+"""
+from sqlalchemy import JSON, Text
+from sqlalchemy.types import TypeDecorator
+import json
+import logging
+import os
+import threading
+from app import sections
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 新写入数据的编码：json / msgpack / zstd
+PAYLOAD_CODEC = os.getenv("PAYLOAD_CODEC", "json").lower()
+# zstd 压缩级别
+PAYLOAD_ZSTD_LEVEL = int(os.getenv("PAYLOAD_ZSTD_LEVEL", "3"))
+# 训练字典的大小（字节）和使用的样本数
+PAYLOAD_DICT_SIZE = int(os.getenv("PAYLOAD_DICT_SIZE", str(16 * 1024)))
+PAYLOAD_DICT_SAMPLES = int(os.getenv("PAYLOAD_DICT_SAMPLES", "5000"))
+
+# 编码后数据的前缀，JSON 文本不会以 NUL 开头
+MAGIC = b"\x00WP"
+FORMAT_MSGPACK = b"m"
+FORMAT_ZSTD = b"z"
+
+CODECS = ("json", "msgpack", "zstd")
+
+if PAYLOAD_CODEC not in CODECS:
+    raise ValueError(f"未知的 PAYLOAD_CODEC: {PAYLOAD_CODEC}，可选 {', '.join(CODECS)}")
+if PAYLOAD_CODEC != "json" and (msgpack is None or (PAYLOAD_CODEC == "zstd" and zstandard is None)):
+    logger.warning(f"PAYLOAD_CODEC={PAYLOAD_CODEC} 需要安装 msgpack / zstandard，新数据仍以 JSON 存储")
+    PAYLOAD_CODEC = "json"
+
+# 已加载的 zstd 字典 {字典ID: ZstdCompressionDict}，新数据使用ID最大的字典
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+# zstd 压缩/解压对象不能被多个线程同时使用，每个线程各自缓存
+_local = threading.local()
+
+
+def load_dictionaries():
+    """从数据库读取所有 zstd 字典（启动时和遇到未知字典ID时调用）"""
+    if zstandard is None:
+        return
+    from app.database import ReadSessionLocal, PayloadDictionary
+
+    db = ReadSessionLocal()
+    try:
+        rows = db.query(PayloadDictionary.id, PayloadDictionary.data).all()
+    finally:
+        db.close()
+    with _dictionaries_lock:
+        for row in rows:
+            if row.id not in _dictionaries:
+                _dictionaries[row.id] = zstandard.ZstdCompressionDict(row.data)
+
+
+def active_dictionary_id() -> int:
+    """新数据使用的字典ID，0 表示不使用字典"""
+    with _dictionaries_lock:
+        return max(_dictionaries, default=0)
+
+
+def _compressor():
+    dict_id = active_dictionary_id()
+    compressors = _local.__dict__.setdefault("compressors", {})
+    compressor = compressors.get(dict_id)
+    if compressor is None:
+        compressor = compressors[dict_id] = zstandard.ZstdCompressor(
+            level=PAYLOAD_ZSTD_LEVEL,
+            dict_data=_dictionaries.get(dict_id),
+            write_content_size=True
+        )
+    return compressor
+
+
+def _decompressor(dict_id: int):
+    decompressors = _local.__dict__.setdefault("decompressors", {})
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        if dict_id and dict_id not in _dictionaries:
+            # 字典可能是其它进程（管理命令）新训练的
+            load_dictionaries()
+            if dict_id not in _dictionaries:
+                raise ValueError(f"找不到 zstd 字典 {dict_id}")
+        decompressor = decompressors[dict_id] = zstandard.ZstdDecompressor(
+            dict_data=_dictionaries.get(dict_id)
+        )
+    return decompressor
+
+
+def _json_text(value) -> str:
+    # 与 SQLAlchemy JSON 列的默认序列化保持一致
+    return json.dumps(value)
+
+
+def encode(value, codec: str = None):
+    """把数据编码为要写入数据库的值（JSON 文本或带前缀的二进制）"""
+    if value is None:
+        return None
+    codec = codec or PAYLOAD_CODEC
+    if codec == "json":
+        return _json_text(value)
+    try:
+        packed = msgpack.packb(value, use_bin_type=True)
+    except (TypeError, ValueError, OverflowError):
+        # 超出 64 位的整数等 msgpack 无法表示的数据仍以 JSON 存储
+        return _json_text(value)
+    if codec == "msgpack":
+        return MAGIC + FORMAT_MSGPACK + packed
+    return MAGIC + FORMAT_ZSTD + _compressor().compress(packed)
+
+
+def decode(value):
+    """把数据库中的值解码为数据"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return json.loads(value)
+    value = bytes(value)
+    if not value.startswith(MAGIC):
+        return json.loads(value)
+    if msgpack is None:
+        raise RuntimeError("读取二进制编码的数据需要安装 msgpack")
+
+    body = memoryview(value)[len(MAGIC) + 1:]
+    data_format = value[len(MAGIC):len(MAGIC) + 1]
+    if data_format == FORMAT_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("读取 zstd 压缩的数据需要安装 zstandard")
+        dict_id = zstandard.get_frame_parameters(body).dict_id
+        body = _decompressor(dict_id).decompress(body)
+    elif data_format != FORMAT_MSGPACK:
+        raise ValueError(f"未知的数据编码: {data_format!r}")
+    return msgpack.unpackb(body, raw=False)
+
+
+class PayloadJSON(TypeDecorator):
+    """
+    按 PAYLOAD_CODEC 编码的 JSON 列，读取时还原去重保存的静态部分
+
+    SQLite 的列可以同时保存文本和二进制，编解码在这里完成；其它数据库使用原生 JSON 列
+    """
+    impl = JSON
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "sqlite":
+            return dialect.type_descriptor(Text())
+        return dialect.type_descriptor(JSON())
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name != "sqlite":
+            return value
+        return encode(value)
+
+    def process_result_value(self, value, dialect):
+        if dialect.name != "sqlite":
+            return sections.expand(value)
+        return sections.expand(decode(value))
+
+
+def train_dictionary(samples: int = None, dict_size: int = None) -> int:
+    """
+    用最近的数据训练新的 zstd 字典并保存到数据库，返回字典ID
+
+    训练后新写入的数据使用新字典（运行中的服务需要重启），
+    已有数据可以用 `migrate-payloads --all` 重新编码
+    """
+    if msgpack is None or zstandard is None:
+        raise RuntimeError("训练字典需要安装 msgpack 和 zstandard")
+    from sqlalchemy import func
+    from app.database import SessionLocal, CollectedData, PayloadDictionary
+
+    db = SessionLocal()
+    try:
+        rows = db.query(CollectedData.data).order_by(CollectedData.id.desc()).limit(
+            samples or PAYLOAD_DICT_SAMPLES
+        ).all()
+        packed = [msgpack.packb(row.data, use_bin_type=True) for row in rows if row.data is not None]
+        if len(packed) < 100:
+            raise ValueError(f"样本太少（{len(packed)} 条），至少需要 100 条数据")
+
+        dict_id = (db.query(func.max(PayloadDictionary.id)).scalar() or 0) + 1
+        dictionary = zstandard.train_dictionary(
+            dict_size or PAYLOAD_DICT_SIZE, packed, dict_id=dict_id, level=PAYLOAD_ZSTD_LEVEL
+        )
+        db.add(PayloadDictionary(id=dict_id, sample_count=len(packed), data=dictionary.as_bytes()))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    load_dictionaries()
+    logger.info(f"zstd 字典 {dict_id} 训练完成，样本 {len(packed)} 条")
+    return dict_id
+
+
+def migrate_payloads(batch_size: int = 1000, all_rows: bool = False) -> int:
+    """
+    把已有数据转换为当前 PAYLOAD_CODEC 编码，按ID分批进行，每批一个短事务
+
+    默认只转换存储格式（文本/二进制）与当前编码不一致的记录；
+    all_rows 为 True 时重新编码所有记录（例如训练了新字典之后，或对旧数据做静态部分去重）。
+    开启增量空间回收时每批之后归还空闲页，数据库文件随之变小。返回转换的记录数
+    """
+    from sqlalchemy import func, update
+    from app.database import (
+        SessionLocal, CollectedData, IS_SQLITE, RETENTION_VACUUM_PAGES,
+        auto_vacuum_mode, incremental_vacuum, release_free_pages,
+    )
+
+    if not IS_SQLITE:
+        return 0
+    vacuum = auto_vacuum_mode() == 2
+
+    storage_type = "text" if PAYLOAD_CODEC == "json" else "blob"
+    converted = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            query = db.query(CollectedData.id, CollectedData.data).filter(CollectedData.id > last_id)
+            if not all_rows:
+                query = query.filter(func.typeof(CollectedData.data) != storage_type)
+            rows = query.order_by(CollectedData.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            payloads, upserts = sections.compact(db, [row.data for row in rows])
+            db.execute(update(CollectedData), [
+                {"id": row.id, "data": data} for row, data in zip(rows, payloads)
+            ])
+            db.commit()
+            sections.remember(upserts)
+            converted += len(rows)
+            last_id = rows[-1].id
+            if vacuum:
+                incremental_vacuum(RETENTION_VACUUM_PAGES)
+            logger.info(f"已转换 {converted} 条数据")
+
+        # 结束最后一次查询的事务，归还写连接
+        db.commit()
+        if vacuum and converted > 0:
+            release_free_pages()
+        return converted
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
@@ -1,20 +1,111 @@
 """
 数据库配置和模型
 """
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, DateTime, JSON, Index
+from sqlalchemy import (
+    create_engine, event, func, inspect, text,
+    Column, Integer, String, BigInteger, DateTime, JSON, Float, Boolean, Index, LargeBinary, PrimaryKeyConstraint
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timedelta
 import os
+from app import codec, profiling, telemetry
 
 # 数据库文件路径
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data.db")
 
-# 创建数据库引擎
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# 存储配置：default 保持 SQLite 默认设置；production 开启 WAL 等优化并限制为单写连接
+DB_PROFILE = os.getenv("DB_PROFILE", "default").lower()
+# production 配置下的 PRAGMA 参数
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# 只读连接池大小（数据大屏等查询使用）
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# 新建 SQLite 数据库时开启增量空间回收，删除数据后可以逐步把空闲页归还给操作系统
+DB_AUTO_VACUUM = os.getenv("DB_AUTO_VACUUM", "INCREMENTAL").upper()
+
+# 过期数据每批删除的记录数，每批一个短事务，期间的写入最多等待一批
+RETENTION_DELETE_BATCH = int(os.getenv("RETENTION_DELETE_BATCH", "5000"))
+# 每批删除后最多回收的空闲页数（auto_vacuum=INCREMENTAL 时生效）
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+# 预聚合、设备登记表等按唯一键合并写入（INSERT ... ON CONFLICT DO UPDATE），支持这些数据库
+UPSERT_DIALECTS = ("sqlite", "postgresql")
+# 内存数据库每个连接各自独立，无法拆分读写连接
+IS_MEMORY_DB = IS_SQLITE and (":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/") == "sqlite:")
+USE_PRODUCTION_PROFILE = IS_SQLITE and DB_PROFILE == "production"
+
+
+def _apply_pragmas(dbapi_connection, read_only: bool):
+    """在每个新连接上应用 SQLite PRAGMA"""
+    cursor = dbapi_connection.cursor()
+    try:
+        if not read_only:
+            # 只对尚未建表的新数据库生效，且必须在切换 WAL 之前设置
+            cursor.execute(f"PRAGMA auto_vacuum={DB_AUTO_VACUUM}")
+        if USE_PRODUCTION_PROFILE:
+            # busy_timeout 需最先设置，切换 WAL 时可能需要短暂等待锁
+            cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+            cursor.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def _create_engine(read_only: bool = False):
+    """创建数据库引擎，SQLite 连接上会自动应用 PRAGMA"""
+    if not IS_SQLITE:
+        return create_engine(DATABASE_URL, pool_pre_ping=True)
+
+    kwargs = {}
+    if USE_PRODUCTION_PROFILE and not IS_MEMORY_DB:
+        if read_only:
+            kwargs = {"pool_size": DB_READ_POOL_SIZE, "max_overflow": DB_READ_POOL_SIZE}
+        else:
+            # SQLite 同一时刻只允许一个写事务，进程内排队比 "database is locked" 重试更划算
+            kwargs = {"pool_size": 1, "max_overflow": 0}
+
+    new_engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **kwargs)
+    event.listen(
+        new_engine, "connect",
+        lambda dbapi_connection, connection_record: _apply_pragmas(dbapi_connection, read_only)
+    )
+    return new_engine
+
+
+# 创建数据库引擎（写）
+engine = _create_engine()
+
+# 只读引擎，非 SQLite 或内存数据库时与写引擎共用
+if IS_SQLITE and not IS_MEMORY_DB:
+    read_engine = _create_engine(read_only=True)
+else:
+    read_engine = engine
+
+# 统计 SQL 次数和耗时（/metrics）
+if telemetry.METRICS_ENABLED:
+    telemetry.instrument_engine(engine, "write")
+    if read_engine is not engine:
+        telemetry.instrument_engine(read_engine, "read")
+
+# 慢查询日志，以及采样分析时统计请求的 SQL 次数和耗时
+if profiling.SLOW_QUERY_MS > 0 or profiling.ADMIN_TOKEN:
+    profiling.instrument_engine(engine, "write")
+    if read_engine is not engine:
+        profiling.instrument_engine(read_engine, "read")
 
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 # 声明基类
 Base = declarative_base()
@@ -30,22 +121,221 @@ class CollectedData(Base):
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(String(100), index=True, comment="设备ID")
     timestamp = Column(BigInteger, index=True, comment="数据时间戳（毫秒）")
-    data = Column(JSON, comment="收集的数据内容")
+    data = Column(codec.PayloadJSON, comment="收集的数据内容（存储编码见 app/codec.py）")
     created_at = Column(DateTime, default=datetime.utcnow, comment="记录创建时间")
     
+    # 入库时从 data 中提取的指标列（见 app/extractors.py）
+    battery_level = Column(Float, comment="电量")
+    battery_charging = Column(Boolean, comment="是否充电")
+    wifi_signal = Column(Float, comment="WiFi 信号强度")
+    wifi_ssid = Column(String(100), comment="WiFi 名称")
+    network_type = Column(String(32), comment="网络类型")
+    latitude = Column(Float, comment="纬度")
+    longitude = Column(Float, comment="经度")
+    geo_cell = Column(BigInteger, comment="位置所在的 Web Mercator 网格单元编号（见 app/geo.py）")
+    foreground_app = Column(String(200), comment="前台应用包名")
+    metrics_version = Column(Integer, comment="指标提取规则版本")
+    
     # 创建复合索引以提高查询性能
     __table_args__ = (
         Index('idx_device_timestamp', 'device_id', 'timestamp'),
         Index('idx_created_at', 'created_at'),
+        Index('idx_device_created_at', 'device_id', 'created_at'),
+        Index('idx_created_app', 'created_at', 'foreground_app'),
+        Index('idx_created_geo', 'created_at', 'geo_cell', 'latitude', 'longitude'),
     )
 
 
+class MetricRollup(Base):
+    """
+    按时间桶预聚合的统计（每分钟 / 每小时 / 每天，按设备区分）
+    
+    入库时增量更新，由 app/rollups.py 维护
+    """
+    __tablename__ = "metric_rollups"
+    
+    granularity = Column(String(8), nullable=False, comment="时间桶粒度：minute/hour/day")
+    bucket_start = Column(DateTime, nullable=False, comment="时间桶起点（UTC）")
+    device_id = Column(String(100), nullable=False, default="", comment="设备ID，无设备ID的数据为空字符串")
+    count = Column(Integer, nullable=False, default=0, comment="记录数")
+    last_at = Column(DateTime, comment="桶内最新记录的创建时间")
+    
+    battery_count = Column(Integer, nullable=False, default=0)
+    battery_min = Column(Float)
+    battery_max = Column(Float)
+    battery_sum = Column(Float, nullable=False, default=0)
+    battery_last = Column(Float)
+    
+    wifi_count = Column(Integer, nullable=False, default=0)
+    wifi_min = Column(Float)
+    wifi_max = Column(Float)
+    wifi_sum = Column(Float, nullable=False, default=0)
+    wifi_last = Column(Float)
+    
+    __table_args__ = (
+        PrimaryKeyConstraint('granularity', 'bucket_start', 'device_id'),
+    )
+
+
+class Device(Base):
+    """
+    设备登记表：每个设备一行，记录首次/最近上报时间、累计记录数和各部分的最新数据
+    
+    入库时增量更新，由 app/devices.py 维护
+    """
+    __tablename__ = "devices"
+    
+    device_id = Column(String(100), primary_key=True, comment="设备ID，无设备ID的数据为空字符串")
+    first_seen = Column(DateTime, comment="最早一条记录的创建时间")
+    last_seen = Column(DateTime, index=True, comment="最新一条记录的创建时间")
+    sample_count = Column(Integer, nullable=False, default=0, comment="记录数")
+    last_timestamp = Column(BigInteger, comment="最新一条记录的数据时间戳（毫秒）")
+    latest_data = Column(JSON, comment="按部分（battery、location 等）合并的最新数据")
+
+
+class AppSession(Base):
+    """
+    前台应用会话：同一设备连续上报同一个前台应用的一段时间（按数据时间戳）
+
+    入库时增量更新，由 app/sessions.py 维护
+    """
+    __tablename__ = "app_sessions"
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String(100), nullable=False, default="", comment="设备ID，无设备ID的数据为空字符串")
+    app = Column(String(200), nullable=False, comment="前台应用包名")
+    start_ts = Column(BigInteger, nullable=False, comment="第一条记录的数据时间戳（毫秒）")
+    last_ts = Column(BigInteger, nullable=False, comment="最后一条记录的数据时间戳（毫秒）")
+    end_ts = Column(BigInteger, nullable=False, comment="会话结束时间：下一条记录的时间戳，间隔过长时为 last_ts")
+    sample_count = Column(Integer, nullable=False, default=0, comment="记录数")
+
+    __table_args__ = (
+        Index('idx_app_sessions_device_start', 'device_id', 'start_ts'),
+        Index('idx_app_sessions_end', 'end_ts'),
+    )
+
+
+class PayloadSection(Base):
+    """原始数据中去重保存的静态部分（见 app/sections.py），按内容哈希引用"""
+    __tablename__ = "payload_sections"
+    
+    hash = Column(String(32), primary_key=True, comment="去掉时间戳后的内容哈希")
+    name = Column(String(64), comment="首次出现时所在的部分名称")
+    data = Column(JSON, nullable=False, comment="内容（不含时间戳）")
+    first_seen = Column(DateTime, comment="首次写入时间")
+    last_seen = Column(DateTime, index=True, comment="最近一次被引用的时间（有最小刷新间隔）")
+
+
+class PayloadDictionary(Base):
+    """原始数据 zstd 压缩使用的字典（见 app/codec.py），旧字典保留用于解码"""
+    __tablename__ = "payload_dictionaries"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False, comment="字典ID，与 zstd 帧头中的字典ID一致")
+    created_at = Column(DateTime, default=datetime.utcnow, comment="训练时间")
+    sample_count = Column(Integer, comment="训练使用的样本数")
+    data = Column(LargeBinary, nullable=False, comment="字典内容")
+
+
+# 升级时新建的表需要从历史数据生成内容，给出对应的管理命令
+UPGRADE_HINTS = {
+    "metric_rollups": "python manage.py rebuild-rollups",
+    "devices": "python manage.py rebuild-devices",
+    "app_sessions": "python manage.py rebuild-sessions",
+}
+
+
+def _migrate_columns():
+    """
+    为已存在的表补充新增的列和索引（create_all 不会修改已有的表）
+
+    返回新增的列名列表
+    """
+    inspector = inspect(engine)
+    added = []
+    
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    added.append(f"{table.name}.{column.name}")
+        
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    
+    return added
+
+
 def init_db():
     """初始化数据库，创建表"""
+    if engine.dialect.name not in UPSERT_DIALECTS:
+        raise RuntimeError(f"不支持的数据库 {engine.dialect.name}，请使用 SQLite 或 PostgreSQL")
+    existing_tables = set(inspect(engine).get_table_names())
+    added = _migrate_columns()
     Base.metadata.create_all(bind=engine)
+    if added:
+        print(f"已为旧表添加新列: {', '.join(added)}")
+        print("历史数据需要执行 `python manage.py backfill-metrics` 补齐指标列")
+    if CollectedData.__tablename__ in existing_tables:
+        for table_name, command in UPGRADE_HINTS.items():
+            if table_name not in existing_tables:
+                print(f"新建数据表 {table_name}，历史数据需要执行 `{command}` 生成")
+        if IS_SQLITE and DB_AUTO_VACUUM == "INCREMENTAL" and auto_vacuum_mode() != 2:
+            print("数据库未开启增量空间回收，清理过期数据后文件不会变小，"
+                  "可在停机时执行 `python manage.py enable-incremental-vacuum`")
+    codec.load_dictionaries()
     print("数据库初始化完成")
 
 
+def auto_vacuum_mode() -> int:
+    """当前数据库的 auto_vacuum 模式：0 关闭，1 完全，2 增量"""
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+
+
+def enable_incremental_vacuum():
+    """
+    为已有数据库开启增量空间回收
+
+    需要执行一次完整的 VACUUM（重写整个数据库文件，期间阻塞所有读写），应在停机时执行
+    """
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+        return conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+
+
+def incremental_vacuum(pages: int) -> int:
+    """
+    归还最多 pages 个空闲页给操作系统，返回剩余的空闲页数
+
+    incremental_vacuum 每执行一步释放一页，需要用 executescript 执行到结束
+    """
+    connection = engine.raw_connection()
+    try:
+        connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({pages})")
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA freelist_count")
+        remaining = cursor.fetchone()[0]
+        cursor.close()
+        return remaining
+    finally:
+        connection.close()
+
+
+def release_free_pages() -> int:
+    """分批把所有空闲页归还给操作系统（每批一个短事务），返回剩余的空闲页数"""
+    previous, remaining = None, incremental_vacuum(RETENTION_VACUUM_PAGES)
+    while 0 < remaining and remaining != previous:
+        previous, remaining = remaining, incremental_vacuum(RETENTION_VACUUM_PAGES)
+    return remaining
+
+
 def get_db():
     """获取数据库会话"""
     db = SessionLocal()
@@ -55,28 +345,98 @@ def get_db():
         db.close()
 
 
-def cleanup_expired_data():
-    """清理过期数据"""
+def get_read_db():
+    """获取只读数据库会话（用于查询接口，不占用写连接）"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def upsert(table):
+    """
+    按当前数据库方言构造 INSERT 语句，支持 on_conflict_do_update() 和 excluded
+
+    用于按唯一键合并写入预聚合、设备登记表等（SQLite 和 PostgreSQL 的写法相同）
+    """
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def greatest(*values):
+    """多个值中的最大值（SQLite 为多参数的 max()，PostgreSQL 为 greatest()）"""
+    return func.max(*values) if IS_SQLITE else func.greatest(*values)
+
+
+def least(*values):
+    """多个值中的最小值（SQLite 为多参数的 min()，PostgreSQL 为 least()）"""
+    return func.min(*values) if IS_SQLITE else func.least(*values)
+
+
+def delete_in_batches(*criteria) -> int:
+    """
+    删除满足条件的记录，返回删除的记录数
+    
+    按创建时间从旧到新分批删除，每批一个短事务，写入只需等待当前这一批；
+    开启增量空间回收时每批删除后顺带归还一部分空闲页
+    """
     db = SessionLocal()
+    deleted_count = 0
+    try:
+        vacuum = IS_SQLITE and db.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+        db.commit()
+        
+        while True:
+            # 走 idx_created_at 索引取出一批记录的ID，再按主键删除
+            ids = [
+                row.id for row in db.query(CollectedData.id).filter(
+                    *criteria
+                ).order_by(CollectedData.created_at).limit(RETENTION_DELETE_BATCH)
+            ]
+            if not ids:
+                break
+            
+            db.query(CollectedData).filter(
+                CollectedData.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.commit()
+            deleted_count += len(ids)
+            
+            if vacuum:
+                incremental_vacuum(RETENTION_VACUUM_PAGES)
+            
+            if len(ids) < RETENTION_DELETE_BATCH:
+                break
+        
+        # 结束最后一次查询的事务，归还写连接（production 配置下只有一个写连接）
+        db.commit()
+        # 剩余的空闲页同样分批归还
+        if vacuum and deleted_count > 0:
+            release_free_pages()
+        
+        return deleted_count
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def cleanup_expired_data():
+    """清理过期数据（分批删除，见 delete_in_batches）"""
     try:
         # 计算过期时间点
         expiry_date = datetime.utcnow() - timedelta(days=DATA_EXPIRY_DAYS)
         
         # 删除过期数据
-        deleted_count = db.query(CollectedData).filter(
-            CollectedData.created_at < expiry_date
-        ).delete()
-        
-        db.commit()
+        deleted_count = delete_in_batches(CollectedData.created_at < expiry_date)
         
         if deleted_count > 0:
             print(f"清理了 {deleted_count} 条过期数据")
         
         return deleted_count
     except Exception as e:
-        db.rollback()
         print(f"清理过期数据时出错: {e}")
         return 0
-    finally:
-        db.close()
-
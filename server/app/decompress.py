@@ -0,0 +1,133 @@
+"""
+请求体解压
+设备提交数据时可以用 `Content-Encoding: gzip` 或 `zstd` 压缩请求体（补传积压数据时压缩率很高），
+在进入路由之前解压，路由看到的仍是普通的 JSON / NDJSON 请求体
+"""
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+import asyncio
+import gzip
+import io
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 解压后请求体的大小上限（字节），超过返回 413
+INGEST_MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", str(32 * 1024 * 1024)))
+# 超过该大小的请求体在线程中解压，不阻塞事件循环
+INLINE_DECOMPRESS_BYTES = 64 * 1024
+READ_CHUNK_SIZE = 256 * 1024
+
+# 请求体损坏时解压抛出的异常
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def _read_limited(reader, limit: int) -> bytes:
+    output = io.BytesIO()
+    while True:
+        chunk = reader.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return output.getvalue()
+        output.write(chunk)
+        if output.tell() > limit:
+            raise BodyTooLarge()
+
+
+def decompress(body: bytes, encoding: str, limit: int) -> bytes:
+    """解压请求体，解压后超过 limit 字节时抛出 BodyTooLarge（防止压缩炸弹）"""
+    if encoding == "gzip":
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as reader:
+            return _read_limited(reader, limit)
+    with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body), read_across_frames=True) as reader:
+        return _read_limited(reader, limit)
+
+
+def supported_encodings() -> tuple:
+    return ("gzip", "zstd") if zstandard is not None else ("gzip",)
+
+
+class RequestDecompressionMiddleware:
+    """对指定路径前缀下带 Content-Encoding 的请求体解压"""
+
+    def __init__(self, app, prefix: str = "/api/submit", max_size: int = INGEST_MAX_BODY_BYTES):
+        self.app = app
+        self.prefix = prefix
+        self.max_size = max_size
+
+    async def _too_large(self, scope, receive, send):
+        response = JSONResponse({"detail": f"解压后的请求体超过 {self.max_size} 字节"}, status_code=413)
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        encoding = Headers(scope=scope).get("content-encoding", "").strip().lower()
+        if encoding in ("", "identity"):
+            await self.app(scope, receive, send)
+            return
+        if encoding not in supported_encodings():
+            response = JSONResponse(
+                {"detail": f"不支持的 Content-Encoding: {encoding}，可用 {', '.join(supported_encodings())}"},
+                status_code=415
+            )
+            await response(scope, receive, send)
+            return
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            more_body = message.get("more_body", False)
+            if size > self.max_size:
+                await self._too_large(scope, receive, send)
+                return
+        body = b"".join(chunks)
+
+        try:
+            if size <= INLINE_DECOMPRESS_BYTES:
+                body = decompress(body, encoding, self.max_size)
+            else:
+                body = await asyncio.get_running_loop().run_in_executor(
+                    None, decompress, body, encoding, self.max_size
+                )
+        except BodyTooLarge:
+            await self._too_large(scope, receive, send)
+            return
+        except DECOMPRESS_ERRORS as e:
+            response = JSONResponse({"detail": f"请求体解压失败: {str(e)}"}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        headers = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        # 原地修改，外层中间件（运行指标）之后还能从 scope 中读到匹配的路由
+        scope["headers"] = headers
+
+        delivered = False
+
+        async def receive_decompressed():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_decompressed, send)
@@ -0,0 +1,195 @@
+"""
+设备登记表
+入库时按设备更新首次/最近上报时间、累计记录数和各部分的最新数据，
+设备相关的查询只需读取 devices 表，不再对原始数据分组统计
+"""
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+from app.database import SessionLocal, CollectedData, Device, upsert
+from app import archive
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 重建时每次读取的记录数
+REBUILD_BATCH_SIZE = 5000
+
+
+def device_key(device_id) -> str:
+    """无设备ID的数据登记在空字符串下"""
+    return device_id or ""
+
+
+def _merge_latest(latest: dict, data) -> dict:
+    """按顶层部分合并，新数据中出现的部分整体替换旧值"""
+    if isinstance(data, dict):
+        latest.update(data)
+    return latest
+
+
+def _accumulate(records, states: dict) -> dict:
+    """把一批记录（需按 created_at 升序）累加到各设备的状态上"""
+    for record in records:
+        key = device_key(record.device_id)
+        state = states.get(key)
+        if state is None:
+            state = states[key] = {
+                "device_id": key,
+                "first_seen": record.created_at,
+                "sample_count": 0,
+                "latest_data": {},
+            }
+        state["sample_count"] += 1
+        state["last_seen"] = record.created_at
+        state["last_timestamp"] = record.timestamp
+        _merge_latest(state["latest_data"], record.data)
+    return states
+
+
+def update_devices(db: Session, records):
+    """
+    把新写入的记录合并进设备登记表（不提交，由调用方和记录写入放在同一事务内）
+
+    records 需要按 created_at 升序；调用前应已写入记录，此时事务已持有写锁，
+    读取已有的最新数据再合并不会与其它写入交错
+    """
+    states = _accumulate(records, {})
+    if not states:
+        return
+
+    existing = db.query(Device.device_id, Device.latest_data).filter(
+        Device.device_id.in_(list(states))
+    ).all()
+    for row in existing:
+        state = states[row.device_id]
+        state["latest_data"] = _merge_latest(dict(row.latest_data or {}), state["latest_data"])
+
+    stmt = upsert(Device)
+    current = Device.__table__.c
+    incoming = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["device_id"],
+        set_={
+            "first_seen": func.coalesce(current.first_seen, incoming.first_seen),
+            "last_seen": incoming.last_seen,
+            "sample_count": current.sample_count + incoming.sample_count,
+            "last_timestamp": incoming.last_timestamp,
+            "latest_data": incoming.latest_data,
+        }
+    )
+    db.execute(stmt, list(states.values()))
+
+
+def remove_from_devices(db: Session, record: CollectedData):
+    """
+    删除单条记录时扣减设备的记录数，没有剩余记录的设备一并删除（不提交）
+
+    最新数据无法撤销，保留到该设备下一次上报
+    """
+    key = device_key(record.device_id)
+    db.query(Device).filter(Device.device_id == key).update(
+        {Device.sample_count: Device.sample_count - 1}, synchronize_session=False
+    )
+    db.query(Device).filter(
+        Device.device_id == key,
+        Device.sample_count <= 0
+    ).delete(synchronize_session=False)
+
+
+def refresh_devices() -> int:
+    """
+    过期数据清理后，按剩余的原始数据校正各设备的记录数和首次上报时间，
+    删除已没有数据的设备（使用 idx_device_created_at 索引，不读取数据内容）。
+    归档中的数据同样计入
+
+    返回删除的设备数
+    """
+    remaining = archive.device_stats()
+    db = SessionLocal()
+    try:
+        query = db.query(
+            CollectedData.device_id,
+            func.count(CollectedData.id).label("count"),
+            func.min(CollectedData.created_at).label("first_seen")
+        )
+        boundary = archive.archive_boundary()
+        if boundary is not None:
+            query = query.filter(CollectedData.created_at >= boundary)
+        for row in query.group_by(CollectedData.device_id):
+            key = device_key(row.device_id)
+            if key in remaining:
+                count, first_seen = remaining[key]
+                remaining[key] = (count + row.count, min(first_seen, row.first_seen))
+            else:
+                remaining[key] = (row.count, row.first_seen)
+
+        removed = 0
+        for device in db.query(Device).all():
+            stats = remaining.get(device.device_id)
+            if stats is None:
+                db.delete(device)
+                removed += 1
+            else:
+                device.sample_count, device.first_seen = stats
+        db.commit()
+        return removed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def rebuild_devices() -> int:
+    """
+    从原始数据重建设备登记表，用于升级和修复
+
+    整个重建在一个事务内完成，期间写入会等待；先重放归档数据，再重放数据库中的数据。
+    返回登记的设备数
+    """
+    columns = ("device_id", "timestamp", "created_at", "data")
+    db = SessionLocal()
+    try:
+        db.query(Device).delete(synchronize_session=False)
+
+        states = {}
+        boundary = archive.archive_boundary()
+        if boundary is not None:
+            _accumulate(archive.scan(None, boundary, columns), states)
+
+        query = db.query(*[getattr(CollectedData, column) for column in columns])
+        if boundary is not None:
+            query = query.filter(CollectedData.created_at >= boundary)
+        rows = query.order_by(CollectedData.created_at, CollectedData.id).yield_per(REBUILD_BATCH_SIZE)
+        _accumulate(rows, states)
+
+        if states:
+            db.execute(insert(Device), list(states.values()))
+        db.commit()
+        logger.info(f"设备登记表重建完成，共 {len(states)} 个设备")
+        return len(states)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def device_state(device: Device) -> dict:
+    """设备的最新状态，结构与 /api/dashboard/latest 一致"""
+    return {
+        "device_id": device.device_id or None,
+        "timestamp": device.last_timestamp,
+        "created_at": device.last_seen.isoformat() if device.last_seen else None,
+        "data": device.latest_data,
+    }
+
+
+def total_devices(db: Session) -> int:
+    """登记的设备数"""
+    return db.query(func.count(Device.device_id)).scalar() or 0
+
+
+def active_devices(db: Session, since) -> int:
+    """since 之后有上报的设备数"""
+    return db.query(func.count(Device.device_id)).filter(Device.last_seen >= since).scalar() or 0
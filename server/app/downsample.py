@@ -0,0 +1,163 @@
+"""
+时间序列降采样与轨迹简化
+边读取数据库边按时间分桶，每个桶只保留首、尾、最小、最大四个候选点，
+再用 Largest-Triangle-Three-Buckets (LTTB) 从候选点中选出最终的点。
+内存占用只与桶数（max_points）有关，与窗口内的原始数据量无关，
+统计值（最小、最大、平均）基于全部原始数据计算。
+位置轨迹用 Douglas–Peucker 按地图上的距离简化。
+"""
+from datetime import datetime
+
+
+class SeriesDownsampler:
+    """
+    流式降采样器
+
+    按时间顺序调用 add()，最后调用 points() 和 stats()
+    """
+
+    def __init__(self, start: datetime, end: datetime, max_points: int = 100):
+        self.max_points = max(3, max_points)
+        self.start = start.timestamp()
+        # 每个桶最多贡献 4 个候选点，LTTB 再从中挑选
+        self.bucket_count = self.max_points
+        self.bucket_width = max((end.timestamp() - self.start) / self.bucket_count, 1e-6)
+        self._buckets = {}
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+
+    def add(self, time: datetime, value: float, point):
+        """加入一个原始数据点，point 为该点的原始记录，选中后才转换为输出格式"""
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        x = time.timestamp()
+        index = min(max(int((x - self.start) / self.bucket_width), 0), self.bucket_count - 1)
+        candidate = (x, value, point)
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            # [首, 尾, 最小, 最大]
+            self._buckets[index] = [candidate, candidate, candidate, candidate]
+            return
+        bucket[1] = candidate
+        if value < bucket[2][1]:
+            bucket[2] = candidate
+        if value > bucket[3][1]:
+            bucket[3] = candidate
+
+    def _candidates(self) -> list[tuple]:
+        candidates = []
+        for index in sorted(self._buckets):
+            seen = set()
+            for candidate in sorted(self._buckets[index], key=lambda c: c[0]):
+                if id(candidate) not in seen:
+                    seen.add(id(candidate))
+                    candidates.append(candidate)
+        return candidates
+
+    def points(self, render=None) -> list:
+        """降采样后的数据点（按时间升序），render 用于把原始记录转换为输出格式"""
+        candidates = self._candidates()
+        selected = [point for _, _, point in lttb(candidates, self.max_points)]
+        return [render(point) for point in selected] if render else selected
+
+    def stats(self, digits: int = 2) -> dict:
+        """全部原始数据的统计值"""
+        return {
+            "min": self.min if self.min is not None else 0,
+            "max": self.max if self.max is not None else 0,
+            "avg": round(self.sum / self.count, digits) if self.count else 0,
+        }
+
+
+def lttb(data: list[tuple], threshold: int) -> list[tuple]:
+    """
+    Largest-Triangle-Three-Buckets 降采样
+
+    data 为按 x 升序的 (x, y, ...) 元组列表，保留首尾点，
+    中间每个桶选出与前一个已选点、后一个桶均值构成三角形面积最大的点
+    """
+    length = len(data)
+    if threshold >= length or threshold < 3:
+        return list(data)
+
+    sampled = [data[0]]
+    every = (length - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # 下一个桶的平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, length)
+        next_bucket = data[next_start:next_end] or [data[-1]]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        # 当前桶中选面积最大的点
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = data[a][0], data[a][1]
+        max_area = -1
+        chosen = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (data[j][1] - ay) - (ax - data[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                chosen = j
+
+        sampled.append(data[chosen])
+        a = chosen
+
+    sampled.append(data[-1])
+    return sampled
+
+
+def douglas_peucker(points: list[tuple], tolerance: float) -> list[tuple]:
+    """
+    Douglas–Peucker 轨迹简化
+
+    points 为按时间排序的 (x, y, ...) 元组列表，保留首尾点，
+    去掉与简化后折线的距离不超过 tolerance 的点；用栈代替递归，长轨迹不会超出递归深度
+    """
+    length = len(points)
+    if length < 3 or tolerance <= 0:
+        return list(points)
+
+    keep = [False] * length
+    keep[0] = keep[-1] = True
+    stack = [(0, length - 1)]
+    tolerance_sq = tolerance * tolerance
+
+    while stack:
+        first, last = stack.pop()
+        ax, ay = points[first][0], points[first][1]
+        dx, dy = points[last][0] - ax, points[last][1] - ay
+        segment_sq = dx * dx + dy * dy
+
+        max_distance_sq = -1.0
+        chosen = None
+        for i in range(first + 1, last):
+            px, py = points[i][0] - ax, points[i][1] - ay
+            if segment_sq == 0:
+                distance_sq = px * px + py * py
+            else:
+                # 到线段（而不是直线）的距离，折返的轨迹不会被误删
+                t = min(max((px * dx + py * dy) / segment_sq, 0.0), 1.0)
+                ex, ey = px - t * dx, py - t * dy
+                distance_sq = ex * ex + ey * ey
+            if distance_sq > max_distance_sq:
+                max_distance_sq = distance_sq
+                chosen = i
+
+        if chosen is not None and max_distance_sq > tolerance_sq:
+            keep[chosen] = True
+            stack.append((first, chosen))
+            stack.append((chosen, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
@@ -0,0 +1,124 @@
+"""
+数据库访问线程池
+SQLAlchemy 会话是同步的，路由中直接调用会阻塞事件循环。
+数据库操作放到独立的有界线程池中执行：数据大屏/查询和数据写入各用一个线程池，
+耗时的大屏查询最多占满自己的线程池，不会让设备提交排在它们后面
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from app import profiling
+from app.responses import FastResponse
+
+logger = logging.getLogger(__name__)
+
+# 各线程池的线程数，0 表示在事件循环中直接执行（仅用于对比测试）
+POOL_WORKERS = {
+    # 数据大屏和查询接口；大屏扫描是 CPU 密集的 Python 代码，线程多了会和写入争抢 GIL
+    "dashboard": int(os.getenv("DASHBOARD_WORKERS", "2")),
+    # 数据提交和删除；SQLite 写入本来就是串行的（production 配置下只有一个写连接），
+    # 多个线程争抢同一个写连接时先释放的线程会立即再次拿到连接，其它线程可能一直等待
+    "ingest": int(os.getenv("INGEST_WORKERS", "1")),
+}
+
+
+class _Pool:
+    """线程池及其排队统计"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{name}")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+
+    def _run(self, func):
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def submit(self, loop: asyncio.AbstractEventLoop, func):
+        with self._lock:
+            self.pending += 1
+        return loop.run_in_executor(self.executor, self._run, func)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "completed": self.completed,
+            }
+
+
+_pools = {}
+
+
+def start_executors():
+    """创建线程池"""
+    for name, workers in POOL_WORKERS.items():
+        if workers > 0 and name not in _pools:
+            _pools[name] = _Pool(name, workers)
+    logger.info("数据库线程池已启动: " + ", ".join(f"{name}={workers}" for name, workers in POOL_WORKERS.items()))
+
+
+def stop_executors():
+    """等待已提交的任务完成后关闭线程池"""
+    for pool in list(_pools.values()):
+        pool.executor.shutdown(wait=True)
+    _pools.clear()
+
+
+async def run_in(pool: str, func, *args, **kwargs):
+    """
+    在指定线程池中执行同步函数；线程池未启动或线程数为 0 时直接执行
+
+    与 asyncio.to_thread 一样带上当前上下文（例如协商的响应格式），
+    当前请求正在采样分析时执行的线程参与采样
+    """
+    target = _pools.get(pool)
+    call = profiling.wrap_call(partial(func, *args, **kwargs))
+    if target is None:
+        return call()
+    return await target.submit(asyncio.get_running_loop(), partial(contextvars.copy_context().run, call))
+
+
+def offload(pool: str, render: bool = False):
+    """
+    把同步的路由函数包装为在指定线程池中执行的异步函数
+
+    用法：
+        @router.get("/overview")
+        @offload("dashboard", render=True)
+        def get_overview(...):
+            ...
+
+    包装后保留原函数签名，FastAPI 的参数解析和依赖注入不受影响。
+    render 为 True 时返回的 dict/list 也在线程池中按协商的格式（JSON / msgpack）序列化，
+    大屏的大响应不在事件循环中编码（只用于没有 response_model 的接口）
+    """
+    def decorator(func):
+        def call(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if render and isinstance(result, (dict, list)):
+                return FastResponse(result)
+            return result
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_in(pool, call, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def executor_stats() -> dict:
+    """各线程池的排队情况"""
+    return {name: pool.stats() for name, pool in _pools.items()}
@@ -0,0 +1,122 @@
+"""
+指标提取
+入库时从 JSON 数据中提取数据大屏常用的字段，写入带类型的独立列，
+查询时无需再逐条解析 JSON
+"""
+from sqlalchemy import or_
+from app.database import SessionLocal, CollectedData
+from app.geo import geo_cell
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 提取规则版本，规则变化时递增，backfill 会重新处理旧版本的记录
+METRICS_VERSION = 2
+
+# 前台应用名称的候选字段（按优先级），主要字段是 ForegroundAppCollector 的 packageName
+APP_NAME_FIELDS = ("packageName", "package_name", "appName", "name", "app_name")
+
+
+def _section(data: dict, key: str) -> dict:
+    value = data.get(key)
+    return value if isinstance(value, dict) else {}
+
+
+def _to_float(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_str(value, max_length: int):
+    if value is None:
+        return None
+    return str(value)[:max_length]
+
+
+def extract_metrics(data) -> dict:
+    """
+    从一条数据中提取指标列
+
+    字段缺失或格式不对时对应列为 None，不会抛出异常
+    """
+    if not isinstance(data, dict):
+        data = {}
+
+    battery = _section(data, "battery")
+    location = _section(data, "location")
+    network_info = _section(data, "networkInfo")
+    wifi_info = _section(network_info, "wifiInfo")
+    foreground_app = _section(data, "foregroundApp")
+
+    latitude = _to_float(location.get("latitude"))
+    longitude = _to_float(location.get("longitude"))
+    if latitude is None or longitude is None:
+        latitude = longitude = None
+
+    app_name = None
+    for field in APP_NAME_FIELDS:
+        if foreground_app.get(field):
+            app_name = foreground_app[field]
+            break
+    # 不支持获取前台应用的平台会上报 'N/A'
+    if app_name == "N/A":
+        app_name = None
+
+    battery_level = _to_float(battery.get("level"))
+    wifi_signal = _to_float(wifi_info.get("signalStrength"))
+
+    return {
+        "battery_level": battery_level,
+        "battery_charging": bool(battery.get("isCharging", False)) if battery_level is not None else None,
+        "wifi_signal": wifi_signal,
+        "wifi_ssid": _to_str(wifi_info.get("ssid", "N/A"), 100) if wifi_signal is not None else None,
+        "network_type": _to_str(network_info.get("networkType", "N/A"), 32) if wifi_signal is not None else None,
+        "latitude": latitude,
+        "longitude": longitude,
+        "geo_cell": geo_cell(latitude, longitude),
+        "foreground_app": _to_str(app_name, 200),
+        "metrics_version": METRICS_VERSION,
+    }
+
+
+def backfill_metrics(batch_size: int = 1000) -> int:
+    """
+    为已有记录补齐指标列（按 ID 分批处理，每批一个事务）
+
+    返回处理的记录数
+    """
+    db = SessionLocal()
+    processed = 0
+    last_id = 0
+    try:
+        while True:
+            rows = db.query(CollectedData.id, CollectedData.data).filter(
+                CollectedData.id > last_id,
+                or_(
+                    CollectedData.metrics_version.is_(None),
+                    CollectedData.metrics_version < METRICS_VERSION
+                )
+            ).order_by(CollectedData.id).limit(batch_size).all()
+
+            if not rows:
+                break
+
+            db.bulk_update_mappings(CollectedData, [
+                {"id": row.id, **extract_metrics(row.data)} for row in rows
+            ])
+            db.commit()
+
+            processed += len(rows)
+            last_id = rows[-1].id
+            logger.info(f"已补齐 {processed} 条记录的指标列")
+
+        return processed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
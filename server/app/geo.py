@@ -0,0 +1,336 @@
+"""
+位置聚合
+入库时把经纬度换算成 Web Mercator 瓦片网格上的单元编号（geo_cell，第 GEO_CELL_ZOOM 级瓦片坐标按位交错，
+即 quadkey 的整数形式），某一级的单元就是编号右移若干位，同一单元的点编号前缀相同。
+/location 按视口（bbox）和地图缩放级别在数据库中分组，返回每个单元的点数和质心，
+返回的单元数只与视口大小有关，与窗口内的数据量无关；轨迹按缩放级别对应的像素精度用 Douglas–Peucker 简化
+"""
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+from datetime import datetime
+from app.database import CollectedData
+from app.downsample import douglas_peucker
+from app import archive
+import math
+import os
+
+# 入库时计算单元编号的瓦片级别（约 2.4 米），编号占 48 位；修改后需要重新执行 backfill-metrics
+GEO_CELL_ZOOM = 24
+# 每个瓦片再细分的位数：3 表示每个瓦片 8×8 个单元（256 像素的瓦片上每个单元 32 像素）
+LOCATION_CLUSTER_BITS = int(os.getenv("LOCATION_CLUSTER_BITS", "3"))
+# 未指定缩放级别时，视口宽度约为几个瓦片
+LOCATION_VIEWPORT_TILES = 4
+# 轨迹简化的精度（像素）
+LOCATION_SIMPLIFY_PIXELS = float(os.getenv("LOCATION_SIMPLIFY_PIXELS", "1"))
+# 每个设备读入内存参与简化的最多点数，超过时先等间隔抽取
+LOCATION_TRACK_MAX_POINTS = int(os.getenv("LOCATION_TRACK_MAX_POINTS", "20000"))
+# 轨迹上相邻两点的时间间隔超过该值（秒）时断开，设备离开读取范围后再回来不会连成一条直线
+LOCATION_TRACK_GAP_SECONDS = int(os.getenv("LOCATION_TRACK_GAP_SECONDS", "600"))
+# 读取轨迹时在视口四周多读取的范围（占视口宽高的比例），进出视口的线段仍然完整
+LOCATION_TRACK_MARGIN = 0.5
+
+# Web Mercator 的纬度范围
+MAX_LATITUDE = 85.05112878
+WORLD_BBOX = (-180.0, -MAX_LATITUDE, 180.0, MAX_LATITUDE)
+
+TILE_SIZE = 256
+
+
+def project(latitude: float, longitude: float) -> tuple[float, float]:
+    """经纬度转为 Web Mercator 平面坐标，x、y 均在 [0, 1] 内（y 向南增大）"""
+    latitude = min(max(latitude, -MAX_LATITUDE), MAX_LATITUDE)
+    sin_lat = math.sin(math.radians(latitude))
+    x = (longitude + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def unproject(x: float, y: float) -> tuple[float, float]:
+    """Web Mercator 平面坐标转回 (纬度, 经度)"""
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return latitude, x * 360.0 - 180.0
+
+
+def _spread(value: int) -> int:
+    """把 32 位整数的各位分散到偶数位上"""
+    value &= 0xFFFFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def _compact(value: int) -> int:
+    """_spread 的逆运算"""
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4)) & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8)) & 0x0000FFFF0000FFFF
+    value = (value | (value >> 16)) & 0x00000000FFFFFFFF
+    return value
+
+
+def geo_cell(latitude, longitude):
+    """第 GEO_CELL_ZOOM 级的单元编号，坐标无效时为 None"""
+    if latitude is None or longitude is None:
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    x, y = project(latitude, longitude)
+    size = 1 << GEO_CELL_ZOOM
+    tile_x = min(int(x * size), size - 1)
+    tile_y = min(int(y * size), size - 1)
+    return _spread(tile_x) | (_spread(tile_y) << 1)
+
+
+def cell_bounds(cell: int, zoom: int) -> list[float]:
+    """第 zoom 级单元的范围 [南, 西, 北, 东]"""
+    tile_x, tile_y = _compact(cell), _compact(cell >> 1)
+    size = 1 << zoom
+    north, west = unproject(tile_x / size, tile_y / size)
+    south, east = unproject((tile_x + 1) / size, (tile_y + 1) / size)
+    return [round(south, 6), round(west, 6), round(north, 6), round(east, 6)]
+
+
+def parse_bbox(value: str) -> tuple[float, float, float, float]:
+    """
+    解析 "西,南,东,北"（经度, 纬度, 经度, 纬度）；西大于东表示跨越 180° 经线
+
+    格式不对时抛出 ValueError
+    """
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox 格式为 西,南,东,北")
+    west, south, east, north = parts
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south < north <= 90):
+        raise ValueError("bbox 超出经纬度范围或南北颠倒")
+    return west, south, east, north
+
+
+def fit_zoom(bbox: tuple) -> int:
+    """视口宽度约为 LOCATION_VIEWPORT_TILES 个瓦片的缩放级别"""
+    west, _, east, _ = bbox
+    span = (east - west) % 360 or 360
+    zoom = math.floor(math.log2(LOCATION_VIEWPORT_TILES * 360 / span))
+    return min(max(zoom, 0), cell_zoom_limit())
+
+
+def cell_zoom_limit() -> int:
+    """可用的最大缩放级别（再细分 LOCATION_CLUSTER_BITS 位后不超过 GEO_CELL_ZOOM）"""
+    return GEO_CELL_ZOOM - LOCATION_CLUSTER_BITS
+
+
+def _bbox_filter(bbox: tuple):
+    west, south, east, north = bbox
+    latitude = CollectedData.latitude.between(south, north)
+    if west <= east:
+        return and_(latitude, CollectedData.longitude.between(west, east))
+    return and_(latitude, or_(CollectedData.longitude >= west, CollectedData.longitude <= east))
+
+
+def _in_bbox(bbox: tuple, latitude: float, longitude: float) -> bool:
+    west, south, east, north = bbox
+    if not south <= latitude <= north:
+        return False
+    if west <= east:
+        return west <= longitude <= east
+    return longitude >= west or longitude <= east
+
+
+def cluster(db: Session, start_time: datetime, bbox: tuple, zoom: int, device_id: str = None) -> dict:
+    """
+    窗口内落在 bbox 中的位置按第 zoom + LOCATION_CLUSTER_BITS 级单元分组，返回每个单元的点数和质心
+
+    数据库中的热数据在 SQL 中分组（idx_created_geo 覆盖索引，不读取原始数据），
+    归档部分逐行读取经纬度列再分组；给出 device_id 时只统计该设备
+    """
+    level = min(zoom + LOCATION_CLUSTER_BITS, GEO_CELL_ZOOM)
+    shift = 2 * (GEO_CELL_ZOOM - level)
+    cells = {}
+
+    if archive.covers(start_time):
+        rows = archive.scan(
+            start_time, archive.archive_boundary(), ("latitude", "longitude"),
+            ... if device_id is None else device_id
+        )
+        for row in rows:
+            if row.latitude is None or not _in_bbox(bbox, row.latitude, row.longitude):
+                continue
+            code = geo_cell(row.latitude, row.longitude)
+            if code is None:
+                continue
+            cell = cells.setdefault(code >> shift, [0, 0.0, 0.0])
+            cell[0] += 1
+            cell[1] += row.latitude
+            cell[2] += row.longitude
+
+    code = CollectedData.geo_cell.op(">>")(shift).label("cell")
+    query = db.query(
+        code,
+        func.count().label("count"),
+        func.sum(CollectedData.latitude).label("latitude"),
+        func.sum(CollectedData.longitude).label("longitude")
+    ).filter(
+        CollectedData.created_at >= archive.hot_start(start_time),
+        CollectedData.geo_cell.isnot(None),
+        _bbox_filter(bbox)
+    )
+    if device_id is not None:
+        query = query.filter(CollectedData.device_id == device_id)
+    for row in query.group_by(code):
+        cell = cells.setdefault(row.cell, [0, 0.0, 0.0])
+        cell[0] += row.count
+        cell[1] += row.latitude
+        cell[2] += row.longitude
+
+    items = sorted(cells.items(), key=lambda item: item[1][0], reverse=True)
+    return {
+        "count": sum(cell[0] for cell in cells.values()),
+        "zoom": zoom,
+        "cell_zoom": level,
+        "bbox": list(bbox),
+        "cells": [
+            {
+                "latitude": round(sum_lat / count, 6),
+                "longitude": round(sum_lon / count, 6),
+                "count": count,
+                "bounds": cell_bounds(cell, level),
+            }
+            for cell, (count, sum_lat, sum_lon) in items
+        ],
+    }
+
+
+def _pad_bbox(bbox: tuple, ratio: float) -> tuple:
+    """四周按视口宽高的 ratio 倍扩大 bbox，经度超出范围时绕回（可能因此跨越 180° 经线）"""
+    west, south, east, north = bbox
+    width = (east - west) % 360 or 360
+    margin = (north - south) * ratio
+    south, north = max(south - margin, -90.0), min(north + margin, 90.0)
+    if width * (1 + 2 * ratio) >= 360:
+        return -180.0, south, 180.0, north
+    margin = width * ratio
+    return (west - margin + 180) % 360 - 180, south, (east + margin + 180) % 360 - 180, north
+
+
+def _split_gaps(points: list[tuple]) -> list[list[tuple]]:
+    """相邻两点的时间间隔超过 LOCATION_TRACK_GAP_SECONDS 的地方断开"""
+    gap = LOCATION_TRACK_GAP_SECONDS * 1000
+    parts = []
+    for point in points:
+        if not parts or point[4] - parts[-1][-1][4] > gap:
+            parts.append([])
+        parts[-1].append(point)
+    return parts
+
+
+def _clip(points: list[tuple], bbox: tuple) -> list[list[tuple]]:
+    """
+    只保留视口内的轨迹，拆成若干段
+
+    保留视口内的点以及紧挨着它们的视口外的点，进出视口的线段仍然完整
+    """
+    inside = [_in_bbox(bbox, point[2], point[3]) for point in points]
+    segments = []
+    current = []
+    for i, point in enumerate(points):
+        near = inside[i] or (i > 0 and inside[i - 1]) or (i + 1 < len(points) and inside[i + 1])
+        if near:
+            current.append(point)
+        elif current:
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    return segments
+
+
+def _simplify(points: list[tuple], tolerance: float, max_points: int) -> list[tuple]:
+    """按 tolerance 简化，仍超过 max_points 时逐步放宽精度"""
+    simplified = douglas_peucker(points, tolerance)
+    while len(simplified) > max_points and tolerance > 0:
+        tolerance *= 2
+        simplified = douglas_peucker(simplified, tolerance)
+    return simplified
+
+
+def trajectories(db: Session, start_time: datetime, bbox: tuple, zoom: int, max_points: int,
+                 device_id: str = None) -> list[dict]:
+    """
+    窗口内各设备按数据时间戳排列的轨迹，按第 zoom 级地图上 LOCATION_SIMPLIFY_PIXELS 像素的精度简化，
+    每段最多 max_points 个点
+
+    只读取视口四周 LOCATION_TRACK_MARGIN 范围内的点，每个设备最多 LOCATION_TRACK_MAX_POINTS 个；
+    只返回经过视口的部分，离开视口或长时间没有数据的地方断开成多段；点为 [纬度, 经度, 时间戳]
+    """
+    # 只读取视口附近的点（idx_created_geo 覆盖索引上过滤经纬度），内存和耗时与视口内的数据量有关
+    area = _pad_bbox(bbox, LOCATION_TRACK_MARGIN)
+    columns = ("device_id", "timestamp", "latitude", "longitude")
+
+    archived = {}
+    if archive.covers(start_time):
+        rows = archive.scan(
+            start_time, archive.archive_boundary(), columns, ... if device_id is None else device_id
+        )
+        for row in rows:
+            if (
+                row.latitude is not None and row.longitude is not None and row.timestamp is not None
+                and _in_bbox(area, row.latitude, row.longitude)
+            ):
+                archived.setdefault(row.device_id, []).append((row.timestamp, row.latitude, row.longitude))
+
+    filters = [
+        CollectedData.created_at >= archive.hot_start(start_time),
+        CollectedData.latitude.isnot(None),
+        CollectedData.timestamp.isnot(None),
+        _bbox_filter(area),
+    ]
+    if device_id is not None:
+        filters.append(CollectedData.device_id == device_id)
+    counts = dict(
+        db.query(CollectedData.device_id, func.count()).filter(*filters).group_by(CollectedData.device_id).all()
+    )
+
+    # 每个设备最多保留约 LOCATION_TRACK_MAX_POINTS 个点，超过时按时间顺序等间隔抽取
+    totals = {key: len(points) for key, points in archived.items()}
+    for key, count in counts.items():
+        totals[key] = totals.get(key, 0) + count
+    strides = {key: -(-total // LOCATION_TRACK_MAX_POINTS) for key, total in totals.items()}
+
+    tracks = {}
+    for key, points in archived.items():
+        points.sort()
+        tracks[key] = [
+            (*project(latitude, longitude), latitude, longitude, timestamp)
+            for timestamp, latitude, longitude in points[::strides[key]]
+        ]
+    query = db.query(*[getattr(CollectedData, column) for column in columns]).filter(
+        *filters
+    ).order_by(CollectedData.device_id, CollectedData.timestamp).yield_per(1000)
+    index = {}
+    for row in query:
+        position = index.get(row.device_id, 0)
+        index[row.device_id] = position + 1
+        if position % strides[row.device_id]:
+            continue
+        x, y = project(row.latitude, row.longitude)
+        tracks.setdefault(row.device_id, []).append((x, y, row.latitude, row.longitude, row.timestamp))
+
+    # 一个像素在平面坐标中的长度
+    tolerance = LOCATION_SIMPLIFY_PIXELS / (TILE_SIZE * (1 << zoom))
+    result = []
+    for key in sorted(tracks, key=lambda item: item or ""):
+        points = sorted(tracks[key], key=lambda point: point[4])
+        segments = []
+        for part in _split_gaps(points):
+            for segment in _clip(part, bbox):
+                segments.append([
+                    [round(point[2], 6), round(point[3], 6), point[4]]
+                    for point in _simplify(segment, tolerance, max_points)
+                ])
+        if segments:
+            result.append({"device_id": key, "count": totals[key], "segments": segments})
+    return result
@@ -0,0 +1,337 @@
+"""
+数据写入
+所有入库路径（单条提交、批量提交、写入队列）统一经过这里
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from datetime import datetime
+from app import cluster, sections
+from app.cache import response_cache
+from app.database import CollectedData, SessionLocal
+from app.devices import remove_from_devices, update_devices
+from app.executor import run_in
+from app.extractors import extract_metrics
+from app.pubsub import broker, record_event
+from app.rollups import remove_from_rollups, update_rollups
+from app.schemas import DataSubmission
+from app.sessions import remove_from_sessions, update_sessions
+from app.telemetry import record_ingest
+from collections import deque
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 写入模式：sync 请求内直接提交；async 先入队列，由后台线程批量提交
+INGEST_MODE = os.getenv("INGEST_MODE", "sync").lower()
+# 写入队列容量，队列满时提交接口返回 503
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+# 每批最多写入的记录数
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+# 一条记录在队列中等待写入的最长时间（毫秒）
+INGEST_MAX_LATENCY_MS = int(os.getenv("INGEST_MAX_LATENCY_MS", "200"))
+# 一批写入失败后整批重试的次数（如清理、归档任务期间短暂的 database is locked），之后逐条写入
+INGEST_RETRY_ATTEMPTS = int(os.getenv("INGEST_RETRY_ATTEMPTS", "3"))
+# 第一次重试前的等待时间（毫秒），之后每次翻倍
+INGEST_RETRY_BACKOFF_MS = int(os.getenv("INGEST_RETRY_BACKOFF_MS", "200"))
+# 逐条写入仍然失败的数据保留在内存中的最大条数（完整内容同时写入错误日志）
+INGEST_DEAD_LETTER_SIZE = int(os.getenv("INGEST_DEAD_LETTER_SIZE", "1000"))
+
+
+def build_record(submission: DataSubmission, created_at: datetime = None) -> CollectedData:
+    """根据提交内容构造数据记录"""
+    return CollectedData(
+        device_id=submission.device_id,
+        timestamp=submission.timestamp,
+        data=submission.data,
+        created_at=created_at or datetime.utcnow(),
+        **extract_metrics(submission.data)
+    )
+
+
+def store_submissions(db: Session, submissions: list[DataSubmission], created_at: datetime = None) -> list[int]:
+    """
+    在一个事务内批量写入数据，返回新记录的 ID 列表（与输入顺序一致）
+
+    created_at 默认为当前时间，回放历史数据（如基准测试预置数据）时可以指定；
+    出错时回滚并向上抛出异常，由调用方决定如何响应
+    """
+    if not submissions:
+        return []
+
+    created_at = created_at or datetime.utcnow()
+    records = [build_record(submission, created_at) for submission in submissions]
+
+    try:
+        # 静态部分只保存一次，记录中保存引用
+        payloads = [record.data for record in records]
+        compacted, upserts = sections.compact(db, payloads)
+        for record, data in zip(records, compacted):
+            record.data = data
+        db.add_all(records)
+        # flush 后即可拿到自增 ID，避免 commit 后逐条 refresh
+        db.flush()
+        # 之后的推送和设备登记表使用完整数据
+        for record, data in zip(records, payloads):
+            set_committed_value(record, "data", data)
+        ids = [record.id for record in records]
+        # 提交后记录会过期，先生成推送事件
+        events = [record_event(record) for record in records]
+        # 预聚合、设备登记表、应用会话与记录在同一事务内更新
+        update_rollups(db, records)
+        update_devices(db, records)
+        update_sessions(db, records)
+        db.commit()
+        sections.remember(upserts)
+        record_ingest([record.device_id for record in records])
+        # 数据已变化，数据大屏的缓存失效
+        response_cache.bump_generation()
+        # 推送给订阅了实时数据的连接
+        broker.publish(events)
+        return ids
+    except Exception:
+        db.rollback()
+        raise
+
+
+def delete_record(db: Session, data_id: int) -> bool:
+    """删除一条记录，同时从预聚合、设备登记表和应用会话中去掉；记录不存在时返回 False"""
+    record = db.query(CollectedData).filter(CollectedData.id == data_id).first()
+    if not record:
+        return False
+    try:
+        remove_from_rollups(db, record)
+        remove_from_devices(db, record)
+        remove_from_sessions(db, record)
+        db.delete(record)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    response_cache.bump_generation()
+    return True
+
+
+async def persist(db: Session, submissions: list[DataSubmission]) -> list[int]:
+    """在请求中写入：多进程模式下交给写入进程，否则在写入线程池中执行"""
+    if cluster.writer_client is not None:
+        return await cluster.writer_client.call("store", items=[item.model_dump() for item in submissions])
+    return await run_in("ingest", store_submissions, db, submissions)
+
+
+async def delete(db: Session, data_id: int) -> bool:
+    """在请求中删除，与 persist 一样选择执行的位置"""
+    if cluster.writer_client is not None:
+        return await cluster.writer_client.call("delete", data_id=data_id)
+    return await run_in("ingest", delete_record, db, data_id)
+
+
+def _write_batch(batch: list[DataSubmission]):
+    """写入队列的后台线程写入一批"""
+    if cluster.writer_client is not None:
+        cluster.writer_client.call_from_thread("store", items=[item.model_dump() for item in batch])
+        return
+    db = SessionLocal()
+    try:
+        store_submissions(db, batch)
+    finally:
+        db.close()
+
+
+class IngestQueue:
+    """
+    写后（write-behind）队列
+    
+    提交接口只负责入队，后台线程按数量或最长等待时间凑批，
+    一个事务提交一批，请求延迟不再受磁盘 fsync 影响。
+    数据入队时已经返回 202，写入失败时先整批重试，再逐条写入，
+    只有本身无法写入的数据进入死信列表。
+    """
+
+    def __init__(self, maxsize: int, batch_size: int, max_latency_ms: int):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = max(1, batch_size)
+        self.max_latency = max_latency_ms / 1000
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        # 统计计数
+        self.enqueued = 0
+        self.rejected = 0
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead_letters = deque(maxlen=max(1, INGEST_DEAD_LETTER_SIZE))
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        """启动后台写入线程"""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30) -> bool:
+        """
+        停止写入线程，退出前写完队列中剩余的数据
+
+        超时后线程仍在写入时记录警告并保留线程，返回 False
+        """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning(
+                    f"写入线程 {timeout} 秒内未结束，队列中还有 {self._queue.qsize()} 条数据等待写入"
+                )
+                return False
+            self._thread = None
+        return True
+
+    def put(self, submission: DataSubmission) -> bool:
+        """入队，队列已满或正在停止时返回 False"""
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait(submission)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _next_batch(self) -> list[DataSubmission]:
+        """取下一批数据：拿到第一条后，最多再等待 max_latency 凑满一批"""
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self) -> list[DataSubmission]:
+        """不等待，直接取出最多一批数据"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+        # 关闭前写完剩余数据
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _write_with_retry(self, batch: list[DataSubmission]) -> Exception:
+        """整批写入，失败时按退避时间重试，返回最后一次的异常（成功时为 None）"""
+        error = None
+        for attempt in range(INGEST_RETRY_ATTEMPTS + 1):
+            if attempt:
+                with self._lock:
+                    self.retried += 1
+                time.sleep(INGEST_RETRY_BACKOFF_MS / 1000 * 2 ** (attempt - 1))
+            try:
+                _write_batch(batch)
+                return None
+            except Exception as e:
+                error = e
+        return error
+
+    def _flush(self, batch: list[DataSubmission]):
+        start = time.perf_counter()
+        failed = []
+        error = self._write_with_retry(batch)
+        if error is not None:
+            # 与写入进程的 _store 一致：整批失败后逐条写入，只有出错的数据丢弃
+            logger.warning(f"批量写入 {len(batch)} 条数据失败（{error}），逐条重试")
+            for submission in batch:
+                try:
+                    _write_batch([submission])
+                except Exception as e:
+                    failed.append(submission)
+                    logger.error(f"数据写入失败，已放入死信列表: {e}; {submission.model_dump_json()}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.written += len(batch) - len(failed)
+            self.failed += len(failed)
+            self.dead_letters.extend(failed)
+            self.flush_count += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+
+    def stats(self) -> dict:
+        """队列深度与写入耗时统计"""
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "enqueued": self.enqueued,
+                "rejected": self.rejected,
+                "written": self.written,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dead_letters": len(self.dead_letters),
+                "flush_count": self.flush_count,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+                "avg_flush_ms": round(self.total_flush_ms / self.flush_count, 2) if self.flush_count else 0,
+            }
+
+
+ingest_queue = None
+
+
+def start_ingest_queue():
+    """INGEST_MODE=async 时启动写入队列"""
+    global ingest_queue
+
+    if INGEST_MODE != "async" or ingest_queue is not None:
+        return
+
+    ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_MAX_LATENCY_MS)
+    ingest_queue.start()
+    logger.info(
+        f"异步写入队列已启动（容量 {INGEST_QUEUE_SIZE}，每批 {INGEST_BATCH_SIZE} 条，"
+        f"最长等待 {INGEST_MAX_LATENCY_MS} ms）"
+    )
+
+
+def stop_ingest_queue():
+    """停止写入队列并写完剩余数据"""
+    global ingest_queue
+
+    if ingest_queue is not None:
+        if not ingest_queue.stop():
+            # 保留队列对象，剩余数据由仍在运行的写入线程继续写入，状态接口可以看到队列深度
+            return
+        logger.info(f"异步写入队列已停止，共写入 {ingest_queue.written} 条数据")
+        ingest_queue = None
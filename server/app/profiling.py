@@ -0,0 +1,289 @@
+"""
+慢查询日志和按请求采样分析
+- 慢查询：执行时间超过 SLOW_QUERY_MS 的 SQL 连同参数、耗时和 EXPLAIN QUERY PLAN 写入日志，
+  最近的记录保存在内存中，可通过 /api/admin/slow-queries 查看
+- 采样分析：配置 ADMIN_TOKEN 后，数据大屏请求带上 `X-Admin-Token` 和 `X-Profile: 1` 时，
+  定时采样处理这个请求的线程的调用栈，返回 folded stacks 格式（flamegraph.pl / speedscope 可直接读取）
+  而不是原来的响应，用来区分耗时在 SQL、数据解码还是响应编码
+"""
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, PlainTextResponse
+import hmac
+import logging
+import os
+import reprlib
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 慢查询阈值（毫秒），0 表示关闭
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+# 内存中保留的最近慢查询条数
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "100"))
+# 管理接口和请求采样分析的令牌，为空表示关闭
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 采样间隔（毫秒）；CPU 密集的线程每隔 sys.getswitchinterval()（默认 5ms）才让出 GIL，实际间隔不会小于它
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# 参数只保留开头部分，避免 data 列等大字段撑大日志
+_param_repr = reprlib.Repr()
+_param_repr.maxstring = 200
+_param_repr.maxother = 200
+_param_repr.maxlist = 20
+_param_repr.maxtuple = 20
+_param_repr.maxdict = 20
+
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+_EXPLAINABLE = ("SELECT", "WITH ", "INSERT", "UPDATE", "DELETE")
+
+
+def check_admin_token(value: str) -> bool:
+    """校验管理员令牌，未配置 ADMIN_TOKEN 时一律拒绝"""
+    if not ADMIN_TOKEN or not value:
+        return False
+    return hmac.compare_digest(value.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+# ---------- 慢查询 ----------
+
+def _format_parameters(parameters, executemany: bool) -> str:
+    if executemany:
+        first = parameters[0] if parameters else None
+        return f"{len(parameters)} 组，第一组: {_param_repr.repr(first)}"
+    return _param_repr.repr(parameters)
+
+
+def _explain(conn, statement: str, parameters) -> list:
+    """在同一个连接上执行 EXPLAIN QUERY PLAN，按层级缩进返回每个步骤"""
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    finally:
+        cursor.close()
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append("  " * depth[node_id] + detail)
+    return plan
+
+
+def _record_slow_query(conn, name: str, statement: str, parameters, executemany: bool, elapsed: float):
+    plan = []
+    # 批量写入的执行计划没有意义，建表等语句执行后已无法 EXPLAIN，其它数据库的 EXPLAIN 语法不同
+    if (
+        conn.dialect.name == "sqlite"
+        and not executemany
+        and statement.lstrip()[:6].upper() in _EXPLAINABLE
+    ):
+        try:
+            plan = _explain(conn, statement, parameters)
+        except Exception as e:
+            plan = [f"EXPLAIN 失败: {str(e)}"]
+    entry = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "engine": name,
+        "duration_ms": round(elapsed * 1000, 1),
+        "statement": " ".join(statement.split()),
+        "parameters": _format_parameters(parameters, executemany),
+        "plan": plan,
+        "thread": threading.current_thread().name,
+    }
+    slow_queries.append(entry)
+    logger.warning(
+        "慢查询 %.1fms [%s] %s 参数: %s 执行计划: %s",
+        entry["duration_ms"], name, entry["statement"], entry["parameters"], " | ".join(plan) or "-"
+    )
+
+
+def instrument_engine(engine, name: str):
+    """记录慢查询，并把 SQL 次数和耗时计入正在采样分析的请求"""
+    from sqlalchemy import event
+
+    threshold = SLOW_QUERY_MS / 1000
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._profiling_start = time.perf_counter()
+
+    # SQLite 的 execute 执行到产生第一行为止：排序、分组等在这里完成，逐行读取的时间不计入
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_profiling_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        session = _active_session.get()
+        if session is not None:
+            session.queries += 1
+            session.sql_seconds += elapsed
+        if threshold > 0 and elapsed >= threshold:
+            _record_slow_query(conn, name, statement, parameters, executemany, elapsed)
+
+
+# ---------- 采样分析 ----------
+
+# 当前请求的采样分析，线程池中执行的函数通过复制的上下文拿到
+_active_session = ContextVar("profile_session", default=None)
+
+_SERVER_DIR = str(Path(__file__).resolve().parent.parent) + os.sep
+_frame_labels = {}
+
+
+def _frame_label(code) -> str:
+    """函数名 (文件:首行)，与 py-spy 的 folded 输出一致"""
+    label = _frame_labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        if filename.startswith(_SERVER_DIR):
+            filename = filename[len(_SERVER_DIR):]
+        elif "site-packages" + os.sep in filename:
+            filename = filename.split("site-packages" + os.sep, 1)[1]
+        else:
+            filename = os.path.basename(filename)
+        name = getattr(code, "co_qualname", code.co_name)
+        label = _frame_labels[code] = f"{name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+    return label
+
+
+class ProfileSession:
+    """对登记的线程定时采样调用栈，按调用栈计数"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def run(self, call):
+        """在当前线程执行 call，期间采样这个线程"""
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+        try:
+            return call()
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = list(self._threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[self._fold(frame)] += 1
+                    self.samples += 1
+
+    @staticmethod
+    def _fold(frame) -> str:
+        # 只保留 run 之上的部分，去掉线程池本身的调用栈
+        names = []
+        while frame is not None and frame.f_code is not _RUN_CODE:
+            names.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_RUN_CODE = ProfileSession.run.__code__
+
+
+def wrap_call(call):
+    """当前请求正在采样分析时，让 call 执行期间的线程参与采样"""
+    session = _active_session.get()
+    if session is None:
+        return call
+    return lambda: session.run(call)
+
+
+def profiling_active() -> bool:
+    return _active_session.get() is not None
+
+
+class ProfilerMiddleware:
+    """
+    带 `X-Profile: 1` 和正确的 `X-Admin-Token` 的请求在采样分析下执行，
+    原来的响应被丢弃，返回 folded stacks 文本；放在响应缓存外层，采样期间不读写缓存
+    """
+
+    def __init__(self, app, prefix: str, exclude: tuple = ()):
+        self.app = app
+        self.prefix = prefix
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith(self.prefix)
+            or scope["path"].startswith(self.exclude)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        if headers.get("x-profile", "").lower() not in ("1", "true"):
+            await self.app(scope, receive, send)
+            return
+        if not check_admin_token(headers.get("x-admin-token", "")):
+            await JSONResponse({"detail": "需要管理员令牌"}, status_code=403)(scope, receive, send)
+            return
+
+        status = 500
+
+        async def discard(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        session = ProfileSession(PROFILE_INTERVAL_MS / 1000)
+        token = _active_session.set(session)
+        session.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            elapsed = time.perf_counter() - start
+            session.stop()
+            _active_session.reset(token)
+
+        response = PlainTextResponse(session.folded(), headers={
+            "Cache-Control": "no-store",
+            "X-Profile-Status": str(status),
+            "X-Profile-Duration-Ms": f"{elapsed * 1000:.1f}",
+            "X-Profile-Samples": str(session.samples),
+            "X-Profile-Interval-Ms": f"{PROFILE_INTERVAL_MS:g}",
+            "X-Profile-DB-Queries": str(session.queries),
+            "X-Profile-DB-Ms": f"{session.sql_seconds * 1000:.1f}",
+        })
+        await response(scope, receive, send)
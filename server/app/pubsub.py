@@ -0,0 +1,165 @@
+"""
+实时推送
+入库提交后把新数据发布给所有订阅的数据大屏连接（SSE / WebSocket），
+每个连接有独立的有界缓冲区，消费过慢的连接会被断开，
+最近的事件保存在环形缓冲区中，断线重连时可以从 Last-Event-ID 之后继续
+"""
+from collections import deque
+from datetime import datetime
+import asyncio
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 每个连接最多缓冲的事件数，超过则断开该连接
+STREAM_CLIENT_BUFFER = int(os.getenv("STREAM_CLIENT_BUFFER", "256"))
+# 保留用于断线续传的最近事件数
+STREAM_HISTORY_SIZE = int(os.getenv("STREAM_HISTORY_SIZE", "2000"))
+# 没有新数据时发送心跳的间隔（秒）
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "15"))
+
+
+def record_event(record) -> dict:
+    """
+    一条入库记录对应的推送事件
+
+    data 中只包含本次上报的部分，按部分合并即可得到设备的最新状态（与 /latest 一致）
+    """
+    return {
+        "id": record.id,
+        "device_id": record.device_id,
+        "timestamp": record.timestamp,
+        "created_at": record.created_at.isoformat() if isinstance(record.created_at, datetime) else None,
+        "data": record.data,
+    }
+
+
+class Subscription:
+    """一个推送连接的订阅，事件只在所属的事件循环中读取"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, device_ids, buffer_size: int):
+        self.loop = loop
+        self.device_ids = device_ids
+        self.buffer_size = buffer_size
+        self.queue = asyncio.Queue()
+        # 续传位置已不在环形缓冲区中，客户端需要重新拉取完整数据
+        self.reset = False
+        self.dropped = False
+
+    def matches(self, event: dict) -> bool:
+        return self.device_ids is None or event["device_id"] in self.device_ids
+
+    def _deliver(self, events: list):
+        """在订阅所属的事件循环中执行"""
+        if self.dropped:
+            return
+        for event in events:
+            if not self.matches(event):
+                continue
+            if self.queue.qsize() >= self.buffer_size:
+                # 消费过慢：丢弃缓冲的事件，通知连接结束
+                self.dropped = True
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(None)
+                return
+            self.queue.put_nowait(event)
+
+    def close(self):
+        self.queue.put_nowait(None)
+
+    async def get(self, timeout: float):
+        """取下一个事件；超时返回 ...，订阅结束返回 None"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return ...
+
+
+class Broker:
+    """进程内发布/订阅，发布方可以在任意线程（包括后台写入线程）调用 publish()"""
+
+    def __init__(self, buffer_size: int, history_size: int):
+        self.buffer_size = max(1, buffer_size)
+        self._history = deque(maxlen=max(0, history_size))
+        self._subscriptions = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def add_listener(self, callback):
+        """发布时在发布方线程中调用 callback(events)（多进程部署时写入进程用它把事件转发给工作进程）"""
+        self._listeners.append(callback)
+
+    def publish(self, events: list):
+        """发布一批事件（按 id 升序）"""
+        if not events:
+            return
+        with self._lock:
+            self._history.extend(events)
+            self.published += len(events)
+            subscriptions = list(self._subscriptions)
+
+        for listener in self._listeners:
+            listener(events)
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, events)
+            except RuntimeError:
+                # 事件循环已关闭
+                self.unsubscribe(subscription)
+
+    def subscribe(self, device_ids=None, last_event_id: int = None) -> Subscription:
+        """
+        在当前事件循环中订阅
+
+        device_ids 为空表示订阅所有设备；给出 last_event_id 时先补发之后的历史事件
+        """
+        subscription = Subscription(asyncio.get_running_loop(), device_ids, self.buffer_size)
+        with self._lock:
+            if last_event_id is not None:
+                missed = [
+                    event for event in self._history
+                    if event["id"] > last_event_id and subscription.matches(event)
+                ]
+                covered = bool(self._history) and self._history[0]["id"] <= last_event_id + 1 \
+                    and self._history[-1]["id"] >= last_event_id
+                if (covered or (not self._history and last_event_id <= 0)) and len(missed) < self.buffer_size:
+                    subscription._deliver(missed)
+                else:
+                    subscription.reset = True
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if subscription.dropped:
+                self.dropped += 1
+
+    def close(self):
+        """通知所有连接结束（服务关闭时调用）"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.close)
+            except RuntimeError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscriptions),
+                "published": self.published,
+                "dropped": self.dropped,
+                "history": len(self._history),
+                "last_event_id": self._history[-1]["id"] if self._history else None,
+            }
+
+
+broker = Broker(STREAM_CLIENT_BUFFER, STREAM_HISTORY_SIZE)
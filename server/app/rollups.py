@@ -0,0 +1,355 @@
+"""
+时间桶预聚合
+入库时按分钟 / 小时 / 天增量更新 metric_rollups，
+时间序列和概览统计从最粗且能覆盖查询窗口的粒度读取，不再扫描原始数据
+"""
+from sqlalchemy import and_, or_, case, func
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from app.database import SessionLocal, CollectedData, MetricRollup, greatest, least, upsert
+from app import archive
+import logging
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("minute", "hour", "day")
+
+# 参与预聚合的指标：列名前缀 -> CollectedData 上的指标列
+ROLLUP_METRICS = {
+    "battery": "battery_level",
+    "wifi": "wifi_signal",
+}
+
+# 重放原始数据时每次读取的时间跨度（同一天内的多次读取累加后一次替换）
+REBUILD_CHUNK = timedelta(hours=1)
+
+
+def floor_time(value: datetime, granularity: str) -> datetime:
+    """时间向下取整到时间桶起点"""
+    if granularity == "minute":
+        return value.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_time(value: datetime, granularity: str) -> datetime:
+    """时间向上取整到时间桶起点"""
+    floored = floor_time(value, granularity)
+    if floored == value:
+        return floored
+    step = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}[granularity]
+    return floored + step
+
+
+def _new_bucket() -> dict:
+    bucket = {"count": 0, "last_at": None}
+    for prefix in ROLLUP_METRICS:
+        bucket.update({
+            f"{prefix}_count": 0,
+            f"{prefix}_min": None,
+            f"{prefix}_max": None,
+            f"{prefix}_sum": 0.0,
+            f"{prefix}_last": None,
+        })
+    return bucket
+
+
+def _accumulate(records, buckets: dict = None) -> dict:
+    """把一批记录（需按 created_at 升序）累加到 (粒度, 桶起点, 设备) 上"""
+    if buckets is None:
+        buckets = {}
+    for record in records:
+        device_id = record.device_id or ""
+        for granularity in GRANULARITIES:
+            key = (granularity, floor_time(record.created_at, granularity), device_id)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _new_bucket()
+            bucket["count"] += 1
+            bucket["last_at"] = record.created_at
+            for prefix, column in ROLLUP_METRICS.items():
+                value = getattr(record, column)
+                if value is None:
+                    continue
+                bucket[f"{prefix}_count"] += 1
+                bucket[f"{prefix}_sum"] += value
+                bucket[f"{prefix}_last"] = value
+                if bucket[f"{prefix}_min"] is None or value < bucket[f"{prefix}_min"]:
+                    bucket[f"{prefix}_min"] = value
+                if bucket[f"{prefix}_max"] is None or value > bucket[f"{prefix}_max"]:
+                    bucket[f"{prefix}_max"] = value
+    return buckets
+
+
+def _merge_min_max(existing, incoming, func_name: str):
+    """合并最小/最大值，任一侧为 NULL 时取另一侧"""
+    return case(
+        (existing.is_(None), incoming),
+        (incoming.is_(None), existing),
+        else_=(least if func_name == "min" else greatest)(existing, incoming)
+    )
+
+
+def update_rollups(db: Session, records):
+    """
+    把新写入的记录合并进预聚合表（不提交，由调用方和记录写入放在同一事务内）
+
+    records 需要已设置 created_at 和指标列，并按 created_at 升序
+    """
+    _write_buckets(db, _accumulate(records))
+
+
+def _write_buckets(db: Session, buckets: dict):
+    """
+    把累加好的桶合并进预聚合表（不提交）
+
+    最新值只在写入的一侧不早于已有桶时覆盖，避免较旧的记录把新写入的值换回去
+    """
+    if not buckets:
+        return
+
+    rows = [
+        {"granularity": granularity, "bucket_start": bucket_start, "device_id": device_id, **values}
+        for (granularity, bucket_start, device_id), values in buckets.items()
+    ]
+
+    stmt = upsert(MetricRollup)
+    existing = MetricRollup.__table__.c
+    incoming = stmt.excluded
+    newer = or_(existing.last_at.is_(None), incoming.last_at >= existing.last_at)
+    update = {
+        "count": existing.count + incoming.count,
+        "last_at": _merge_min_max(existing.last_at, incoming.last_at, "max"),
+    }
+    for prefix in ROLLUP_METRICS:
+        update.update({
+            f"{prefix}_count": existing[f"{prefix}_count"] + incoming[f"{prefix}_count"],
+            f"{prefix}_sum": existing[f"{prefix}_sum"] + incoming[f"{prefix}_sum"],
+            f"{prefix}_min": _merge_min_max(existing[f"{prefix}_min"], incoming[f"{prefix}_min"], "min"),
+            f"{prefix}_max": _merge_min_max(existing[f"{prefix}_max"], incoming[f"{prefix}_max"], "max"),
+            f"{prefix}_last": case(
+                (newer, func.coalesce(incoming[f"{prefix}_last"], existing[f"{prefix}_last"])),
+                else_=func.coalesce(existing[f"{prefix}_last"], incoming[f"{prefix}_last"])
+            ),
+        })
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["granularity", "bucket_start", "device_id"],
+        set_=update
+    )
+    db.execute(stmt, rows)
+
+
+def remove_from_rollups(db: Session, record: CollectedData):
+    """
+    删除单条记录时扣减对应桶的计数和求和（不提交）
+
+    最小/最大/最新值无法增量撤销，由定时校正任务重建
+    """
+    if record.created_at is None:
+        return
+    for granularity in GRANULARITIES:
+        values = {MetricRollup.count: MetricRollup.count - 1}
+        for prefix, column in ROLLUP_METRICS.items():
+            value = getattr(record, column)
+            if value is not None:
+                values[getattr(MetricRollup, f"{prefix}_count")] = getattr(MetricRollup, f"{prefix}_count") - 1
+                values[getattr(MetricRollup, f"{prefix}_sum")] = getattr(MetricRollup, f"{prefix}_sum") - value
+        db.query(MetricRollup).filter(
+            MetricRollup.granularity == granularity,
+            MetricRollup.bucket_start == floor_time(record.created_at, granularity),
+            MetricRollup.device_id == (record.device_id or "")
+        ).update(values, synchronize_session=False)
+
+
+def window_ranges(start: datetime, end: datetime, coarsest: str = "day") -> list[tuple]:
+    """
+    把时间窗口 [start, end] 拆成若干 (粒度, 起点, 终点) 区间（两端按分钟对齐，end 所在的分钟也包含在内），
+    两端不足一个大桶的部分用更细的粒度补齐，中间用尽量粗的粒度
+
+    coarsest 限制最大粒度（例如按小时出时间序列时不能使用天桶）
+    """
+    start = floor_time(start, "minute")
+    levels = GRANULARITIES[:GRANULARITIES.index(coarsest) + 1]
+
+    end = ceil_time(end, "minute")
+    if start >= end:
+        return []
+
+    # 从粗到细，找到能放进窗口的最粗粒度，区间左右两侧交给更细的粒度
+    for granularity in reversed(levels[1:]):
+        lo = ceil_time(start, granularity)
+        hi = floor_time(end, granularity)
+        if lo < hi:
+            finer = levels[levels.index(granularity) - 1]
+            return window_ranges(start, lo, finer) + [(granularity, lo, hi)] + window_ranges(hi, end, finer)
+    return [("minute", start, end)]
+
+
+def _ranges_filter(ranges: list[tuple]):
+    """区间列表转为查询条件，每个区间包含起点、不包含终点"""
+    return or_(*[
+        and_(
+            MetricRollup.granularity == granularity,
+            MetricRollup.bucket_start >= lo,
+            MetricRollup.bucket_start < hi
+        )
+        for granularity, lo, hi in ranges
+    ])
+
+
+def count_in_window(db: Session, start: datetime, end: datetime) -> int:
+    """窗口内的记录数"""
+    total = db.query(func.sum(MetricRollup.count)).filter(
+        _ranges_filter(window_ranges(start, end))
+    ).scalar()
+    return int(total or 0)
+
+
+def total_count(db: Session) -> int:
+    """全部记录数（天桶覆盖所有数据）"""
+    total = db.query(func.sum(MetricRollup.count)).filter(
+        MetricRollup.granularity == "day"
+    ).scalar()
+    return int(total or 0)
+
+
+def count_series(db: Session, start: datetime, end: datetime, interval: str) -> list[tuple]:
+    """
+    按 interval（hour/day）输出 (桶起点, 记录数) 时间序列
+
+    窗口起点所在的不完整时间桶由更细的粒度汇总得到
+    """
+    rows = db.query(
+        MetricRollup.granularity,
+        MetricRollup.bucket_start,
+        func.sum(MetricRollup.count).label("count")
+    ).filter(
+        _ranges_filter(window_ranges(start, end, coarsest=interval))
+    ).group_by(MetricRollup.granularity, MetricRollup.bucket_start).all()
+
+    series = {}
+    for row in rows:
+        label = floor_time(row.bucket_start, interval)
+        series[label] = series.get(label, 0) + int(row.count)
+    return sorted(series.items())
+
+
+def _rebuild_day(db: Session, day: datetime, boundary, columns) -> int:
+    """
+    重建一天内的分钟 / 小时 / 天桶，返回重放的记录数
+
+    先在事务外按小时读取原始数据累加到内存，再在同一个事务里删除旧桶、
+    补上累加期间新写入的记录并写入新桶，查询端始终看到完整的旧桶或新桶
+    """
+    next_day = day + timedelta(days=1)
+    buckets = {}
+    replayed = 0
+
+    if boundary is not None and day < boundary:
+        # 归档边界按天对齐，归档文件不会再变化
+        max_id = None
+        records = list(archive.scan(day, next_day, columns))
+        _accumulate(records, buckets)
+        replayed += len(records)
+    else:
+        max_id = db.query(func.max(CollectedData.id)).scalar() or 0
+        chunk_start = day
+        while chunk_start < next_day:
+            chunk_end = chunk_start + REBUILD_CHUNK
+            records = db.query(*[getattr(CollectedData, column) for column in columns]).filter(
+                CollectedData.id <= max_id,
+                CollectedData.created_at >= chunk_start,
+                CollectedData.created_at < chunk_end
+            ).order_by(CollectedData.created_at).all()
+            _accumulate(records, buckets)
+            replayed += len(records)
+            chunk_start = chunk_end
+        # 结束读事务，下面的删除拿到写锁后读取的是最新数据
+        db.commit()
+
+    db.query(MetricRollup).filter(
+        MetricRollup.bucket_start >= day,
+        MetricRollup.bucket_start < next_day
+    ).delete(synchronize_session=False)
+    if max_id is not None:
+        # 已持有写锁，累加期间写入的记录不会再有新增，一并计入
+        records = db.query(*[getattr(CollectedData, column) for column in columns]).filter(
+            CollectedData.id > max_id,
+            CollectedData.created_at >= day,
+            CollectedData.created_at < next_day
+        ).order_by(CollectedData.created_at).all()
+        _accumulate(records, buckets)
+        replayed += len(records)
+    _write_buckets(db, buckets)
+    db.commit()
+    return replayed
+
+
+def rebuild_rollups(start: datetime = None, end: datetime = None) -> int:
+    """
+    从原始数据重建 [start, end) 内的预聚合（边界按天对齐），用于修复和升级
+
+    按天逐个替换：每一天的旧桶在同一个事务里删除并写入新桶，
+    重建过程中查询不会看到缺失或只重放了一半的桶。
+    归档边界之前的部分从归档文件重放。
+    返回重放的记录数
+    """
+    start = floor_time(start, "day") if start else None
+    end = ceil_time(end, "day") if end else None
+
+    db = SessionLocal()
+    try:
+        if start is None:
+            archived_days = archive.archived_days()
+            first = archived_days[0] if archived_days else db.query(func.min(CollectedData.created_at)).scalar()
+            if first is None:
+                db.query(MetricRollup).delete(synchronize_session=False)
+                db.commit()
+                return 0
+            start = floor_time(first, "day")
+            # 第一条数据之前残留的桶没有对应的原始数据
+            db.query(MetricRollup).filter(
+                MetricRollup.bucket_start < start
+            ).delete(synchronize_session=False)
+            db.commit()
+        boundary = archive.archive_boundary()
+        columns = ("device_id", "created_at", *ROLLUP_METRICS.values())
+        if end is None:
+            end = floor_time(datetime.utcnow(), "day") + timedelta(days=1)
+
+        replayed = 0
+        day = start
+        while day < end:
+            replayed += _rebuild_day(db, day, boundary, columns)
+            day += timedelta(days=1)
+
+        logger.info(f"预聚合重建完成，重放 {replayed} 条记录")
+        return replayed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def trim_rollups(before: datetime):
+    """
+    清理早于 before 的预聚合，与原始数据的过期清理保持一致
+
+    完整的天桶直接删除，before 所在的那一天从剩余原始数据重建
+    """
+    boundary = floor_time(before, "day")
+    db = SessionLocal()
+    try:
+        db.query(MetricRollup).filter(
+            MetricRollup.bucket_start < boundary
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    rebuild_rollups(boundary, boundary + timedelta(days=1))
@@ -0,0 +1,28 @@
+"""
+管理接口
+需要在 `X-Admin-Token` 请求头中携带 ADMIN_TOKEN
+"""
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from typing import Optional
+from app import profiling
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """校验管理员令牌"""
+    if not profiling.check_admin_token(x_admin_token or ""):
+        raise HTTPException(status_code=403, detail="需要管理员令牌")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/slow-queries")
+async def get_slow_queries(limit: int = Query(50, ge=1, le=1000)):
+    """最近的慢查询，最新的在前"""
+    queries = list(profiling.slow_queries)[-limit:]
+    queries.reverse()
+    return {
+        "threshold_ms": profiling.SLOW_QUERY_MS,
+        "count": len(queries),
+        "queries": queries,
+    }
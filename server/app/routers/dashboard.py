@@ -7,30 +7,49 @@ from sqlalchemy.orm import Session
 from sqlalchemy import func, extract, and_
 from datetime import datetime, timedelta
 from typing import Optional
-from app.database import get_db, CollectedData
+from app.database import get_read_db, CollectedData, Device
+from app import devices, geo, sessions
+from app.executor import offload
+from app.aggregators import (
+    AGGREGATORS, BatteryAggregator, DevicesAggregator, NetworkAggregator, OverviewAggregator,
+    TimelineAggregator, scan_window,
+)
 
 router = APIRouter()
 
 
 @router.get("/latest")
-async def get_latest_data(
+@offload("dashboard", render=True)
+def get_latest_data(
     device_id: str = Query(None, description="设备ID（可选）"),
-    db: Session = Depends(get_db)
+    all_devices: bool = Query(False, alias="all", description="返回每个设备的最新数据"),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取最新的设备数据
     
-    - **device_id**: 设备ID（可选，不提供则返回所有设备的最新数据）
+    - **device_id**: 设备ID（可选，不提供则返回最近上报的设备的最新数据）
+    - **all**: 为 true 时返回所有设备的最新数据列表（按最近上报时间倒序）
+    
+    data 为该设备各部分（battery、location 等）最近一次上报的内容，直接读取设备登记表
     """
     try:
-        query = db.query(CollectedData)
+        if all_devices:
+            return {
+                "devices": [
+                    devices.device_state(device)
+                    for device in db.query(Device).order_by(Device.last_seen.desc())
+                ]
+            }
+        
+        query = db.query(Device)
         
         if device_id:
-            query = query.filter(CollectedData.device_id == device_id)
+            query = query.filter(Device.device_id == device_id)
         
-        latest_data = query.order_by(CollectedData.created_at.desc()).first()
+        device = query.order_by(Device.last_seen.desc()).first()
         
-        if not latest_data:
+        if not device:
             return {
                 "device_id": None,
                 "timestamp": None,
@@ -38,20 +57,16 @@ async def get_latest_data(
                 "data": None
             }
         
-        return {
-            "device_id": latest_data.device_id,
-            "timestamp": latest_data.timestamp,
-            "created_at": latest_data.created_at.isoformat() if latest_data.created_at else None,
-            "data": latest_data.data
-        }
+        return devices.device_state(device)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取最新数据失败: {str(e)}")
 
 
 @router.get("/overview")
-async def get_overview(
+@offload("dashboard", render=True)
+def get_overview(
     hours: int = Query(24, description="统计最近N小时的数据"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取数据概览统计
@@ -59,52 +74,20 @@ async def get_overview(
     - **hours**: 统计最近N小时的数据（默认24小时）
     """
     try:
-        # 计算时间范围
         end_time = datetime.utcnow()
         start_time = end_time - timedelta(hours=hours)
-        
-        # 总数据量
-        total_count = db.query(CollectedData).count()
-        
-        # 最近N小时的数据量
-        recent_count = db.query(CollectedData).filter(
-            CollectedData.created_at >= start_time
-        ).count()
-        
-        # 活跃设备数
-        active_devices = db.query(CollectedData.device_id).filter(
-            CollectedData.created_at >= start_time
-        ).distinct().count()
-        
-        # 总设备数
-        total_devices = db.query(CollectedData.device_id).distinct().count()
-        
-        # 最新数据时间
-        latest_data = db.query(CollectedData).order_by(
-            CollectedData.created_at.desc()
-        ).first()
-        latest_time = latest_data.created_at if latest_data else None
-        
-        return {
-            "total_count": total_count,
-            "recent_count": recent_count,
-            "active_devices": active_devices,
-            "total_devices": total_devices,
-            "latest_time": latest_time.isoformat() if latest_time else None,
-            "time_range": {
-                "start": start_time.isoformat(),
-                "end": end_time.isoformat()
-            }
-        }
+        # 记录数从预聚合表读取，设备数从设备登记表读取
+        return OverviewAggregator(start_time, end_time, {}).result(db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取概览数据失败: {str(e)}")
 
 
 @router.get("/timeline")
-async def get_timeline(
+@offload("dashboard", render=True)
+def get_timeline(
     hours: int = Query(24, description="统计最近N小时的数据"),
     interval: str = Query("hour", description="时间间隔：hour/day"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取时间序列数据
@@ -113,47 +96,19 @@ async def get_timeline(
     - **interval**: 时间间隔，hour 或 day
     """
     try:
-        # 计算时间范围
         end_time = datetime.utcnow()
         start_time = end_time - timedelta(hours=hours)
-        
-        # 根据间隔类型分组
-        if interval == "hour":
-            # 按小时分组
-            query = db.query(
-                func.strftime('%Y-%m-%d %H:00:00', CollectedData.created_at).label('time'),
-                func.count(CollectedData.id).label('count')
-            ).filter(
-                CollectedData.created_at >= start_time
-            ).group_by('time').order_by('time')
-        else:
-            # 按天分组
-            query = db.query(
-                func.date(CollectedData.created_at).label('time'),
-                func.count(CollectedData.id).label('count')
-            ).filter(
-                CollectedData.created_at >= start_time
-            ).group_by('time').order_by('time')
-        
-        results = query.all()
-        
-        return {
-            "timeline": [
-                {
-                    "time": str(result.time),
-                    "count": result.count
-                }
-                for result in results
-            ]
-        }
+        # 从预聚合表读取，按小时或按天汇总
+        return TimelineAggregator(start_time, end_time, {"interval": interval}).result(db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取时间序列数据失败: {str(e)}")
 
 
 @router.get("/devices")
-async def get_devices_stats(
+@offload("dashboard", render=True)
+def get_devices_stats(
     limit: int = Query(10, description="返回前N个设备"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备统计信息
@@ -161,242 +116,175 @@ async def get_devices_stats(
     - **limit**: 返回前N个设备（默认10）
     """
     try:
-        from sqlalchemy import desc
-        
-        # 按设备分组统计
-        device_stats = db.query(
-            CollectedData.device_id,
-            func.count(CollectedData.id).label('count'),
-            func.max(CollectedData.created_at).label('last_seen')
-        ).group_by(CollectedData.device_id).order_by(
-            desc('count')
-        ).limit(limit).all()
-        
-        return {
-            "devices": [
-                {
-                    "device_id": stat.device_id,
-                    "count": stat.count,
-                    "last_seen": stat.last_seen.isoformat() if stat.last_seen else None
-                }
-                for stat in device_stats
-            ]
-        }
+        # 直接读取设备登记表，不扫描原始数据
+        return DevicesAggregator(None, None, {"limit": limit}).result(db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取设备统计失败: {str(e)}")
 
 
 @router.get("/battery")
-async def get_battery_stats(
+@offload("dashboard", render=True)
+def get_battery_stats(
     hours: int = Query(24, description="统计最近N小时的数据"),
     interval: str = Query("hour", description="时间间隔：'hour' 或 'day'"),
-    db: Session = Depends(get_db)
+    max_points: int = Query(100, ge=3, le=5000, description="最多返回的数据点数"),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取电量时间序列数据
     
     - **hours**: 统计最近N小时的数据（默认24小时）
     - **interval**: 时间间隔：'hour' 或 'day'（默认 'hour'）
+    - **max_points**: 最多返回的数据点数（默认100），使用 LTTB 降采样保留峰谷
+    
+    统计值基于窗口内全部数据计算，不受降采样影响
     """
     try:
-        start_time = datetime.utcnow() - timedelta(hours=hours)
-        
-        # 查询最近的数据，按时间排序
-        recent_data = db.query(CollectedData).filter(
-            CollectedData.created_at >= start_time
-        ).order_by(CollectedData.created_at.asc()).all()
-        
-        # 收集电量数据点
-        battery_points = []
-        for record in recent_data:
-            if record.data and isinstance(record.data, dict):
-                battery = record.data.get('battery')
-                if battery and isinstance(battery, dict):
-                    level = battery.get('level')
-                    if level is not None:
-                        battery_points.append({
-                            "time": record.created_at.isoformat() if record.created_at else None,
-                            "timestamp": record.timestamp,
-                            "level": level,
-                            "isCharging": battery.get('isCharging', False)
-                        })
-        
-        # 如果数据点太多，进行采样（每N个点取一个）
-        max_points = 100
-        if len(battery_points) > max_points:
-            step = len(battery_points) // max_points
-            battery_points = battery_points[::step]
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
         
-        return {
-            "points": battery_points,
-            "count": len(battery_points),
-            "stats": {
-                "min": min([p["level"] for p in battery_points]) if battery_points else 0,
-                "max": max([p["level"] for p in battery_points]) if battery_points else 0,
-                "avg": round(sum([p["level"] for p in battery_points]) / len(battery_points), 2) if battery_points else 0
-            }
-        }
+        # 只查询提取好的电量列，按时间顺序流式读取
+        aggregator = BatteryAggregator(start_time, end_time, {"max_points": max_points})
+        scan_window(db, start_time, [aggregator], [CollectedData.battery_level.isnot(None)])
+        return aggregator.result(db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取电量统计失败: {str(e)}")
 
 
 @router.get("/location")
-async def get_location_stats(
+@offload("dashboard", render=True)
+def get_location_stats(
     hours: int = Query(24, description="统计最近N小时的数据"),
-    db: Session = Depends(get_db)
+    bbox: Optional[str] = Query(None, description="视口范围：西,南,东,北（默认全球）"),
+    zoom: Optional[int] = Query(None, ge=0, le=geo.cell_zoom_limit(), description="地图缩放级别（默认按视口宽度推算）"),
+    device_id: Optional[str] = Query(None, description="只统计该设备（默认全部设备）"),
+    trajectory: bool = Query(False, description="是否返回各设备的简化轨迹"),
+    max_points: int = Query(2000, ge=2, le=20000, description="每段轨迹最多返回的点数"),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取位置统计信息
     
     - **hours**: 统计最近N小时的数据（默认24小时）
+    - **bbox**: 视口范围，经纬度 `西,南,东,北`，西大于东表示跨越 180° 经线（默认全球）
+    - **zoom**: 地图缩放级别，位置按该级别每个瓦片 8×8 的网格聚合（默认视口宽度约 4 个瓦片）
+    - **device_id**: 只统计该设备
+    - **trajectory**: 同时返回各设备经过视口的轨迹，按缩放级别用 Douglas–Peucker 简化
+    - **max_points**: 每段轨迹最多返回的点数（默认2000）
+    
+    返回每个网格单元的点数、质心和范围，单元数只与视口大小有关，与窗口内的数据量无关
     """
+    try:
+        area = geo.parse_bbox(bbox) if bbox else geo.WORLD_BBOX
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"bbox 参数错误: {str(e)}")
+    if zoom is None:
+        zoom = geo.fit_zoom(area)
+    
     try:
         start_time = datetime.utcnow() - timedelta(hours=hours)
         
-        # 查询最近的数据
-        recent_data = db.query(CollectedData).filter(
-            CollectedData.created_at >= start_time
-        ).all()
-        
-        locations = []
-        for record in recent_data:
-            if record.data and isinstance(record.data, dict):
-                location = record.data.get('location')
-                if location and isinstance(location, dict):
-                    lat = location.get('latitude')
-                    lng = location.get('longitude')
-                    if lat is not None and lng is not None:
-                        locations.append({
-                            "latitude": lat,
-                            "longitude": lng,
-                            "timestamp": record.timestamp
-                        })
-        
-        return {
-            "count": len(locations),
-            "locations": locations[:1000]  # 限制返回数量，避免数据过大
-        }
+        result = geo.cluster(db, start_time, area, zoom, device_id)
+        if trajectory:
+            result["trajectories"] = geo.trajectories(db, start_time, area, zoom, max_points, device_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取位置统计失败: {str(e)}")
 
 
 @router.get("/network")
-async def get_network_stats(
+@offload("dashboard", render=True)
+def get_network_stats(
     hours: int = Query(24, description="统计最近N小时的数据"),
-    db: Session = Depends(get_db)
+    max_points: int = Query(100, ge=3, le=5000, description="最多返回的数据点数"),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取网络信号强度时间序列数据
     
     - **hours**: 统计最近N小时的数据（默认24小时）
+    - **max_points**: 最多返回的数据点数（默认100），使用 LTTB 降采样保留峰谷
+    
+    统计值基于窗口内全部数据计算，不受降采样影响
     """
     try:
-        start_time = datetime.utcnow() - timedelta(hours=hours)
-        
-        # 查询最近的数据，按时间排序
-        recent_data = db.query(CollectedData).filter(
-            CollectedData.created_at >= start_time
-        ).order_by(CollectedData.created_at.asc()).all()
-        
-        # 收集信号强度数据点
-        signal_points = []
-        for record in recent_data:
-            if record.data and isinstance(record.data, dict):
-                network_info = record.data.get('networkInfo')
-                if network_info and isinstance(network_info, dict):
-                    wifi_info = network_info.get('wifiInfo')
-                    if wifi_info and isinstance(wifi_info, dict):
-                        signal_strength = wifi_info.get('signalStrength')
-                        if signal_strength is not None:
-                            signal_points.append({
-                                "time": record.created_at.isoformat() if record.created_at else None,
-                                "timestamp": record.timestamp,
-                                "signalStrength": signal_strength,
-                                "ssid": wifi_info.get('ssid', 'N/A'),
-                                "networkType": network_info.get('networkType', 'N/A')
-                            })
-        
-        # 如果数据点太多，进行采样（每N个点取一个）
-        max_points = 100
-        if len(signal_points) > max_points:
-            step = len(signal_points) // max_points
-            signal_points = signal_points[::step]
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
         
-        return {
-            "points": signal_points,
-            "count": len(signal_points),
-            "stats": {
-                "min": min([p["signalStrength"] for p in signal_points]) if signal_points else 0,
-                "max": max([p["signalStrength"] for p in signal_points]) if signal_points else 0,
-                "avg": round(sum([p["signalStrength"] for p in signal_points]) / len(signal_points), 2) if signal_points else 0
-            }
-        }
+        # 只查询提取好的网络列，按时间顺序流式读取
+        aggregator = NetworkAggregator(start_time, end_time, {"max_points": max_points})
+        scan_window(db, start_time, [aggregator], [CollectedData.wifi_signal.isnot(None)])
+        return aggregator.result(db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取网络统计失败: {str(e)}")
 
 
 @router.get("/apps")
-async def get_apps_stats(
+@offload("dashboard", render=True)
+def get_apps_stats(
     hours: int = Query(24, description="统计最近N小时的数据"),
     limit: int = Query(10, description="返回前N个应用"),
-    db: Session = Depends(get_db)
+    device_id: Optional[str] = Query(None, description="只统计该设备（默认全部设备）"),
+    timeline: bool = Query(False, description="是否返回每个设备的会话时间线"),
+    max_sessions: int = Query(1000, ge=1, le=10000, description="时间线最多返回的会话数"),
+    db: Session = Depends(get_read_db)
 ):
     """
     获取应用使用统计
     
     - **hours**: 统计最近N小时的数据（默认24小时）
     - **limit**: 返回前N个应用（默认10）
+    - **device_id**: 只统计该设备
+    - **timeline**: 同时返回每个设备的会话时间线（开始/结束为数据时间戳，毫秒）
+    - **max_sessions**: 时间线最多返回的会话数（默认1000），超出时只返回最近的会话
+    
+    使用时长按应用会话计算（见 app/sessions.py），只计入会话落在窗口内的部分，不受采样间隔影响
     """
     try:
-        start_time = datetime.utcnow() - timedelta(hours=hours)
-        
-        # 查询最近的数据
-        recent_data = db.query(CollectedData).filter(
-            CollectedData.created_at >= start_time
-        ).all()
-        
-        app_usage = {}
-        
-        for record in recent_data:
-            if record.data and isinstance(record.data, dict):
-                foreground_app = record.data.get('foregroundApp')
-                if foreground_app and isinstance(foreground_app, dict):
-                    # 根据 ForegroundAppCollector 的实现，主要字段是 packageName
-                    # 尝试多种可能的字段名（按优先级）
-                    app_name = (
-                        foreground_app.get('packageName') or  # 主要字段
-                        foreground_app.get('package_name') or
-                        foreground_app.get('appName') or 
-                        foreground_app.get('name') or 
-                        foreground_app.get('app_name')
-                    )
-                    # 如果 packageName 是 'N/A'，跳过
-                    if app_name and app_name != 'N/A':
-                        app_usage[app_name] = app_usage.get(app_name, 0) + 1
-        
-        # 排序并取前N个
-        top_apps = sorted(
-            app_usage.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:limit]
-        
-        # 调试：如果没有数据，返回一些调试信息
-        if not top_apps and recent_data:
-            import logging
-            # 检查第一条数据的内容
-            sample_data = recent_data[0].data if recent_data else {}
-            logging.debug(f"应用数据为空，但存在 {len(recent_data)} 条记录。示例数据: {sample_data}")
-            # 检查是否有 foregroundApp 字段
-            if sample_data and isinstance(sample_data, dict):
-                logging.debug(f"foregroundApp 字段: {sample_data.get('foregroundApp')}")
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
         
-        return {
-            "apps": [
-                {"name": k, "count": v}
-                for k, v in top_apps
-            ]
-        }
+        result = sessions.app_usage(db, start_time, end_time, limit, device_id)
+        if timeline:
+            result["timeline"] = sessions.device_timelines(db, start_time, end_time, max_sessions, device_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取应用统计失败: {str(e)}")
 
+
+@router.get("/snapshot")
+@offload("dashboard", render=True)
+def get_snapshot(
+    hours: int = Query(24, description="统计最近N小时的数据"),
+    sections: Optional[str] = Query(None, description="需要的分区，逗号分隔（默认全部）"),
+    interval: str = Query("hour", description="时间序列间隔：hour/day"),
+    max_points: int = Query(100, ge=3, le=5000, description="电量/网络最多返回的数据点数"),
+    limit: int = Query(10, description="设备/应用返回前N个"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    一次返回数据大屏的多个分区
+    
+    - **hours**: 统计最近N小时的数据（默认24小时）
+    - **sections**: overview,timeline,devices,battery,network,location,apps 中的若干个，逗号分隔（默认全部）
+    - **interval** / **max_points** / **limit**: 与对应单独接口的参数含义相同
+    
+    窗口内的数据只扫描一次，逐行交给各分区的聚合器；
+    每个分区的结构与对应的单独接口一致
+    """
+    names = [name.strip() for name in sections.split(",") if name.strip()] if sections else list(AGGREGATORS)
+    unknown = [name for name in names if name not in AGGREGATORS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未知的分区: {', '.join(unknown)}")
+
+    try:
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
+        params = {"interval": interval, "max_points": max_points, "limit": limit}
+        
+        aggregators = [AGGREGATORS[name](start_time, end_time, params) for name in dict.fromkeys(names)]
+        scan_window(db, start_time, aggregators)
+        
+        return {aggregator.name: aggregator.result(db) for aggregator in aggregators}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取大屏快照失败: {str(e)}")
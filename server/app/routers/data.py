@@ -1,18 +1,63 @@
 """
 数据路由
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from pydantic import ValidationError
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
 from datetime import datetime
-from app.database import get_db, CollectedData
-from app.schemas import DataSubmission, SuccessResponse, DataResponse
+from typing import Optional
+import base64
+import json
+import os
+from app.database import get_db, get_read_db, CollectedData, Device
+from app import ingest
+from app.cache import response_cache
+from app.cluster import cluster_stats
+from app.executor import executor_stats, offload
+from app.responses import FastResponse
+from app.schemas import (
+    DataSubmission, SuccessResponse, DataResponse,
+    BatchItemResult, BatchSubmitResponse
+)
 
 router = APIRouter()
 
+# 查询接口返回的列（与 DataResponse 一致），直接按元组读取，不构造 ORM 对象、不解码 data 列
+DATA_RESPONSE_COLUMNS = (CollectedData.id, CollectedData.device_id, CollectedData.timestamp, CollectedData.created_at)
+DATA_RESPONSE_KEYS = tuple(column.key for column in DATA_RESPONSE_COLUMNS)
+
+# 单次批量提交允许的最大记录数
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+
+
+def _parse_batch_body(body: bytes, content_type: str) -> list:
+    """解析批量提交的请求体，支持 JSON 数组和 NDJSON（每行一个 JSON 对象）"""
+    text = body.decode("utf-8")
+
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                # 保留占位，让该行以失败结果返回，而不是拒绝整个批次
+                items.append(e)
+        return items
+
+    items = json.loads(text)
+    if not isinstance(items, list):
+        raise ValueError("请求体必须是 JSON 数组")
+    return items
+
 
 @router.post("/submit", response_model=SuccessResponse)
 async def submit_data(
     submission: DataSubmission,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
@@ -21,70 +66,198 @@ async def submit_data(
     - **device_id**: 设备ID（可选）
     - **timestamp**: 数据时间戳（毫秒）
     - **data**: 收集的数据内容
+    
+    异步写入模式（`INGEST_MODE=async`）下数据先进入写入队列，立即返回 202，
+    此时响应中不包含记录ID。
     """
+    if ingest.ingest_queue is not None:
+        if not ingest.ingest_queue.put(submission):
+            raise HTTPException(status_code=503, detail="写入队列已满，请稍后重试")
+        response.status_code = 202
+        return SuccessResponse(message="数据已接收，等待写入")
+    
     try:
-        # 创建数据记录
-        db_data = CollectedData(
-            device_id=submission.device_id,
-            timestamp=submission.timestamp,
-            data=submission.data,
-            created_at=datetime.utcnow()
-        )
-        
-        db.add(db_data)
-        db.commit()
-        db.refresh(db_data)
+        ids = await ingest.persist(db, [submission])
         
         return SuccessResponse(
             message="数据保存成功",
-            id=db_data.id
+            id=ids[0]
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"保存数据失败: {str(e)}")
+
+
+@router.post("/submit/batch", response_model=BatchSubmitResponse)
+async def submit_batch(
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    批量接收并存储数据（设备离线后补传积压数据）
+    
+    - 请求体为 `DataSubmission` 的 JSON 数组
+    - 或 `Content-Type: application/x-ndjson`，每行一个 `DataSubmission`
+    
+    每条记录单独校验，校验失败的记录不影响其它记录；
+    通过校验的记录在同一个事务内一次性写入。
+    """
+    try:
+        items = _parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"请求体格式错误: {str(e)}")
+    
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"单次最多提交 {BATCH_MAX_ITEMS} 条记录，当前 {len(items)} 条"
         )
+    
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        if isinstance(item, Exception):
+            results.append(BatchItemResult(index=index, success=False, error=f"JSON 解析失败: {item}"))
+            continue
+        try:
+            valid.append((index, DataSubmission.model_validate(item)))
+            results.append(None)
+        except ValidationError as e:
+            errors = "; ".join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}"
+                for err in e.errors()
+            )
+            results.append(BatchItemResult(index=index, success=False, error=errors))
+    
+    try:
+        ids = await ingest.persist(db, [submission for _, submission in valid])
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"保存数据失败: {str(e)}")
+    
+    for (index, _), record_id in zip(valid, ids):
+        results[index] = BatchItemResult(index=index, success=True, id=record_id)
+    
+    accepted = len(valid)
+    rejected = len(items) - accepted
+    return BatchSubmitResponse(
+        success=rejected == 0,
+        message="批量数据保存成功" if rejected == 0 else f"{rejected} 条记录校验失败",
+        accepted=accepted,
+        rejected=rejected,
+        results=results
+    )
+
+
+@router.get("/ingest/stats")
+async def get_ingest_stats():
+    """
+    获取写入队列状态（队列深度、写入耗时等）、数据库线程池的排队情况，
+    以及多进程模式下处理本次请求的工作进程的状态
+    """
+    if ingest.ingest_queue is None:
+        return {"mode": "sync", "executors": executor_stats(), "cluster": cluster_stats()}
+    return {"mode": "async", **ingest.ingest_queue.stats(), "executors": executor_stats(), "cluster": cluster_stats()}
+
+
+def encode_cursor(created_at: datetime, record_id: int) -> str:
+    """把 (created_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([created_at.isoformat(), record_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """解析分页游标，格式不正确时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(record_id)
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """
+    获取数据大屏响应缓存的命中统计
+    """
+    return response_cache.stats()
 
 
 @router.get("/data", response_model=list[DataResponse])
-async def get_data(
+@offload("dashboard")
+def get_data(
     device_id: str = None,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=1000),
     offset: int = 0,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="分页游标，取上一页响应头 X-Next-Cursor 的值"),
+    start_time: Optional[datetime] = Query(None, description="起始时间（UTC，包含）"),
+    end_time: Optional[datetime] = Query(None, description="结束时间（UTC，不包含）"),
+    db: Session = Depends(get_read_db)
 ):
     """
-    查询数据
+    查询数据（按创建时间倒序）
     
     - **device_id**: 设备ID（可选，用于筛选）
     - **limit**: 返回记录数限制（默认100）
-    - **offset**: 偏移量（默认0）
+    - **offset**: 偏移量（默认0，传入 cursor 时忽略）
+    - **cursor**: 分页游标（推荐），翻到任意一页的开销都与第一页相同，且不受新写入数据影响
+    - **start_time** / **end_time**: 按创建时间筛选（可选）
+    
+    如果还有下一页，响应头 `X-Next-Cursor` 中返回下一页的游标
     """
     try:
-        query = db.query(CollectedData)
+        query = db.query(*DATA_RESPONSE_COLUMNS)
         
         if device_id:
             query = query.filter(CollectedData.device_id == device_id)
+        if start_time:
+            query = query.filter(CollectedData.created_at >= start_time)
+        if end_time:
+            query = query.filter(CollectedData.created_at < end_time)
+        
+        query = query.order_by(CollectedData.created_at.desc(), CollectedData.id.desc())
+        
+        if cursor:
+            try:
+                cursor_created_at, cursor_id = decode_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            # 从游标位置继续向后查找，走 (created_at, id) 索引，不需要跳过 offset 行
+            query = query.filter(
+                tuple_(CollectedData.created_at, CollectedData.id) < tuple_(cursor_created_at, cursor_id)
+            )
+        else:
+            query = query.offset(offset)
+        
+        rows = query.limit(limit).all()
         
-        data_list = query.order_by(CollectedData.created_at.desc()).offset(offset).limit(limit).all()
+        headers = {}
+        if len(rows) == limit:
+            last = rows[-1]
+            headers["X-Next-Cursor"] = encode_cursor(last.created_at, last.id)
         
-        return data_list
+        # 直接序列化查询结果，跳过 response_model 的逐条校验
+        return FastResponse([dict(zip(DATA_RESPONSE_KEYS, row)) for row in rows], headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询数据失败: {str(e)}")
 
 
 @router.get("/data/{data_id}", response_model=DataResponse)
-async def get_data_by_id(
+@offload("dashboard")
+def get_data_by_id(
     data_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     根据ID查询单条数据
     """
-    data = db.query(CollectedData).filter(CollectedData.id == data_id).first()
+    data = db.query(*DATA_RESPONSE_COLUMNS).filter(CollectedData.id == data_id).first()
     
     if not data:
         raise HTTPException(status_code=404, detail="数据不存在")
     
-    return data
+    return dict(zip(DATA_RESPONSE_KEYS, data))
 
 
 @router.delete("/data/{data_id}")
@@ -95,39 +268,31 @@ async def delete_data(
     """
     删除指定ID的数据
     """
-    data = db.query(CollectedData).filter(CollectedData.id == data_id).first()
-    
-    if not data:
-        raise HTTPException(status_code=404, detail="数据不存在")
-    
     try:
-        db.delete(data)
-        db.commit()
-        return {"success": True, "message": "数据删除成功"}
+        deleted = await ingest.delete(db, data_id)
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"删除数据失败: {str(e)}")
+    
+    if not deleted:
+        raise HTTPException(status_code=404, detail="数据不存在")
+    
+    return {"success": True, "message": "数据删除成功"}
 
 
 @router.get("/stats")
-async def get_stats(db: Session = Depends(get_db)):
+@offload("dashboard")
+def get_stats(db: Session = Depends(get_read_db)):
     """
     获取数据统计信息
     """
     try:
-        total_count = db.query(CollectedData).count()
-        
-        # 按设备分组统计
-        from sqlalchemy import func
-        device_stats = db.query(
-            CollectedData.device_id,
-            func.count(CollectedData.id).label('count')
-        ).group_by(CollectedData.device_id).all()
+        # 直接读取设备登记表，每个设备一行
+        device_stats = db.query(Device.device_id, Device.sample_count).all()
         
         return {
-            "total_count": total_count,
+            "total_count": sum(stat.sample_count for stat in device_stats),
             "device_stats": [
-                {"device_id": stat.device_id, "count": stat.count}
+                {"device_id": stat.device_id or None, "count": stat.sample_count}
                 for stat in device_stats
             ]
         }
@@ -0,0 +1,235 @@
+"""
+数据导出路由
+以流式响应导出原始数据，供分析系统批量拉取
+"""
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from datetime import datetime
+from typing import Optional
+import csv
+import io
+import json
+import os
+import zlib
+from app.database import ReadSessionLocal, CollectedData
+from app import archive
+
+router = APIRouter()
+
+# 每次从数据库读取的记录数
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+EXPORT_COLUMNS = ["id", "device_id", "timestamp", "created_at", "data"]
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def _iter_chunks(device_id: Optional[str], start_time: Optional[datetime], end_time: Optional[datetime]):
+    """
+    分批读取数据，每批为一个记录列表；使用独立会话，响应结束时关闭
+
+    时间范围涉及已归档的日期时先输出归档数据，再输出数据库中的热数据
+    """
+    chunk = []
+    if archive.covers(start_time):
+        boundary = archive.archive_boundary()
+        archived = archive.scan(
+            start_time, min(end_time, boundary) if end_time else boundary, EXPORT_COLUMNS,
+            device_id=device_id if device_id else ...
+        )
+        for row in archived:
+            chunk.append(row)
+            if len(chunk) >= EXPORT_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        start_time = boundary
+
+    db = ReadSessionLocal()
+    try:
+        query = db.query(
+            CollectedData.id,
+            CollectedData.device_id,
+            CollectedData.timestamp,
+            CollectedData.created_at,
+            CollectedData.data
+        )
+        if device_id:
+            query = query.filter(CollectedData.device_id == device_id)
+        if start_time:
+            query = query.filter(CollectedData.created_at >= start_time)
+        if end_time:
+            query = query.filter(CollectedData.created_at < end_time)
+        query = query.order_by(CollectedData.created_at, CollectedData.id).execution_options(
+            stream_results=True
+        ).yield_per(EXPORT_CHUNK_SIZE)
+
+        for row in query:
+            chunk.append(row)
+            if len(chunk) >= EXPORT_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        db.close()
+
+
+def _encode_ndjson(chunks):
+    for chunk in chunks:
+        yield "".join(
+            json.dumps({
+                "id": row.id,
+                "device_id": row.device_id,
+                "timestamp": row.timestamp,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "data": row.data,
+            }, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for row in chunk
+        ).encode("utf-8")
+
+
+def _encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        for row in chunk:
+            writer.writerow([
+                row.id,
+                row.device_id,
+                row.timestamp,
+                row.created_at.isoformat() if row.created_at else "",
+                json.dumps(row.data, ensure_ascii=False, separators=(",", ":")),
+            ])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _StreamSink(io.RawIOBase):
+    """Parquet 写入目标：写入的字节暂存起来，由生成器逐段取走"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _encode_parquet(chunks, compression: str):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("device_id", pa.string()),
+        ("timestamp", pa.int64()),
+        ("created_at", pa.timestamp("us")),
+        ("data", pa.string()),
+    ])
+    sink = _StreamSink()
+    # 每批数据写成一个 row group，写完即把已生成的字节发出去
+    with pq.ParquetWriter(sink, schema, compression=compression) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pydict({
+                "id": [row.id for row in chunk],
+                "device_id": [row.device_id for row in chunk],
+                "timestamp": [row.timestamp for row in chunk],
+                "created_at": [row.created_at for row in chunk],
+                "data": [json.dumps(row.data, ensure_ascii=False, separators=(",", ":")) for row in chunk],
+            }, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def _compress(stream, compression: str):
+    """对输出流做整体压缩"""
+    if compression == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    else:
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    for data in stream:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@router.get("/export")
+async def export_data(
+    device_id: Optional[str] = Query(None, description="设备ID（可选）"),
+    start_time: Optional[datetime] = Query(None, description="起始时间（UTC，包含）"),
+    end_time: Optional[datetime] = Query(None, description="结束时间（UTC，不包含）"),
+    format: str = Query("ndjson", description="导出格式：ndjson/csv/parquet"),
+    compression: str = Query("none", description="压缩方式：none/gzip/zstd"),
+):
+    """
+    流式导出原始数据
+
+    - **device_id**: 设备ID（可选）
+    - **start_time** / **end_time**: 按记录创建时间筛选（可选）
+    - **format**: `ndjson`（默认）、`csv` 或 `parquet`
+    - **compression**: `none`（默认）、`gzip` 或 `zstd`；
+      parquet 格式下作为列压缩算法，其它格式对整个文件压缩
+
+    数据按创建时间顺序分批读取并边读边发送，导出任意数据量时内存占用保持不变
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的导出格式: {format}")
+    if compression not in ("none", "gzip", "zstd"):
+        raise HTTPException(status_code=400, detail=f"不支持的压缩方式: {compression}")
+
+    # 可选依赖在开始输出前检查，避免输出到一半才失败
+    try:
+        if format == "parquet":
+            import pyarrow  # noqa: F401
+        if compression == "zstd" and format != "parquet":
+            import zstandard  # noqa: F401
+    except ImportError as e:
+        raise HTTPException(status_code=400, detail=f"服务器未安装 {e.name}，无法使用该导出选项")
+
+    chunks = _iter_chunks(device_id, start_time, end_time)
+    media_type, extension = FORMATS[format]
+    filename = f"collected_data.{extension}"
+
+    if format == "parquet":
+        stream = _encode_parquet(chunks, "snappy" if compression == "none" else compression)
+    elif format == "csv":
+        stream = _encode_csv(chunks)
+    else:
+        stream = _encode_ndjson(chunks)
+
+    if format != "parquet" and compression != "none":
+        stream = _compress(stream, compression)
+        media_type = "application/gzip" if compression == "gzip" else "application/zstd"
+        filename += ".gz" if compression == "gzip" else ".zst"
+
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
@@ -0,0 +1,125 @@
+"""
+实时推送路由
+数据大屏通过 SSE 或 WebSocket 订阅新入库的数据，不再轮询
+"""
+from fastapi import APIRouter, Header, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import json
+from app.pubsub import broker, STREAM_KEEPALIVE_SECONDS
+
+router = APIRouter()
+
+
+def _parse_devices(device_id: Optional[str]):
+    """逗号分隔的设备ID，为空表示所有设备"""
+    if not device_id:
+        return None
+    return {item.strip() for item in device_id.split(",") if item.strip()} or None
+
+
+def _parse_event_id(value: Optional[str]):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无效的事件ID: {value}")
+
+
+def _sse(event: str, data, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+@router.get("/stream")
+async def stream_events(
+    device_id: Optional[str] = Query(None, description="只订阅这些设备，逗号分隔（可选）"),
+    last_event_id: Optional[str] = Query(None, description="从该事件之后继续（可选）"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    以 Server-Sent Events 推送新入库的数据
+
+    - **device_id**: 只订阅这些设备，逗号分隔（可选，默认所有设备）
+    - **last_event_id**: 断线续传，也可以使用 `Last-Event-ID` 请求头（浏览器 EventSource 自动携带）
+
+    每条数据为一个 `data` 事件，事件ID为记录ID，内容为本次上报的部分（按部分合并即为设备最新状态）。
+    续传位置已不在服务器缓冲区中时先发送 `reset` 事件，客户端应重新拉取 REST 接口；
+    消费过慢的连接会收到 `dropped` 事件后被断开
+    """
+    device_ids = _parse_devices(device_id)
+    resume_from = _parse_event_id(last_event_id if last_event_id is not None else last_event_id_header)
+
+    subscription = broker.subscribe(device_ids, resume_from)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            if subscription.reset:
+                yield _sse("reset", {"last_event_id": resume_from})
+            while True:
+                event = await subscription.get(STREAM_KEEPALIVE_SECONDS)
+                if event is ...:
+                    yield ": keepalive\n\n"
+                elif event is None:
+                    if subscription.dropped:
+                        yield _sse("dropped", {"reason": "客户端消费过慢"})
+                    break
+                else:
+                    yield _sse("data", event, event["id"])
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/stream/ws")
+async def stream_websocket(
+    websocket: WebSocket,
+    device_id: Optional[str] = Query(None),
+    last_event_id: Optional[int] = Query(None),
+):
+    """
+    以 WebSocket 推送新入库的数据，参数与 /stream 相同
+
+    每条消息为 JSON：`{"event": "data" | "reset" | "dropped", "id": ..., "data": ...}`
+    """
+    await websocket.accept()
+    subscription = broker.subscribe(_parse_devices(device_id), last_event_id)
+    try:
+        if subscription.reset:
+            await websocket.send_json({"event": "reset", "data": {"last_event_id": last_event_id}})
+        while True:
+            event = await subscription.get(STREAM_KEEPALIVE_SECONDS)
+            if event is ...:
+                await websocket.send_json({"event": "keepalive"})
+            elif event is None:
+                if subscription.dropped:
+                    await websocket.send_json({"event": "dropped", "data": {"reason": "客户端消费过慢"}})
+                    await websocket.close(code=1013)
+                else:
+                    await websocket.close(code=1001)
+                break
+            else:
+                await websocket.send_json({"event": "data", "id": event["id"], "data": event})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@router.get("/stream/stats")
+async def get_stream_stats():
+    """
+    获取实时推送状态（订阅连接数、已发布/断开的数量）
+    """
+    return broker.stats()
@@ -1,11 +1,19 @@
 """
 定时任务调度器
-用于定期清理过期数据
+用于定期清理过期数据、校正预聚合数据、归档冷数据
 """
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from app.database import cleanup_expired_data
+from datetime import datetime, timedelta
+from app.database import cleanup_expired_data, DATA_EXPIRY_DAYS
+from app.archive import archive_old_data, drop_expired
+from app.sections import prune_sections
+from app.devices import refresh_devices
+from app.rollups import rebuild_rollups, trim_rollups
+from app.sessions import trim_sessions
+from app.telemetry import CLEANUP_DELETED, job_timer
 import logging
+import os
 
 # 配置日志
 logging.basicConfig(
@@ -16,16 +24,48 @@ logger = logging.getLogger(__name__)
 
 scheduler = None
 
+# 预聚合校正任务每次重建最近N天的数据
+ROLLUP_REPAIR_DAYS = int(os.getenv("ROLLUP_REPAIR_DAYS", "2"))
+
 
 def cleanup_job():
     """清理过期数据的任务"""
     try:
-        deleted_count = cleanup_expired_data()
+        with job_timer("cleanup"):
+            deleted_count = cleanup_expired_data()
+            CLEANUP_DELETED.inc(("collected_data",), deleted_count)
+            expiry_date = datetime.utcnow() - timedelta(days=DATA_EXPIRY_DAYS)
+            CLEANUP_DELETED.inc(("archive_partitions",), drop_expired(expiry_date))
+            trim_rollups(expiry_date)
+            CLEANUP_DELETED.inc(("app_sessions",), trim_sessions(expiry_date))
+            CLEANUP_DELETED.inc(("payload_sections",), prune_sections(expiry_date))
+            CLEANUP_DELETED.inc(("devices",), refresh_devices())
         logger.info(f"定时清理任务完成，删除了 {deleted_count} 条过期数据")
     except Exception as e:
         logger.error(f"定时清理任务出错: {e}")
 
 
+def rollup_repair_job():
+    """从原始数据重建最近几天的预聚合，修正可能的偏差"""
+    try:
+        with job_timer("rollup_repair"):
+            replayed = rebuild_rollups(datetime.utcnow() - timedelta(days=ROLLUP_REPAIR_DAYS))
+        logger.info(f"预聚合校正任务完成，重放了 {replayed} 条数据")
+    except Exception as e:
+        logger.error(f"预聚合校正任务出错: {e}")
+
+
+def archive_job():
+    """把超过 ARCHIVE_AFTER_DAYS 天的数据移入归档文件"""
+    try:
+        with job_timer("archive"):
+            archived = archive_old_data()
+        if archived:
+            logger.info(f"冷数据归档任务完成，归档了 {archived} 条数据")
+    except Exception as e:
+        logger.error(f"冷数据归档任务出错: {e}")
+
+
 def start_scheduler():
     """启动调度器"""
     global scheduler
@@ -45,6 +85,22 @@ def start_scheduler():
         replace_existing=True
     )
     
+    scheduler.add_job(
+        rollup_repair_job,
+        trigger=IntervalTrigger(hours=24),
+        id='repair_rollups',
+        name='校正预聚合数据',
+        replace_existing=True
+    )
+    
+    scheduler.add_job(
+        archive_job,
+        trigger=IntervalTrigger(hours=24),
+        id='archive_old_data',
+        name='归档冷数据',
+        replace_existing=True
+    )
+    
     scheduler.start()
     logger.info("调度器已启动，将每天执行一次过期数据清理")
 
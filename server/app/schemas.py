@@ -2,7 +2,7 @@
 Pydantic 数据模型
 """
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 
@@ -43,3 +43,19 @@ class SuccessResponse(BaseModel):
     message: str = "数据保存成功"
     id: Optional[int] = None
 
+
+class BatchItemResult(BaseModel):
+    """批量提交中单条记录的处理结果"""
+    index: int = Field(..., description="记录在批次中的位置（从0开始）")
+    success: bool
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BatchSubmitResponse(BaseModel):
+    """批量提交响应模型"""
+    success: bool = True
+    message: str = "批量数据保存成功"
+    accepted: int = 0
+    rejected: int = 0
+    results: List[BatchItemResult] = []
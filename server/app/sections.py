@@ -0,0 +1,190 @@
+"""
+原始数据静态部分去重
+同一设备每次上报的 deviceInfo、systemInfo、screenInfo、appInfo、storageInfo 等部分除时间戳外几乎不变。
+入库时把这些部分（去掉时间戳后）按内容哈希保存到 payload_sections 表，每份内容只保存一次，
+记录中对应的部分替换为引用 `{"$section": 哈希, "timestamp": ...}`；
+读取时（app/codec.py 的 PayloadJSON 列）自动还原为完整数据，时间戳排在该部分的最后。
+
+每次入库时刷新所引用内容的 last_seen（同一内容每 SECTION_TOUCH_SECONDS 秒最多一次），
+引用某份内容的记录创建时间不会晚于 last_seen + SECTION_TOUCH_SECONDS，
+过期数据清理后按此删除不再被引用的内容。
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 去重的部分，逗号分隔，为空表示不去重。
+# PAYLOAD_CODEC=zstd 且训练了字典时，静态内容本来就几乎被字典压缩掉，32 位十六进制的引用反而更大，默认不去重
+PAYLOAD_DEDUP_SECTIONS = tuple(
+    name.strip() for name in os.getenv(
+        "PAYLOAD_DEDUP_SECTIONS",
+        "" if os.getenv("PAYLOAD_CODEC", "json").lower() == "zstd"
+        else "deviceInfo,systemInfo,screenInfo,appInfo,storageInfo"
+    ).split(",") if name.strip()
+)
+# 进程内缓存的内容条数
+SECTION_CACHE_SIZE = int(os.getenv("SECTION_CACHE_SIZE", "10000"))
+# 同一内容刷新 last_seen 的最小间隔（秒）
+SECTION_TOUCH_SECONDS = int(os.getenv("SECTION_TOUCH_SECONDS", "3600"))
+
+# 引用标记
+SECTION_MARKER = "$section"
+# 每次上报都会变化、保留在记录中的字段
+VOLATILE_KEYS = ("timestamp",)
+# 内容太短时引用并不更省空间
+SECTION_MIN_BYTES = 64
+
+
+class _SectionCache:
+    """哈希 -> [内容, 最近一次刷新 last_seen 的时间]，LRU 淘汰"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: str):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+            return entry
+
+    def put(self, digest: str, content: dict, touched_at):
+        with self._lock:
+            self._entries[digest] = [content, touched_at]
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = _SectionCache(SECTION_CACHE_SIZE)
+
+
+def section_hash(canonical: str) -> str:
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def compact(db, payloads: list) -> tuple[list, dict]:
+    """
+    把一批数据中的静态部分替换为引用，并在当前事务内写入（或刷新）被引用的内容
+
+    返回 (替换后的数据列表, 本次写入的内容)；事务提交后需要调用 remember() 记入缓存。
+    未提交前不把新内容放进缓存，回滚时不会留下指向不存在内容的引用
+    """
+    from app.database import PayloadSection, upsert
+
+    if not PAYLOAD_DEDUP_SECTIONS:
+        return payloads, {}
+
+    now = datetime.utcnow()
+    fresh_after = now - timedelta(seconds=SECTION_TOUCH_SECONDS)
+    compacted = []
+    upserts = {}
+    for data in payloads:
+        if not isinstance(data, dict):
+            compacted.append(data)
+            continue
+        result = data
+        for name in PAYLOAD_DEDUP_SECTIONS:
+            section = data.get(name)
+            if not isinstance(section, dict) or SECTION_MARKER in section:
+                continue
+            shared = {key: value for key, value in section.items() if key not in VOLATILE_KEYS}
+            canonical = json.dumps(shared, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+            if len(canonical) < SECTION_MIN_BYTES:
+                continue
+            digest = section_hash(canonical)
+
+            cached = _cache.get(digest)
+            if (cached is None or cached[1] < fresh_after) and digest not in upserts:
+                upserts[digest] = {
+                    "hash": digest, "name": name, "data": shared, "first_seen": now, "last_seen": now
+                }
+
+            reference = {SECTION_MARKER: digest}
+            reference.update({key: section[key] for key in VOLATILE_KEYS if key in section})
+            if result is data:
+                result = dict(data)
+            result[name] = reference
+        compacted.append(result)
+
+    if upserts:
+        statement = upsert(PayloadSection)
+        db.execute(
+            statement.on_conflict_do_update(
+                index_elements=["hash"], set_={"last_seen": statement.excluded.last_seen}
+            ),
+            list(upserts.values())
+        )
+    return compacted, upserts
+
+
+def remember(upserts: dict):
+    """事务提交后把写入的内容记入缓存"""
+    for digest, row in upserts.items():
+        _cache.put(digest, row["data"], row["last_seen"])
+
+
+def _load(digest: str):
+    """缓存中没有时从数据库读取内容（例如重启后或其它进程写入的内容）"""
+    from app.database import ReadSessionLocal, PayloadSection
+
+    db = ReadSessionLocal()
+    try:
+        row = db.query(PayloadSection.data, PayloadSection.last_seen).filter(PayloadSection.hash == digest).first()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    _cache.put(digest, row.data, row.last_seen)
+    return row.data
+
+
+def expand(data):
+    """把数据中的引用还原为完整内容；找不到内容的引用保持原样"""
+    if not isinstance(data, dict):
+        return data
+    result = data
+    for name, value in data.items():
+        if not isinstance(value, dict) or SECTION_MARKER not in value:
+            continue
+        cached = _cache.get(value[SECTION_MARKER])
+        shared = cached[0] if cached is not None else _load(value[SECTION_MARKER])
+        if shared is None:
+            logger.warning(f"找不到去重内容 {value[SECTION_MARKER]}")
+            continue
+        # 浅拷贝：内容中的嵌套对象在引用同一内容的记录之间共享，不应修改
+        section = dict(shared)
+        section.update((key, item) for key, item in value.items() if key != SECTION_MARKER)
+        if result is data:
+            result = dict(data)
+        result[name] = section
+    return result
+
+
+def prune_sections(before: datetime) -> int:
+    """
+    创建时间早于 before 的记录已删除后，删除不再被引用的内容，返回删除的条数
+
+    缓存中可能还留着被删除的内容，它们的刷新时间早于 cutoff，下次入库时会重新写入
+    """
+    from app.database import SessionLocal, PayloadSection
+
+    cutoff = before - timedelta(seconds=SECTION_TOUCH_SECONDS)
+    db = SessionLocal()
+    try:
+        deleted = db.query(PayloadSection).filter(PayloadSection.last_seen < cutoff).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,408 @@
+"""
+前台应用会话
+入库时按设备把前台应用的采样（按数据时间戳排序）合并成会话：同一应用的相邻采样间隔不超过
+SESSION_GAP_SECONDS 时属于同一个会话，每条采样一直持续到下一条采样（间隔过长时视为中断）。
+迟到的、乱序的数据只重算时间戳附近的几个会话；应用使用时长和设备时间线直接读取 app_sessions 表
+"""
+from sqlalchemy import and_, func, insert, or_
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+from app.database import SessionLocal, CollectedData, AppSession, greatest, least
+from app.devices import device_key
+from app import archive
+import bisect
+import heapq
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# 相邻两条采样的最大间隔（秒），超过时视为中断；应大于客户端的上报间隔（默认 5 分钟）
+SESSION_GAP_SECONDS = int(os.getenv("SESSION_GAP_SECONDS", "600"))
+SESSION_GAP_MS = SESSION_GAP_SECONDS * 1000
+
+# 重建时每次读取的记录数
+REBUILD_BATCH_SIZE = 5000
+
+_SAMPLE_COLUMNS = ("id", "device_id", "timestamp", "foreground_app")
+
+
+def to_millis(value: datetime) -> int:
+    """UTC 时间转为毫秒时间戳，与数据时间戳比较"""
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class _Run:
+    """
+    重算过程中的一段连续采样
+
+    count 为已入库的记录数，added 为本次新写入、并入这一段的记录时间戳；
+    拆分时从原始数据读回已入库的记录，再补上 added
+    """
+    __slots__ = ("app", "start", "last", "count", "added")
+
+    def __init__(self, app: str, start: int, last: int, count: int, added: list = None):
+        self.app = app
+        self.start = start
+        self.last = last
+        self.count = count
+        self.added = added if added is not None else []
+
+    @classmethod
+    def from_session(cls, session: AppSession) -> "_Run":
+        return cls(session.app, session.start_ts, session.last_ts, session.sample_count)
+
+    @classmethod
+    def sample(cls, app: str, timestamp: int, stored: bool = True) -> "_Run":
+        if stored:
+            return cls(app, timestamp, timestamp, 1)
+        return cls(app, timestamp, timestamp, 0, [timestamp])
+
+
+def _same_device(key: str):
+    if key:
+        return CollectedData.device_id == key
+    return or_(CollectedData.device_id.is_(None), CollectedData.device_id == "")
+
+
+def _end(run: _Run, next_start) -> int:
+    """会话持续到下一个会话的起点，没有下一个会话或间隔过长时到最后一条采样"""
+    if next_start is not None and next_start - run.last <= SESSION_GAP_MS:
+        return next_start
+    return run.last
+
+
+def _build_sessions(key: str, runs, next_start: int = None):
+    """
+    把按起点排序的若干段合并成会话行
+
+    同一应用且间隔不超过 SESSION_GAP_MS 的相邻段合并；next_start 为重算范围之后下一个会话的起点，
+    决定最后一段的结束时间（结束时间总是重新计算，删除记录后不会沿用原来的值）
+    """
+    current = None
+    for run in runs:
+        if current is None:
+            current = run
+            continue
+        gap = run.start - current.last
+        if run.app == current.app and gap <= SESSION_GAP_MS:
+            current.last = max(current.last, run.last)
+            current.count += run.count
+            current.added.extend(run.added)
+            continue
+        yield _session_row(key, current, _end(current, run.start))
+        current = run
+    if current is not None:
+        yield _session_row(key, current, _end(current, next_start))
+
+
+def _session_row(key: str, run: _Run, end: int) -> dict:
+    return {
+        "device_id": key,
+        "app": run.app,
+        "start_ts": run.start,
+        "last_ts": run.last,
+        "end_ts": end,
+        "sample_count": run.count + len(run.added),
+    }
+
+
+def _load(db: Session, key: str, lo: int, hi: int) -> tuple[list[AppSession], int]:
+    """
+    读取 [lo, hi] 附近可能受影响的会话（按起点排序）和之后下一个会话的起点
+
+    包括 lo - SESSION_GAP_MS 之前的最后一个会话，重算后它与相邻会话的合并同样正确；
+    hi + SESSION_GAP_MS 之后的第一个会话不会与新数据合并，只用它的起点计算前一个会话的结束时间。
+    只使用 (device_id, start_ts) 索引
+    """
+    lower = db.query(func.max(AppSession.start_ts)).filter(
+        AppSession.device_id == key,
+        AppSession.start_ts <= lo - SESSION_GAP_MS
+    ).scalar()
+    query = db.query(AppSession).filter(
+        AppSession.device_id == key,
+        AppSession.start_ts <= hi + SESSION_GAP_MS
+    )
+    if lower is not None:
+        query = query.filter(AppSession.start_ts >= lower)
+    sessions = query.order_by(AppSession.start_ts).all()
+    next_start = db.query(func.min(AppSession.start_ts)).filter(
+        AppSession.device_id == key,
+        AppSession.start_ts > hi + SESSION_GAP_MS
+    ).scalar()
+    return sessions, next_start
+
+
+def _expand(db: Session, key: str, run: _Run, exclude_ids: set) -> list[_Run]:
+    """
+    把一段拆回单条采样（乱序数据落在会话中间、或删除会话中的记录时）
+
+    从原始数据读取已入库的记录（使用 idx_device_timestamp 索引），数量不足时说明一部分已经归档，
+    再从该设备的归档中补齐
+    """
+    query = db.query(CollectedData.id, CollectedData.timestamp, CollectedData.foreground_app).filter(
+        _same_device(key),
+        CollectedData.timestamp >= run.start,
+        CollectedData.timestamp <= run.last,
+        CollectedData.foreground_app.isnot(None)
+    )
+    samples = {row.id: (row.timestamp, row.foreground_app) for row in query if row.id not in exclude_ids}
+    boundary = archive.archive_boundary()
+    if len(samples) < run.count and boundary is not None:
+        for row in archive.scan(None, boundary, _SAMPLE_COLUMNS, device_id=key or None):
+            if (
+                row.id not in exclude_ids
+                and row.foreground_app is not None
+                and row.timestamp is not None
+                and run.start <= row.timestamp <= run.last
+            ):
+                samples[row.id] = (row.timestamp, row.foreground_app)
+
+    runs = [_Run.sample(app, timestamp) for timestamp, app in samples.values()]
+    runs.extend(_Run.sample(run.app, timestamp, stored=False) for timestamp in run.added)
+    runs.sort(key=lambda item: item.start)
+    return runs
+
+
+def _find(runs: list[_Run], timestamp: int) -> int:
+    """起点不晚于 timestamp 的最后一段的位置，没有时为 -1"""
+    return bisect.bisect_right(runs, timestamp, key=lambda run: run.start) - 1
+
+
+def _add_sample(db: Session, key: str, runs: list[_Run], timestamp: int, app: str, exclude_ids: set):
+    """把一条新采样放进按起点排序的段列表"""
+    index = _find(runs, timestamp)
+    if index >= 0 and timestamp <= runs[index].last:
+        run = runs[index]
+        if run.app == app:
+            run.added.append(timestamp)
+            return
+        # 落在另一个应用的会话中间，把会话拆开
+        runs[index:index + 1] = _expand(db, key, run, exclude_ids)
+        index = _find(runs, timestamp)
+
+    if index >= 0:
+        previous = runs[index]
+        following = runs[index + 1] if index + 1 < len(runs) else None
+        if (
+            previous.app == app
+            and timestamp - previous.last <= SESSION_GAP_MS
+            and (following is None or following.start > timestamp)
+        ):
+            # 最常见的情况：按顺序到达的同一应用的采样，直接延长
+            previous.last = timestamp
+            previous.added.append(timestamp)
+            return
+    runs.insert(index + 1, _Run.sample(app, timestamp, stored=False))
+
+
+def _replace(db: Session, sessions: list[AppSession], rows: list[dict]):
+    """用重算结果替换原来的会话，结果没有变化时不写入"""
+    before = [
+        (s.app, s.start_ts, s.last_ts, s.end_ts, s.sample_count) for s in sessions
+    ]
+    after = [
+        (row["app"], row["start_ts"], row["last_ts"], row["end_ts"], row["sample_count"]) for row in rows
+    ]
+    if before == after:
+        return
+    if sessions:
+        db.query(AppSession).filter(
+            AppSession.id.in_([session.id for session in sessions])
+        ).delete(synchronize_session=False)
+    if rows:
+        db.execute(insert(AppSession), rows)
+
+
+def update_sessions(db: Session, records):
+    """
+    把新写入的记录合并进应用会话（不提交，由调用方和记录写入放在同一事务内）
+
+    调用前应已写入记录（拆分会话时需要排除这批记录，按 ID 区分）；
+    每个设备只读取和改写新数据时间戳附近的会话
+    """
+    samples = {}
+    for record in records:
+        if record.foreground_app is None or record.timestamp is None:
+            continue
+        samples.setdefault(device_key(record.device_id), []).append(
+            (record.timestamp, record.foreground_app, record.id)
+        )
+
+    for key, items in samples.items():
+        items.sort()
+        exclude_ids = {record_id for _, _, record_id in items}
+        sessions, next_start = _load(db, key, items[0][0], items[-1][0])
+        runs = [_Run.from_session(session) for session in sessions]
+        for timestamp, app, _ in items:
+            _add_sample(db, key, runs, timestamp, app, exclude_ids)
+        _replace(db, sessions, list(_build_sessions(key, runs, next_start)))
+
+
+def remove_from_sessions(db: Session, record: CollectedData):
+    """删除单条记录时把它从所在的会话中去掉，前后的会话按需要合并或拆分（不提交）"""
+    if record.foreground_app is None or record.timestamp is None:
+        return
+    key = device_key(record.device_id)
+    sessions, next_start = _load(db, key, record.timestamp, record.timestamp)
+    runs = [_Run.from_session(session) for session in sessions]
+    index = _find(runs, record.timestamp)
+    if index < 0 or record.timestamp > runs[index].last:
+        return
+    runs[index:index + 1] = _expand(db, key, runs[index], {record.id})
+    _replace(db, sessions, list(_build_sessions(key, runs, next_start)))
+
+
+def trim_sessions(before: datetime) -> int:
+    """清理在 before 之前结束的会话，与原始数据的过期清理保持一致；返回删除的会话数"""
+    db = SessionLocal()
+    try:
+        deleted = db.query(AppSession).filter(
+            AppSession.end_ts < to_millis(before)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _device_samples(db: Session, key: str, boundary):
+    """按数据时间戳升序读取一个设备的全部前台应用采样（归档和数据库中的数据）"""
+    archived = []
+    if boundary is not None:
+        archived = sorted(
+            (row.timestamp, row.foreground_app)
+            for row in archive.scan(None, boundary, _SAMPLE_COLUMNS, device_id=key or None)
+            if row.foreground_app is not None and row.timestamp is not None
+        )
+    query = db.query(CollectedData.timestamp, CollectedData.foreground_app).filter(
+        _same_device(key),
+        CollectedData.timestamp.isnot(None),
+        CollectedData.foreground_app.isnot(None)
+    )
+    if boundary is not None:
+        query = query.filter(CollectedData.created_at >= boundary)
+    rows = query.order_by(CollectedData.timestamp).yield_per(REBUILD_BATCH_SIZE)
+    return heapq.merge(archived, ((row.timestamp, row.foreground_app) for row in rows))
+
+
+def rebuild_sessions() -> int:
+    """
+    从原始数据重建应用会话，用于升级、修改 SESSION_GAP_SECONDS 后和修复
+
+    整个重建在一个事务内完成，期间写入会等待；逐个设备按数据时间戳重放归档和数据库中的数据。
+    返回生成的会话数
+    """
+    db = SessionLocal()
+    try:
+        db.query(AppSession).delete(synchronize_session=False)
+
+        boundary = archive.archive_boundary()
+        keys = {device_key(row.device_id) for row in db.query(CollectedData.device_id).distinct()}
+        if boundary is not None:
+            keys.update(archive.device_stats())
+
+        total = 0
+        for key in sorted(keys):
+            runs = (_Run.sample(app, timestamp) for timestamp, app in _device_samples(db, key, boundary))
+            batch = []
+            for row in _build_sessions(key, runs):
+                batch.append(row)
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    db.execute(insert(AppSession), batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                db.execute(insert(AppSession), batch)
+                total += len(batch)
+        db.commit()
+        logger.info(f"应用会话重建完成，共 {len(keys)} 个设备、{total} 个会话")
+        return total
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _window_filter(start_ms: int, end_ms: int, device_id: str = None):
+    """与窗口有重叠的会话（使用 idx_app_sessions_end 索引，最近的窗口只读取少量会话）"""
+    conditions = [AppSession.end_ts >= start_ms, AppSession.start_ts <= end_ms]
+    if device_id is not None:
+        conditions.append(AppSession.device_id == device_id)
+    return and_(*conditions)
+
+
+def app_usage(db: Session, start_time: datetime, end_time: datetime, limit: int, device_id: str = None) -> dict:
+    """
+    窗口内各应用的使用时长（会话与窗口重叠的部分），按时长降序取前 limit 个
+
+    device_id 为空时统计所有设备
+    """
+    start_ms, end_ms = to_millis(start_time), to_millis(end_time)
+    overlap = greatest(least(AppSession.end_ts, end_ms) - greatest(AppSession.start_ts, start_ms), 0)
+    duration = func.sum(overlap).label("duration")
+    rows = db.query(
+        AppSession.app,
+        duration,
+        func.count(AppSession.id).label("sessions"),
+        func.count(func.distinct(AppSession.device_id)).label("devices")
+    ).filter(
+        _window_filter(start_ms, end_ms, device_id)
+    ).group_by(AppSession.app).all()
+
+    total = sum(row.duration or 0 for row in rows)
+    top_apps = sorted(rows, key=lambda row: (row.duration or 0, row.sessions), reverse=True)[:limit]
+    return {
+        "total_seconds": round(total / 1000, 1),
+        "apps": [
+            {
+                "name": row.app,
+                "duration_seconds": round((row.duration or 0) / 1000, 1),
+                "share": round((row.duration or 0) / total, 4) if total else 0.0,
+                "sessions": row.sessions,
+                "devices": row.devices,
+            }
+            for row in top_apps
+        ],
+    }
+
+
+def device_timelines(db: Session, start_time: datetime, end_time: datetime, max_sessions: int,
+                     device_id: str = None) -> dict:
+    """
+    窗口内每个设备的会话时间线（按开始时间排序），会话的起止时间不按窗口截断
+
+    超过 max_sessions 个会话时只返回最近的部分，truncated 为 true
+    """
+    start_ms, end_ms = to_millis(start_time), to_millis(end_time)
+    sessions = db.query(AppSession).filter(
+        _window_filter(start_ms, end_ms, device_id)
+    ).order_by(AppSession.end_ts.desc()).limit(max_sessions + 1).all()
+    truncated = len(sessions) > max_sessions
+
+    timelines = {}
+    for session in sessions[:max_sessions]:
+        timelines.setdefault(session.device_id, []).append(session)
+    return {
+        "truncated": truncated,
+        "devices": [
+            {
+                "device_id": key or None,
+                "sessions": [
+                    {
+                        "app": session.app,
+                        "start": session.start_ts,
+                        "end": session.end_ts,
+                        "duration_seconds": round((session.end_ts - session.start_ts) / 1000, 1),
+                        "samples": session.sample_count,
+                    }
+                    for session in sorted(items, key=lambda item: item.start_ts)
+                ],
+            }
+            for key, items in sorted(timelines.items())
+        ],
+    }
@@ -0,0 +1,273 @@
+"""
+前端静态文件
+启动时把前端目录读入内存清单：每个文件的内容哈希（强 ETag）、预先压缩好的 gzip / brotli 版本、响应头，
+请求时按路径查清单并根据 Accept-Encoding 选择版本，不再访问文件系统；
+文件名带内容哈希的资源返回 immutable 缓存头，其它文件每次用 ETag 重新验证，未变化时返回 304。
+STATIC_WATCH 开启时后台线程定期检查目录，有变化就重建清单（开发时使用）
+"""
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from starlette.responses import FileResponse, Response
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 小于该大小的文件不压缩（字节）
+STATIC_COMPRESS_MIN_BYTES = int(os.getenv("STATIC_COMPRESS_MIN_BYTES", "512"))
+# 超过该大小的文件不读入内存，直接从磁盘发送且不压缩（字节）
+STATIC_MAX_MEMORY_BYTES = int(os.getenv("STATIC_MAX_MEMORY_BYTES", str(16 * 1024 * 1024)))
+# 匹配的路径视为带内容哈希的资源，可以长期缓存
+STATIC_IMMUTABLE_PATTERN = re.compile(os.getenv("STATIC_IMMUTABLE_PATTERN", r"(^|/)assets/|[.-][0-9a-f]{8,}\.\w+$"))
+# 是否监视目录变化并重建清单
+STATIC_WATCH = os.getenv("STATIC_WATCH", "0").lower() in ("1", "true", "yes")
+# 检查目录变化的间隔（秒）
+STATIC_WATCH_INTERVAL = float(os.getenv("STATIC_WATCH_INTERVAL", "1"))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript", "application/json", "application/manifest+json", "application/xml",
+    "application/wasm", "image/svg+xml", "image/x-icon", "font/ttf", "font/otf",
+}
+# 服务端的偏好顺序
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# 不放进清单的目录（使用源目录时）
+SKIP_DIRS = {"node_modules", "unpackage", "__pycache__"}
+
+
+def _compressible(media_type: str) -> bool:
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=11)
+    # mtime=0 使同样的内容得到同样的压缩结果
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+class StaticFile:
+    """清单中的一个文件"""
+    __slots__ = ("path", "body", "variants", "content_hash", "media_type", "last_modified", "cache_control")
+
+    def __init__(self, path: Path, body, variants: dict, content_hash: str, media_type: str,
+                 mtime: float, immutable: bool):
+        self.path = path
+        # 太大的文件为 None，从磁盘发送
+        self.body = body
+        self.variants = variants
+        self.content_hash = content_hash
+        self.media_type = media_type
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+
+    def etag(self, encoding: str = None) -> str:
+        """每种编码的内容不同，强 ETag 也不同"""
+        return f'"{self.content_hash}-{encoding}"' if encoding else f'"{self.content_hash}"'
+
+
+def _read_file(path: Path, relative: str) -> StaticFile:
+    stat = path.stat()
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    immutable = bool(STATIC_IMMUTABLE_PATTERN.search(relative))
+
+    if stat.st_size > STATIC_MAX_MEMORY_BYTES:
+        digest = hashlib.blake2b(digest_size=12)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return StaticFile(path, None, {}, digest.hexdigest(), media_type, stat.st_mtime, immutable)
+
+    body = path.read_bytes()
+    variants = {}
+    if len(body) >= STATIC_COMPRESS_MIN_BYTES and _compressible(media_type):
+        for encoding in ENCODINGS:
+            compressed = _compress(body, encoding)
+            # 压缩效果不明显时不值得让客户端解压
+            if len(compressed) < len(body) * 0.9:
+                variants[encoding] = compressed
+    content_hash = hashlib.blake2b(body, digest_size=12).hexdigest()
+    return StaticFile(path, body, variants, content_hash, media_type, stat.st_mtime, immutable)
+
+
+def _walk(directory: Path):
+    """(相对路径, 文件) 列表，跳过隐藏文件、SKIP_DIRS 和指向目录外的符号链接"""
+    base = directory.resolve()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith(".") and name not in SKIP_DIRS)
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = Path(root) / name
+            if path.is_symlink() and not path.resolve().is_relative_to(base):
+                continue
+            yield path.relative_to(directory).as_posix(), path
+
+
+def _accepted_encodings(header: str) -> dict:
+    """解析 Accept-Encoding，返回 {编码: q 值}"""
+    accepted = {}
+    for item in header.split(","):
+        encoding, *params = item.strip().lower().split(";")
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding.strip()] = quality
+    return accepted
+
+
+def choose_encoding(header: str, available) -> str:
+    """在已有的压缩版本中选出客户端接受的编码，没有时返回 None（发送原文件）"""
+    if not header or not available:
+        return None
+    accepted = _accepted_encodings(header)
+    for encoding in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def _etag_matches(if_none_match: str, entry: StaticFile) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    # 客户端缓存的可能是任何一种编码的版本，内容哈希相同即未变化
+    return any(entry.etag(encoding) in tags for encoding in (None, *entry.variants))
+
+
+def _not_modified_since(if_modified_since: str, entry: StaticFile) -> bool:
+    try:
+        return parsedate_to_datetime(entry.last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+class StaticSite:
+    """前端目录的内存清单"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.files = None
+        self.signature = None
+        self._build_lock = threading.Lock()
+        self._watcher = None
+        self._stopping = threading.Event()
+
+    def _signature(self) -> tuple:
+        """目录中所有文件的路径、大小和修改时间，用于判断是否需要重建"""
+        signature = []
+        for relative, path in _walk(self.directory):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            signature.append((relative, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def build(self):
+        """读取目录，生成清单后整体替换"""
+        with self._build_lock:
+            start = time.perf_counter()
+            signature = self._signature()
+            files = {}
+            for relative, path in _walk(self.directory):
+                try:
+                    files[relative] = _read_file(path, relative)
+                except OSError as e:
+                    logger.warning(f"读取静态文件 {relative} 失败: {e}")
+            self.files = files
+            self.signature = signature
+            total = sum(len(entry.body) for entry in files.values() if entry.body is not None)
+            compressed = sum(
+                min((len(variant) for variant in entry.variants.values()), default=len(entry.body))
+                for entry in files.values() if entry.body is not None
+            )
+            logger.info(
+                f"静态文件清单已生成：{len(files)} 个文件，{total / 1024:.0f}KB，"
+                f"压缩后 {compressed / 1024:.0f}KB（{', '.join(ENCODINGS)}），"
+                f"耗时 {(time.perf_counter() - start) * 1000:.0f}ms"
+            )
+
+    def lookup(self, path: str):
+        """按请求路径查找文件：文件本身、目录下的 index.html，找不到时返回 None"""
+        if self.files is None:
+            self.build()
+        path = path.strip("/")
+        entry = self.files.get(path)
+        if entry is None:
+            entry = self.files.get(f"{path}/index.html" if path else "index.html")
+        return entry
+
+    def respond(self, entry: StaticFile, request_headers) -> Response:
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), entry.variants)
+        headers = {
+            "ETag": entry.etag(encoding),
+            "Cache-Control": entry.cache_control,
+            "Last-Modified": entry.last_modified,
+        }
+        if entry.variants:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, entry)
+        else:
+            if_modified_since = request_headers.get("if-modified-since")
+            not_modified = if_modified_since is not None and _not_modified_since(if_modified_since, entry)
+        if not_modified:
+            return Response(status_code=304, headers=headers)
+
+        if entry.body is None:
+            return FileResponse(str(entry.path), media_type=entry.media_type, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            return Response(entry.variants[encoding], media_type=entry.media_type, headers=headers)
+        return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+    def start(self):
+        """生成清单，STATIC_WATCH 开启时启动监视线程"""
+        self.build()
+        if STATIC_WATCH and self._watcher is None:
+            self._stopping.clear()
+            self._watcher = threading.Thread(
+                target=self._watch, args=(STATIC_WATCH_INTERVAL,), name="static-watcher", daemon=True
+            )
+            self._watcher.start()
+
+    def stop(self):
+        """停止监视线程"""
+        self._stopping.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float):
+        while not self._stopping.wait(interval):
+            try:
+                if self._signature() != self.signature:
+                    logger.info("前端目录有变化，重建静态文件清单")
+                    self.build()
+            except Exception as e:
+                logger.error(f"重建静态文件清单出错: {e}")
+
@@ -0,0 +1,349 @@
+"""
+运行指标
+以 Prometheus 文本格式在 /metrics 输出：各接口的请求数和延迟直方图、进行中的请求数、
+每个请求的 SQL 次数和耗时（SQLAlchemy 引擎事件）、各设备的写入条数、大屏扫描的行数、
+定时任务耗时和清理删除的记录数，以及写入队列、线程池、实时推送、响应缓存的状态。
+
+指标只是进程内加锁的字典累加，开销在微秒级，可以在满负载下常开；
+多进程部署时每个进程各自统计。
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 是否收集请求和 SQL 指标
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+# 单独统计写入条数的设备数上限，超过后新设备计入 device="other"，避免指标数量无限增长
+METRICS_MAX_DEVICES = int(os.getenv("METRICS_MAX_DEVICES", "1000"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 请求延迟直方图的桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 单个请求的 SQL 次数
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+# 定时任务耗时（秒）
+JOB_BUCKETS = (0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0)
+
+_metrics = []
+_collectors = []
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """指标基类，values 按标签值元组保存"""
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def samples(self):
+        """(后缀, 标签名, 标签值, 数值) 的列表"""
+        with self._lock:
+            return [("", self.labels, key, value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels: tuple = (), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels: tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [各桶计数（不累计，最后一个为 +Inf）, 总和, 次数]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+        result = []
+        names = self.labels + ("le",)
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                result.append(("_bucket", names, key + (_format_value(float(bound)),), cumulative))
+            result.append(("_sum", self.labels, key, total))
+            result.append(("_count", self.labels, key, count))
+        return result
+
+
+def register_collector(func):
+    """
+    注册在输出时读取的指标（队列深度等已有统计），func 返回
+    [(名称, 类型, 说明, 标签名, {标签值: 数值})]
+    """
+    _collectors.append(func)
+    return func
+
+
+def render() -> str:
+    """输出 Prometheus 文本格式"""
+    lines = []
+
+    def emit(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, label_names, label_values, value in samples:
+            lines.append(f"{name}{suffix}{_format_labels(label_names, label_values)} {_format_value(value)}")
+
+    for metric in _metrics:
+        emit(metric.name, metric.kind, metric.help_text, metric.samples())
+    for collector in _collectors:
+        try:
+            collected = collector()
+        except Exception as e:
+            logger.warning(f"读取指标失败: {e}")
+            continue
+        for name, kind, help_text, label_names, values in collected:
+            emit(name, kind, help_text, [("", label_names, key, value) for key, value in values.items()])
+    return "\n".join(lines) + "\n"
+
+
+# ---------- 指标定义 ----------
+
+HTTP_REQUESTS = Counter("http_requests_total", "请求数", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "请求耗时", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "进行中的请求数（含实时推送长连接）")
+HTTP_DB_QUERIES = Histogram(
+    "http_request_db_queries", "单个请求执行的 SQL 次数", ("route",), QUERY_COUNT_BUCKETS
+)
+HTTP_DB_SECONDS = Histogram("http_request_db_seconds", "单个请求执行 SQL 的总耗时", ("route",))
+
+DB_QUERIES = Counter("db_queries_total", "执行的 SQL 次数", ("engine",))
+DB_SECONDS = Counter("db_query_seconds_total", "执行 SQL 的总耗时", ("engine",))
+
+INGEST_SAMPLES = Counter("ingest_samples_total", "写入的数据条数", ("device",))
+INGEST_BATCHES = Counter("ingest_batches_total", "写入事务数")
+ROWS_SCANNED = Counter("dashboard_rows_scanned_total", "大屏窗口扫描读取的行数", ("source",))
+
+JOB_DURATION = Histogram("scheduler_job_duration_seconds", "定时任务耗时", ("job",), JOB_BUCKETS)
+JOB_FAILURES = Counter("scheduler_job_failures_total", "定时任务失败次数", ("job",))
+JOB_LAST_SUCCESS = Gauge("scheduler_job_last_success_timestamp_seconds", "定时任务最近一次成功完成的时间", ("job",))
+CLEANUP_DELETED = Counter("cleanup_deleted_total", "过期清理删除的数量", ("table",))
+
+
+# ---------- 请求 ----------
+
+class RequestStats:
+    """一个请求内的 SQL 统计（线程池中执行时上下文随之复制，累加到同一个对象）"""
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_stats = ContextVar("request_stats", default=None)
+
+
+def route_label(scope) -> str:
+    """用路由模板而不是实际路径作为标签，避免 /api/data/{data_id} 这样的路径产生大量指标"""
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    # 较新的 FastAPI 中 include_router 的路由保留相对路径，用实际路径补上前缀
+    try:
+        suffix = route.path_format.format(**scope.get("path_params", {}))
+    except (AttributeError, KeyError, IndexError, ValueError):
+        return template
+    if suffix and scope["path"].endswith(suffix):
+        return scope["path"][:len(scope["path"]) - len(suffix)] + template
+    return template
+
+
+class MetricsMiddleware:
+    """统计每个 HTTP 请求的耗时、状态码和 SQL 次数（ASGI 中间件，放在最外层）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec()
+            _request_stats.reset(token)
+            route = route_label(scope)
+            HTTP_REQUESTS.inc((scope["method"], route, str(status)))
+            HTTP_DURATION.observe(elapsed, (scope["method"], route))
+            HTTP_DB_QUERIES.observe(stats.queries, (route,))
+            HTTP_DB_SECONDS.observe(stats.seconds, (route,))
+
+
+# ---------- SQL ----------
+
+def instrument_engine(engine, name: str):
+    """统计引擎执行的 SQL 次数和耗时，并计入当前请求"""
+    from sqlalchemy import event
+
+    labels = (name,)
+
+    # 开始时间记在本次执行的上下文上，语句出错时随上下文一起丢弃
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        DB_QUERIES.inc(labels)
+        DB_SECONDS.inc(labels, elapsed)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += elapsed
+
+
+# ---------- 写入、扫描、定时任务 ----------
+
+_known_devices = set()
+_known_devices_lock = threading.Lock()
+
+
+def record_ingest(device_ids: list):
+    """记录一个写入事务中各设备的条数"""
+    counts = {}
+    for device_id in device_ids:
+        counts[device_id or ""] = counts.get(device_id or "", 0) + 1
+    with _known_devices_lock:
+        for device_id in list(counts):
+            if device_id in _known_devices:
+                continue
+            if len(_known_devices) < METRICS_MAX_DEVICES:
+                _known_devices.add(device_id)
+            else:
+                counts["other"] = counts.get("other", 0) + counts.pop(device_id)
+    for device_id, count in counts.items():
+        INGEST_SAMPLES.inc((device_id,), count)
+    INGEST_BATCHES.inc()
+
+
+@contextmanager
+def job_timer(job: str):
+    """统计定时任务的耗时、失败次数和最近一次成功的时间，异常继续向外抛出"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        JOB_FAILURES.inc((job,))
+        raise
+    else:
+        JOB_LAST_SUCCESS.set(time.time(), (job,))
+    finally:
+        JOB_DURATION.observe(time.perf_counter() - start, (job,))
+
+
+@register_collector
+def _runtime_stats():
+    """读取各模块已有的统计"""
+    from app import ingest
+    from app.cache import response_cache
+    from app.executor import executor_stats
+    from app.pubsub import broker
+
+    pools = executor_stats()
+    cache = response_cache.stats()
+    stream = broker.stats()
+    collected = [
+        ("db_pool_pending", "gauge", "线程池中排队和执行中的任务数", ("pool",),
+         {(name,): stats["pending"] for name, stats in pools.items()}),
+        ("db_pool_workers", "gauge", "线程池的线程数", ("pool",),
+         {(name,): stats["workers"] for name, stats in pools.items()}),
+        ("dashboard_cache_entries", "gauge", "大屏响应缓存条数", (), {(): cache["entries"]}),
+        ("dashboard_cache_bytes", "gauge", "大屏响应缓存占用的字节数", (), {(): cache["bytes"]}),
+        ("dashboard_cache_lookups_total", "counter", "大屏响应缓存查找次数", ("result",),
+         {("hit",): cache["hits"], ("miss",): cache["misses"]}),
+        ("stream_subscribers", "gauge", "实时推送连接数", (), {(): stream["subscribers"]}),
+        ("stream_published_total", "counter", "推送的事件数", (), {(): stream["published"]}),
+        ("stream_dropped_total", "counter", "因缓冲区满断开的推送连接数", (), {(): stream["dropped"]}),
+    ]
+    if ingest.ingest_queue is not None:
+        queue_stats = ingest.ingest_queue.stats()
+        collected += [
+            ("ingest_queue_depth", "gauge", "写入队列中等待的条数", (), {(): queue_stats["queue_depth"]}),
+            ("ingest_queue_rejected_total", "counter", "写入队列已满被拒绝的条数", (), {(): queue_stats["rejected"]}),
+        ]
+    return collected
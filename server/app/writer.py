@@ -0,0 +1,218 @@
+"""
+写入进程
+多进程部署（CLUSTER_MODE）时唯一直接写入数据的进程：在 Unix socket 上接收各工作进程的提交和删除请求，
+由一个线程在唯一的写连接上串行执行，排队中的提交合并到同一个事务（group commit）；
+提交后的推送事件和缓存失效通知广播给所有已连接的工作进程
+
+用法（在 server 目录下；`python main.py` 在 WORKERS > 1 时会自动启动）：
+    CLUSTER_MODE=1 python -m app.writer
+"""
+import asyncio
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+from app.cluster import (
+    CLUSTER_RUN_DIR, WRITER_LOCK_FILE, WRITER_SOCKET,
+    encode_frame, read_frame, release_lock, try_lock,
+)
+from app.database import SessionLocal, init_db, IS_MEMORY_DB
+from app.ingest import INGEST_BATCH_SIZE, delete_record, store_submissions
+from app.pubsub import broker
+from app.schemas import DataSubmission
+
+logger = logging.getLogger(__name__)
+
+
+class WriterServer:
+    """接收写入请求的 socket 服务和执行写入的线程"""
+
+    def __init__(self, path: str, batch_size: int):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.loop = None
+        self._requests = queue.Queue()
+        self._clients = set()
+        # 统计计数
+        self.transactions = 0
+        self.stored = 0
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        broker.add_listener(self._on_events)
+
+        if os.path.exists(self.path):
+            # 上一次异常退出留下的 socket 文件（已持有写入进程锁，不会是正在运行的进程）
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        # 只允许同一用户的进程连接
+        os.chmod(self.path, 0o600)
+
+        thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        thread.start()
+        logger.info(f"写入进程已启动（pid {os.getpid()}），监听 {self.path}")
+
+        stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, stopping.set)
+        await stopping.wait()
+
+        # 不再接收新请求，写完已收到的请求后退出
+        server.close()
+        await server.wait_closed()
+        self._requests.put(None)
+        await asyncio.to_thread(thread.join)
+        for writer in list(self._clients):
+            writer.close()
+        os.unlink(self.path)
+        logger.info(f"写入进程已停止，共 {self.transactions} 个事务写入 {self.stored} 条数据")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                self._requests.put((writer, message))
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    # ---------- 以下在写入线程中执行，通过 call_soon_threadsafe 回到事件循环发送 ----------
+
+    def _send(self, writer: asyncio.StreamWriter, frame: bytes):
+        if not writer.is_closing():
+            writer.write(frame)
+
+    def _reply(self, writer, request: dict, result=None, error: str = None):
+        message = {"id": request["id"], "ok": error is None}
+        if error is None:
+            message["result"] = result
+        else:
+            message["error"] = error
+        self.loop.call_soon_threadsafe(self._send, writer, encode_frame(message))
+
+    def _broadcast(self, message: dict):
+        frame = encode_frame(message)
+
+        def send_all():
+            for writer in list(self._clients):
+                self._send(writer, frame)
+
+        self.loop.call_soon_threadsafe(send_all)
+
+    def _on_events(self, events: list):
+        """store_submissions 提交后发布的推送事件，转发给所有工作进程"""
+        self._broadcast({"type": "events", "events": events})
+
+    def _run(self):
+        while True:
+            first = self._requests.get()
+            if first is None:
+                return
+            # 执行上一批期间排队的请求一起处理
+            batch = [first]
+            items = len(first[1].get("items") or ())
+            stopping = False
+            while items < self.batch_size:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                items += len(request[1].get("items") or ())
+            self._process(batch)
+            if stopping:
+                return
+
+    def _process(self, batch: list):
+        stores = []
+        for writer, request in batch:
+            op = request.get("op")
+            if op == "store":
+                stores.append((writer, request))
+            elif op == "delete":
+                self._delete(writer, request)
+            else:
+                self._reply(writer, request, error=f"未知的操作: {op}")
+        if stores:
+            self._store(stores)
+
+    def _store(self, requests: list):
+        """多个请求的提交在一个事务内写入；失败时逐个重试，只有出错的请求返回错误"""
+        submissions = []
+        counts = []
+        for _, request in requests:
+            # 工作进程已经校验过
+            items = [DataSubmission.model_construct(**item) for item in request["items"]]
+            submissions.extend(items)
+            counts.append(len(items))
+
+        db = SessionLocal()
+        try:
+            ids = store_submissions(db, submissions)
+            error = None
+        except Exception as e:
+            error = e
+        finally:
+            db.close()
+
+        if error is not None:
+            if len(requests) > 1:
+                for request in requests:
+                    self._store([request])
+            else:
+                logger.error(f"写入 {len(submissions)} 条数据失败: {error}")
+                self._reply(*requests[0], error=str(error))
+            return
+
+        self.transactions += 1
+        self.stored += len(ids)
+        offset = 0
+        for (writer, request), count in zip(requests, counts):
+            self._reply(writer, request, ids[offset:offset + count])
+            offset += count
+
+    def _delete(self, writer, request: dict):
+        db = SessionLocal()
+        try:
+            deleted = delete_record(db, request["data_id"])
+        except Exception as e:
+            self._reply(writer, request, error=str(e))
+            return
+        finally:
+            db.close()
+        if deleted:
+            self._broadcast({"type": "invalidate"})
+        self._reply(writer, request, deleted)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    if IS_MEMORY_DB:
+        logger.error("内存数据库无法在多个进程间共享，不能使用多进程模式")
+        sys.exit(1)
+
+    lock = try_lock(WRITER_LOCK_FILE)
+    if lock is None:
+        logger.error(f"已有写入进程在运行（{WRITER_LOCK_FILE}）")
+        sys.exit(1)
+    try:
+        os.makedirs(CLUSTER_RUN_DIR, exist_ok=True)
+        init_db()
+        asyncio.run(WriterServer(WRITER_SOCKET, INGEST_BATCH_SIZE).serve())
+    finally:
+        release_lock(lock)
+
+
+if __name__ == "__main__":
+    main()
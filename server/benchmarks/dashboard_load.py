@@ -0,0 +1,168 @@
+"""
+数据大屏查询对数据提交延迟的影响
+启动真实的 uvicorn 服务，先只发送设备提交请求测出基线延迟，
+再同时让若干客户端反复请求大时间窗口的数据大屏接口，对比提交延迟的 p50 / p99。
+分别以线程池模式和事件循环内直接执行（DASHBOARD_WORKERS=0、INGEST_WORKERS=0，即旧行为）运行。
+默认使用 production 存储配置（WAL），否则长时间的读事务会在 SQLite 层面阻塞写入。
+
+用法（在 server 目录下）：
+    python -m benchmarks.dashboard_load --seconds 10 --submitters 4 --viewers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = {
+    "pooled": {},
+    "inline": {"DASHBOARD_WORKERS": "0", "INGEST_WORKERS": "0"},
+}
+
+DASHBOARD_PATHS = [
+    "/api/dashboard/battery?hours=720&max_points=5000",
+    "/api/dashboard/snapshot?hours=720&max_points=2000",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str, body=None) -> int:
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def _wait_ready(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            if _request(conn, "GET", "/health") == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("服务启动超时")
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _phase(port: int, seconds: float, submitters: int, viewers: int, fleet) -> dict:
+    """运行一个阶段，返回提交延迟和大屏请求统计"""
+    latencies = []
+    dashboard_requests = [0]
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def submitter(index):
+        device = fleet[index % len(fleet)]
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            status = _request(conn, "POST", "/api/submit", device.payload())
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    def viewer(index):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        i = index
+        while time.monotonic() < deadline:
+            _request(conn, "GET", DASHBOARD_PATHS[i % len(DASHBOARD_PATHS)])
+            i += 1
+            with lock:
+                dashboard_requests[0] += 1
+
+    threads = [threading.Thread(target=submitter, args=(i,)) for i in range(submitters)]
+    threads += [threading.Thread(target=viewer, args=(i,)) for i in range(viewers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return {
+        "submits": len(latencies),
+        "submit_errors": errors[0],
+        "submit_p50_ms": round(_percentile(latencies, 0.50), 2),
+        "submit_p99_ms": round(_percentile(latencies, 0.99), 2),
+        "submit_max_ms": round(max(latencies), 2) if latencies else 0,
+        "dashboard_requests": dashboard_requests[0],
+    }
+
+
+def run_mode(mode: str, args, fleet) -> dict:
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+            DASHBOARD_CACHE_TTL="0",
+            DB_PROFILE=args.profile,
+            **MODES[mode]
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+            cwd=server_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            _wait_ready(port)
+            # 预置数据，让大屏查询有足够的扫描量
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+            for _ in range(args.seed_rows // 5000):
+                _request(conn, "POST", "/api/submit/batch",
+                         [fleet[i % len(fleet)].payload() for i in range(5000)])
+
+            return {
+                "baseline": _phase(port, args.seconds, args.submitters, 0, fleet),
+                "under_dashboard_load": _phase(port, args.seconds, args.submitters, args.viewers, fleet),
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据大屏负载下的提交延迟基准测试")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--submitters", type=int, default=4)
+    parser.add_argument("--viewers", type=int, default=4)
+    parser.add_argument("--seed-rows", type=int, default=50000)
+    parser.add_argument("--modes", default="pooled,inline")
+    parser.add_argument("--profile", default="production", help="存储配置（DB_PROFILE）")
+    args = parser.parse_args()
+
+    from benchmarks.fleet import make_fleet
+    fleet = make_fleet(50, seed=1)
+
+    results = {}
+    for mode in args.modes.split(","):
+        results[mode] = run_mode(mode, args, fleet)
+        for phase, stats in results[mode].items():
+            print(f"{mode:>8} {phase:>22}: {stats}")
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+模拟设备数据
+生成与 APP 端各收集器（APP/utils/collectors）结构一致的数据
+"""
+import random
+import time
+
+APPS = [
+    "com.tencent.mm", "com.tencent.mobileqq", "com.ss.android.ugc.aweme",
+    "com.taobao.taobao", "com.eg.android.AlipayGphone", "com.sina.weibo",
+    "tv.danmaku.bili", "com.netease.cloudmusic", "com.android.chrome",
+]
+SSIDS = ["Home-WiFi", "Office-5G", "CMCC-Free", "Cafe"]
+
+
+class FakeDevice:
+    """单个模拟设备，状态随时间缓慢变化"""
+
+    def __init__(self, index: int, seed: int = 0):
+        self.rng = random.Random(seed * 100003 + index)
+        self.device_id = f"device_bench_{index:06d}"
+        self.battery = self.rng.uniform(20, 100)
+        self.charging = False
+        self.latitude = 39.9 + self.rng.uniform(-0.5, 0.5)
+        self.longitude = 116.4 + self.rng.uniform(-0.5, 0.5)
+        self.app = self.rng.choice(APPS)
+        self.ssid = self.rng.choice(SSIDS)
+        self.brand = self.rng.choice(["Xiaomi", "HUAWEI", "OPPO", "vivo", "Apple"])
+
+    def payload(self, now_ms: int = None) -> dict:
+        """生成一次提交的数据（与 POST /api/submit 请求体一致）"""
+        now_ms = now_ms or int(time.time() * 1000)
+        rng = self.rng
+
+        # 电量缓慢变化，低电量时开始充电
+        if self.charging:
+            self.battery = min(100.0, self.battery + rng.uniform(0, 3))
+            self.charging = self.battery < 95
+        else:
+            self.battery = max(1.0, self.battery - rng.uniform(0, 1.5))
+            self.charging = self.battery < 15
+        self.latitude += rng.gauss(0, 0.0005)
+        self.longitude += rng.gauss(0, 0.0005)
+        if rng.random() < 0.3:
+            self.app = rng.choice(APPS)
+
+        data = {
+            "battery": {"level": round(self.battery), "isCharging": self.charging, "timestamp": now_ms},
+            "location": {
+                "latitude": round(self.latitude, 6),
+                "longitude": round(self.longitude, 6),
+                "accuracy": rng.choice([10, 20, 35, 65]),
+                "altitude": 0,
+                "verticalAccuracy": 0,
+                "address": None,
+                "timestamp": now_ms,
+            },
+            "foregroundApp": {"packageName": self.app, "className": "N/A", "timestamp": now_ms},
+            "deviceInfo": {
+                "brand": self.brand, "model": f"{self.brand} Phone", "system": "Android 14",
+                "platform": "android", "deviceId": self.device_id, "deviceBrand": self.brand,
+                "deviceModel": f"{self.brand} Phone", "osName": "android", "osVersion": "14",
+                "osLanguage": "zh-CN", "osTheme": "light", "romName": "MIUI", "romVersion": "14.0",
+                "timestamp": now_ms,
+            },
+            "networkInfo": {
+                "networkType": "wifi",
+                "timestamp": now_ms,
+                "wifiInfo": {
+                    "ssid": self.ssid, "bssid": "00:11:22:33:44:55", "secure": True,
+                    "signalStrength": rng.randint(30, 100), "frequency": 5180,
+                },
+            },
+            "storageInfo": {"keys": ["device_id"], "currentSize": 1, "limitSize": 10240, "timestamp": now_ms},
+            "appInfo": {"appId": "__UNI__WHATUDOING", "appName": "WhatUDoing", "appVersion": "1.0.0", "timestamp": now_ms},
+            "screenInfo": {
+                "screenWidth": 1080, "screenHeight": 2400, "windowWidth": 393, "windowHeight": 873,
+                "pixelRatio": 2.75, "statusBarHeight": 32, "timestamp": now_ms,
+            },
+            "systemInfo": {"platform": "android", "system": "Android 14", "version": "1.0.0", "SDKVersion": "", "timestamp": now_ms},
+            "accelerometer": {"x": rng.gauss(0, 0.2), "y": rng.gauss(0, 0.2), "z": 9.8 + rng.gauss(0, 0.2), "timestamp": now_ms},
+            "pushNotification": {"clientid": f"cid_{self.device_id}", "timestamp": now_ms},
+            "timestamp": now_ms,
+        }
+        return {"device_id": self.device_id, "timestamp": now_ms, "data": data}
+
+
+def make_fleet(size: int, seed: int = 0) -> list[FakeDevice]:
+    """创建一批模拟设备"""
+    return [FakeDevice(i, seed) for i in range(size)]
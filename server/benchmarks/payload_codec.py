@@ -0,0 +1,134 @@
+"""
+原始数据存储编码对比
+分别以 json / msgpack / zstd（无字典）/ zstd（训练字典）编码、是否做静态部分去重写入同样的模拟数据，
+对比数据库文件大小、data 列和去重内容表的平均字节数、写入耗时，以及编码、解码和通过 ORM 读取全部数据的耗时。
+每种组合在独立的子进程中运行（PAYLOAD_CODEC / PAYLOAD_DEDUP_SECTIONS 在启动时读取）。
+
+用法（在 server 目录下）：
+    python -m benchmarks.payload_codec --rows 10000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+VARIANTS = {
+    "json": {"codec": "json", "train": False, "dedup": False},
+    "json+dedup": {"codec": "json", "train": False, "dedup": True},
+    "msgpack": {"codec": "msgpack", "train": False, "dedup": False},
+    "zstd": {"codec": "zstd", "train": False, "dedup": False},
+    "zstd-dict": {"codec": "zstd", "train": True, "dedup": False},
+    "zstd-dict+dedup": {"codec": "zstd", "train": True, "dedup": True},
+}
+
+
+def _worker(variant: str, rows: int) -> dict:
+    """在子进程中运行：写入数据并测量"""
+    from sqlalchemy import text
+    from app import codec, sections
+    from app.database import init_db, SessionLocal, CollectedData, engine
+    from app.ingest import store_submissions
+    from app.schemas import DataSubmission
+    from benchmarks.fleet import make_fleet
+
+    init_db()
+    fleet = make_fleet(50, seed=1)
+    payloads = [fleet[i % len(fleet)].payload() for i in range(rows)]
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        # 按 5 分钟上报间隔的设备逐条提交
+        for item in payloads:
+            store_submissions(db, [DataSubmission(**item)])
+        ingest_seconds = time.perf_counter() - start
+    finally:
+        db.close()
+
+    if VARIANTS[variant]["train"]:
+        codec.train_dictionary()
+        codec.migrate_payloads(all_rows=True)
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql("VACUUM")
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        data_bytes = conn.execute(text("SELECT sum(length(CAST(data AS BLOB))) FROM collected_data")).scalar()
+        section_bytes = conn.execute(text("SELECT sum(length(CAST(data AS BLOB))) FROM payload_sections")).scalar()
+        raw_values = [row[0] for row in conn.execute(text("SELECT data FROM collected_data"))]
+    file_bytes = os.path.getsize(engine.url.database)
+
+    data = [item["data"] for item in payloads]
+    start = time.perf_counter()
+    for item in data:
+        codec.encode(item)
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for value in raw_values:
+        sections.expand(codec.decode(value))
+    decode_seconds = time.perf_counter() - start
+
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        db.query(CollectedData.id, CollectedData.data).all()
+        query_seconds = time.perf_counter() - start
+    finally:
+        db.close()
+
+    return {
+        "rows": rows,
+        "file_mb": round(file_bytes / 1024 / 1024, 2),
+        "data_bytes_per_row": round(data_bytes / rows, 1),
+        "section_kb": round((section_bytes or 0) / 1024, 1),
+        "ingest_us_per_row": round(ingest_seconds / rows * 1e6, 1),
+        "encode_us_per_row": round(encode_seconds / rows * 1e6, 2),
+        "decode_us_per_row": round(decode_seconds / rows * 1e6, 2),
+        "orm_read_ms": round(query_seconds * 1000, 1),
+    }
+
+
+def run_variant(variant: str, rows: int) -> dict:
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+            DB_PROFILE="production",
+            PAYLOAD_CODEC=VARIANTS[variant]["codec"],
+        )
+        if VARIANTS[variant]["dedup"]:
+            env["PAYLOAD_DEDUP_SECTIONS"] = "deviceInfo,systemInfo,screenInfo,appInfo,storageInfo"
+        else:
+            env["PAYLOAD_DEDUP_SECTIONS"] = ""
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.payload_codec", "--worker", variant, "--rows", str(rows)],
+            cwd=server_dir, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="原始数据存储编码对比")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(_worker(args.worker, args.rows)))
+        return
+
+    results = {}
+    for variant in args.variants.split(","):
+        results[variant] = run_variant(variant, args.rows)
+        print(f"{variant:>10}: {results[variant]}")
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+查询接口响应序列化对比
+在临时数据库中写入模拟数据，对比 `/api/data?limit=1000` 和 `/api/dashboard/location` 两种响应的构造和序列化耗时：
+- orm+pydantic：之前的做法，读取 ORM 对象（含 data 列解码），经 DataResponse 校验、jsonable_encoder 后用标准库 json 编码
+- tuples+orjson / tuples+msgpack：按元组读取需要的列，直接用 orjson / msgpack 编码
+最后通过 TestClient 请求完整接口，对比 JSON 和 msgpack 响应的耗时和大小。
+
+用法（在 server 目录下）：
+    python -m benchmarks.response_render --rows 20000 --repeat 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def _timed(func, repeat: int) -> tuple:
+    """返回 (中位数耗时毫秒, 最后一次的结果)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2), result
+
+
+def run(rows: int, repeat: int) -> dict:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.testclient import TestClient
+    from pydantic import TypeAdapter
+    import main
+    from app.database import init_db, SessionLocal, ReadSessionLocal, CollectedData
+    from app.ingest import store_submissions
+    from app.responses import FastResponse, _response_format
+    from app.routers.data import DATA_RESPONSE_COLUMNS, DATA_RESPONSE_KEYS
+    from app.schemas import DataSubmission, DataResponse
+    from benchmarks.fleet import make_fleet
+
+    init_db()
+    fleet = make_fleet(50, seed=1)
+    db = SessionLocal()
+    try:
+        for start in range(0, rows, 1000):
+            store_submissions(db, [
+                DataSubmission(**fleet[i % len(fleet)].payload()) for i in range(start, min(rows, start + 1000))
+            ])
+    finally:
+        db.close()
+
+    adapter = TypeAdapter(list[DataResponse])
+
+    def legacy_render(content) -> bytes:
+        return json.dumps(
+            jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+
+    def fast_render(content, fmt: str) -> bytes:
+        token = _response_format.set(fmt)
+        try:
+            return FastResponse(content).body
+        finally:
+            _response_format.reset(token)
+
+    def data_query(session, orm: bool):
+        query = session.query(CollectedData) if orm else session.query(*DATA_RESPONSE_COLUMNS)
+        return query.order_by(CollectedData.created_at.desc(), CollectedData.id.desc()).limit(1000).all()
+
+    def location_query(session):
+        return session.query(
+            CollectedData.latitude, CollectedData.longitude, CollectedData.timestamp
+        ).filter(CollectedData.latitude.isnot(None)).limit(1000).all()
+
+    variants = {
+        "data orm+pydantic": lambda s: legacy_render(
+            adapter.dump_python(adapter.validate_python(data_query(s, True), from_attributes=True), mode="json")
+        ),
+        "data tuples+orjson": lambda s: fast_render(
+            [dict(zip(DATA_RESPONSE_KEYS, row)) for row in data_query(s, False)], "json"
+        ),
+        "data tuples+msgpack": lambda s: fast_render(
+            [dict(zip(DATA_RESPONSE_KEYS, row)) for row in data_query(s, False)], "msgpack"
+        ),
+        "location dicts+json": lambda s: legacy_render({"locations": [
+            {"latitude": row.latitude, "longitude": row.longitude, "timestamp": row.timestamp}
+            for row in location_query(s)
+        ]}),
+        "location tuples+orjson": lambda s: fast_render(
+            {"locations": [dict(row._mapping) for row in location_query(s)]}, "json"
+        ),
+        "location tuples+msgpack": lambda s: fast_render(
+            {"locations": [dict(row._mapping) for row in location_query(s)]}, "msgpack"
+        ),
+    }
+
+    results = {}
+    session = ReadSessionLocal()
+    try:
+        for name, func in variants.items():
+            elapsed, body = _timed(lambda: func(session), repeat)
+            results[name] = {"ms": elapsed, "bytes": len(body)}
+    finally:
+        session.close()
+
+    with TestClient(main.app) as client:
+        for path in ("/api/data?limit=1000", "/api/dashboard/location?hours=87600"):
+            for label, accept in (("json", "application/json"), ("msgpack", "application/msgpack")):
+                elapsed, response = _timed(lambda: client.get(path, headers={"Accept": accept}), repeat)
+                results[f"GET {path} {label}"] = {"ms": elapsed, "bytes": len(response.content)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查询接口响应序列化对比")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 需要在导入 app 之前设置
+        os.environ["DATABASE_URL"] = f"sqlite:///{tmp}/bench.db"
+        os.environ.setdefault("DB_PROFILE", "production")
+        os.environ["DASHBOARD_CACHE_TTL"] = "0"
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        results = run(args.rows, args.repeat)
+
+    for name, stats in results.items():
+        print(f"{name:>50}: {stats}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
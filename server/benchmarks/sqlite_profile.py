@@ -0,0 +1,114 @@
+"""
+SQLite 存储配置对比
+在同一台机器上分别以 default / production 配置运行读写混合负载，
+对比写入、查询吞吐以及 "database is locked" 错误数。
+
+用法（在 server 目录下）：
+    python -m benchmarks.sqlite_profile --seconds 10 --writers 4 --readers 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def run_workload(args):
+    """子进程中执行：环境变量已设置好 DATABASE_URL / DB_PROFILE"""
+    import threading
+    import time
+    from datetime import datetime, timedelta
+    from sqlalchemy import func
+    from app.database import init_db, SessionLocal, ReadSessionLocal, CollectedData
+    from app.ingest import store_submissions
+    from app.schemas import DataSubmission
+    from benchmarks.fleet import make_fleet
+
+    init_db()
+    fleet = make_fleet(50, seed=1)
+
+    # 预置数据，让查询有一定的扫描量
+    db = SessionLocal()
+    for _ in range(args.seed_rows // 500):
+        store_submissions(db, [DataSubmission(**fleet[i % len(fleet)].payload()) for i in range(500)])
+    db.close()
+
+    counters = {"writes": 0, "reads": 0, "write_errors": 0, "read_errors": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def writer(index):
+        device = fleet[index % len(fleet)]
+        while time.monotonic() < deadline:
+            db = SessionLocal()
+            try:
+                store_submissions(db, [DataSubmission(**device.payload())])
+                key = "writes"
+            except Exception as e:
+                key = "locked" if "locked" in str(e) else "write_errors"
+            finally:
+                db.close()
+            with lock:
+                counters[key] += 1
+
+    def reader():
+        while time.monotonic() < deadline:
+            db = ReadSessionLocal()
+            try:
+                start_time = datetime.utcnow() - timedelta(hours=1)
+                db.query(func.count(CollectedData.id)).filter(CollectedData.created_at >= start_time).scalar()
+                db.query(CollectedData.device_id, func.count(CollectedData.id)).group_by(CollectedData.device_id).all()
+                key = "reads"
+            except Exception as e:
+                key = "locked" if "locked" in str(e) else "read_errors"
+            finally:
+                db.close()
+            with lock:
+                counters[key] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    counters["writes_per_sec"] = round(counters["writes"] / args.seconds, 1)
+    counters["reads_per_sec"] = round(counters["reads"] / args.seconds, 1)
+    print(json.dumps(counters))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite 存储配置读写混合基准测试")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seed-rows", type=int, default=20000)
+    parser.add_argument("--profiles", default="default,production")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_workload(args)
+        return
+
+    results = {}
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for profile in args.profiles.split(","):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DB_PROFILE=profile, DATABASE_URL=f"sqlite:///{tmp}/bench.db")
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.sqlite_profile", "--worker",
+                 "--seconds", str(args.seconds), "--writers", str(args.writers),
+                 "--readers", str(args.readers), "--seed-rows", str(args.seed_rows)],
+                cwd=server_dir, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            results[profile] = json.loads(output.strip().splitlines()[-1])
+        print(f"{profile:>12}: {results[profile]}")
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
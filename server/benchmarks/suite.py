@@ -0,0 +1,391 @@
+"""
+负载与延迟基准测试套件
+按 APP 各收集器的数据结构（benchmarks/fleet.py）生成模拟设备，预置 10 万 / 100 万 / 1000 万条数据，
+启动真实的 uvicorn 服务，依次测量：
+- 每个 /api/dashboard/* 接口在不同 hours 窗口下的延迟（关闭响应缓存，顺序请求）
+- 若干并发客户端持续请求 /api/submit 的吞吐和 p50 / p95 / p99 延迟
+结果写入 JSON 文件；--compare 与之前的结果对比，p95 变慢超过 --tolerance 时以非零状态退出。
+
+预置数据按「每台设备每 5 分钟上报一次」分布在最近 --days 天内（最后一批为预置时的当前时间），设备数随数据量增加，
+写入走与线上相同的入库路径（指标列、预聚合、设备登记表、静态部分去重）。
+预置好的数据库保存在 --data-dir 中，--seed-max-age 小时内的运行复制一份使用，原文件保持不变；
+1000 万条数据的预置需要较长时间（开发机上约一小时）和十几 GB 磁盘空间。
+
+用法（在 server 目录下）：
+    python -m benchmarks.suite --sizes 100k,1m --output results.json
+    python -m benchmarks.suite --sizes 100k --output new.json --compare results.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 设备上报间隔（秒）
+REPORT_INTERVAL = 300
+# 不测量的大屏接口（长连接推送）
+SKIP_PATHS = ("/api/dashboard/stream",)
+DEFAULT_HOURS = "1,24,168,720"
+
+
+def parse_size(value: str) -> int:
+    """解析 100k / 1m / 10m 这样的数据量"""
+    value = value.strip().lower()
+    multiplier = {"k": 1000, "m": 1000 * 1000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+
+def latency_stats(values: list) -> dict:
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": round(max(values), 2) if values else 0.0,
+    }
+
+
+# ---------- 预置数据 ----------
+
+def _seed_worker(rows: int, days: int, seed: int) -> dict:
+    """在子进程中运行（DATABASE_URL 指向要预置的数据库）"""
+    from app.database import init_db, SessionLocal
+    from app.ingest import store_submissions
+    from app.schemas import DataSubmission
+    from benchmarks.fleet import make_fleet
+
+    init_db()
+    fleet = make_fleet(max(1, math.ceil(rows / (days * 86400 // REPORT_INTERVAL))), seed=seed)
+    # 最后一批数据的创建时间为当前时间
+    ticks = math.ceil(rows / len(fleet))
+    start_at = datetime.utcnow().replace(microsecond=0) - timedelta(seconds=(ticks - 1) * REPORT_INTERVAL)
+
+    started = time.perf_counter()
+    written = 0
+    db = SessionLocal()
+    try:
+        tick = 0
+        while written < rows:
+            # 同一时刻所有设备各上报一次，作为一批写入
+            created_at = start_at + timedelta(seconds=tick * REPORT_INTERVAL)
+            now_ms = int((created_at - datetime(1970, 1, 1)).total_seconds() * 1000)
+            batch = [
+                DataSubmission(**device.payload(now_ms))
+                for device in fleet[:rows - written]
+            ]
+            store_submissions(db, batch, created_at=created_at)
+            written += len(batch)
+            tick += 1
+    finally:
+        db.close()
+    return {
+        "rows": written,
+        "devices": len(fleet),
+        "seeded_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "seed_seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+def seeded_database(rows: int, args) -> tuple[str, dict]:
+    """
+    返回预置好数据的数据库路径及预置信息
+
+    已有的预置数据库不超过 --seed-max-age 小时时直接使用；
+    数据按预置时的时间分布，放得太久后小时间窗口内没有数据，测量结果不可比，需要重新预置
+    """
+    os.makedirs(args.data_dir, exist_ok=True)
+    name = f"seed_{rows}_{args.days}d_{args.profile}"
+    path = os.path.join(args.data_dir, f"{name}.db")
+    info_path = os.path.join(args.data_dir, f"{name}.json")
+    if os.path.exists(path) and os.path.exists(info_path):
+        with open(info_path, encoding="utf-8") as f:
+            info = json.load(f)
+        age = datetime.utcnow() - datetime.fromisoformat(info["seeded_at"])
+        if age <= timedelta(hours=args.seed_max_age):
+            return path, info
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    print(f"预置 {rows} 条数据到 {path} ...", file=sys.stderr)
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", DB_PROFILE=args.profile)
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.suite", "--seed-worker", str(rows),
+         "--days", str(args.days), "--seed", str(args.seed)],
+        cwd=SERVER_DIR, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    info = json.loads(output.strip().splitlines()[-1])
+    # 合并 WAL，之后复制单个文件即可
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    info["db_bytes"] = os.path.getsize(path)
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return path, info
+
+
+# ---------- 服务与请求 ----------
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str, body=None) -> tuple[int, int]:
+    """返回 (状态码, 响应体字节数)"""
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    return response.status, len(response.read())
+
+
+def _wait_ready(port: int, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            if _request(conn, "GET", "/health")[0] == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("服务启动超时")
+
+
+def start_server(db_path: str, port: int, args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{db_path}",
+        DB_PROFILE=args.profile,
+        DASHBOARD_CACHE_TTL="0",
+        # 预置数据不会在测量期间被过期清理删除
+        DATA_EXPIRY_DAYS=str(args.days + 7),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _wait_ready(port)
+    return server
+
+
+def dashboard_endpoints(port: int) -> dict:
+    """从 OpenAPI 文档中找出所有 /api/dashboard/* 的 GET 接口，返回 {路径: 是否有 hours 参数}"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.request("GET", "/openapi.json")
+    spec = json.loads(conn.getresponse().read())
+    endpoints = {}
+    for path, operations in sorted(spec["paths"].items()):
+        if not path.startswith("/api/dashboard/") or path.startswith(SKIP_PATHS) or "get" not in operations:
+            continue
+        parameters = operations["get"].get("parameters", [])
+        endpoints[path] = any(parameter["name"] == "hours" for parameter in parameters)
+    return endpoints
+
+
+def measure_dashboard(port: int, hours_windows: list, repeat: int) -> dict:
+    """顺序请求每个大屏接口，每个窗口先预热一次再测 repeat 次"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    results = {}
+    for path, has_hours in dashboard_endpoints(port).items():
+        results[path] = {}
+        for hours in (hours_windows if has_hours else [None]):
+            url = f"{path}?hours={hours}" if hours is not None else path
+            _request(conn, "GET", url)
+            latencies = []
+            errors = 0
+            size = 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                status, size = _request(conn, "GET", url)
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += status != 200
+            results[path][str(hours) if hours is not None else "-"] = {
+                **latency_stats(latencies), "errors": errors, "bytes": size
+            }
+            print(f"  {url:>45}: p50 {results[path][str(hours) if hours is not None else '-']['p50_ms']}ms",
+                  file=sys.stderr)
+    return results
+
+
+def measure_ingest(port: int, seconds: float, concurrency: int, seed: int) -> dict:
+    """concurrency 个客户端各用一条连接持续提交，统计吞吐和延迟"""
+    from benchmarks.fleet import make_fleet
+
+    fleet = make_fleet(concurrency * 10, seed=seed + 1)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(index: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        local = []
+        failed = 0
+        count = 0
+        while time.monotonic() < deadline:
+            body = fleet[(index + count * concurrency) % len(fleet)].payload()
+            count += 1
+            start = time.perf_counter()
+            status, _ = _request(conn, "POST", "/api/submit", body)
+            if status in (200, 202):
+                local.append((time.perf_counter() - start) * 1000)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 1),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "errors": errors[0],
+        **latency_stats(latencies),
+    }
+
+
+def run_size(rows: int, args) -> dict:
+    seed_path, seed_info = seeded_database(rows, args)
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as tmp:
+        # 测量会写入新数据，使用预置数据库的副本
+        db_path = os.path.join(tmp, "bench.db")
+        shutil.copyfile(seed_path, db_path)
+        port = _free_port()
+        server = start_server(db_path, port, args)
+        try:
+            print(f"{rows} 条数据：大屏接口", file=sys.stderr)
+            dashboard = measure_dashboard(port, args.hours, args.repeat)
+            print(f"{rows} 条数据：提交接口", file=sys.stderr)
+            ingest = measure_ingest(port, args.ingest_seconds, args.concurrency, args.seed)
+        finally:
+            server.terminate()
+            server.wait()
+    return {"seed": seed_info, "ingest": ingest, "dashboard": dashboard}
+
+
+# ---------- 结果对比 ----------
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    """返回 p95 延迟变慢（或提交吞吐下降）超过 tolerance 的项"""
+    regressions = []
+    for size, result in current["results"].items():
+        before = baseline.get("results", {}).get(size)
+        if before is None:
+            continue
+        old_ingest, new_ingest = before["ingest"], result["ingest"]
+        if new_ingest["throughput_rps"] < old_ingest["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{size} /api/submit 吞吐 {old_ingest['throughput_rps']} -> {new_ingest['throughput_rps']} req/s"
+            )
+        if new_ingest["p95_ms"] > old_ingest["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{size} /api/submit p95 {old_ingest['p95_ms']} -> {new_ingest['p95_ms']}ms")
+        for path, windows in result["dashboard"].items():
+            for hours, stats in windows.items():
+                old = before["dashboard"].get(path, {}).get(hours)
+                if old is not None and stats["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+                    regressions.append(f"{size} {path} hours={hours} p95 {old['p95_ms']} -> {stats['p95_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="负载与延迟基准测试套件")
+    parser.add_argument("--sizes", default="100k,1m,10m", help="预置数据量，逗号分隔")
+    parser.add_argument("--days", type=int, default=28, help="预置数据分布的天数")
+    parser.add_argument("--hours", default=DEFAULT_HOURS, help="大屏接口的 hours 窗口，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=10, help="每个大屏接口和窗口的请求次数")
+    parser.add_argument("--ingest-seconds", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=8, help="提交接口的并发客户端数")
+    parser.add_argument("--profile", default="production", help="存储配置（DB_PROFILE）")
+    parser.add_argument("--seed", type=int, default=1, help="模拟设备的随机种子")
+    parser.add_argument("--seed-max-age", type=float, default=24, help="预置数据库可以重复使用的小时数")
+    parser.add_argument("--data-dir", default=os.path.join(SERVER_DIR, "benchmarks", "data"),
+                        help="预置数据库的保存目录")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件（默认输出到标准输出）")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许变慢的比例")
+    parser.add_argument("--seed-worker", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed_worker is not None:
+        print(json.dumps(_seed_worker(args.seed_worker, args.days, args.seed)))
+        return
+
+    args.hours = [int(hours) for hours in args.hours.split(",") if hours.strip()]
+    report = {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": {
+                "profile": args.profile, "days": args.days, "hours": args.hours, "repeat": args.repeat,
+                "ingest_seconds": args.ingest_seconds, "concurrency": args.concurrency, "seed": args.seed,
+                "payload_codec": os.getenv("PAYLOAD_CODEC", "json"),
+            },
+        },
+        "results": {},
+    }
+    for size in args.sizes.split(","):
+        report["results"][size.strip()] = run_size(parse_size(size), args)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for line in regressions:
+            print(f"变慢: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("没有超过允许范围的变慢", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+多进程部署下数据大屏接口的 CPU 扩展性
+用 suite 的预置数据库（默认 10 万条），分别以 1 / 2 / 4 个工作进程（加一个写入进程）启动服务，
+若干客户端持续轮流请求读取较重的大屏接口（关闭响应缓存），统计吞吐和延迟。
+大屏扫描是 CPU 密集的 Python 代码，单进程受 GIL 限制最多用满一个核，吞吐应随进程数增长到 CPU 核数为止。
+
+用法（在 server 目录下）：
+    python -m benchmarks.workers --size 100k --workers 1,2,4 --seconds 20
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.suite import (
+    SERVER_DIR, _free_port, _request, _wait_ready, latency_stats, parse_size, seeded_database,
+)
+
+# 读取较重、不依赖预聚合的大屏接口
+DEFAULT_PATHS = (
+    "/api/dashboard/snapshot?hours=24",
+    "/api/dashboard/battery?hours=24",
+    "/api/dashboard/network?hours=24",
+    "/api/dashboard/location?hours=24",
+    "/api/dashboard/timeline?hours=24",
+)
+
+
+def start_cluster(db_path: str, run_dir: str, port: int, workers: int, args) -> list:
+    """按 README 中 uvicorn / gunicorn 部署的方式分别启动写入进程和工作进程"""
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{db_path}",
+        DB_PROFILE="production",
+        CLUSTER_MODE="1",
+        CLUSTER_RUN_DIR=run_dir,
+        DASHBOARD_CACHE_TTL="0",
+        DATA_EXPIRY_DAYS=str(args.days + 7),
+    )
+    writer = subprocess.Popen(
+        [sys.executable, "-m", "app.writer"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _wait_ready(port)
+    return [server, writer]
+
+
+def measure(port: int, paths: list, seconds: float, concurrency: int) -> dict:
+    """concurrency 个客户端各用一条连接轮流请求 paths"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(index: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+        local = []
+        failed = 0
+        count = index
+        while time.monotonic() < deadline:
+            path = paths[count % len(paths)]
+            count += 1
+            start = time.perf_counter()
+            status, _ = _request(conn, "GET", path)
+            if status == 200:
+                local.append((time.perf_counter() - start) * 1000)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return {
+        "seconds": round(elapsed, 1),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "errors": errors[0],
+        **latency_stats(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程部署下数据大屏接口的 CPU 扩展性")
+    parser.add_argument("--size", default="100k", help="预置数据量")
+    parser.add_argument("--workers", default="1,2,4", help="工作进程数，逗号分隔")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=None, help="并发客户端数（默认最大进程数的 2 倍）")
+    parser.add_argument("--paths", default=",".join(DEFAULT_PATHS))
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-max-age", type=float, default=24)
+    parser.add_argument("--data-dir", default=os.path.join(SERVER_DIR, "benchmarks", "data"))
+    args = parser.parse_args()
+    # seeded_database 使用的参数
+    args.profile = "production"
+
+    counts = [int(value) for value in args.workers.split(",")]
+    concurrency = args.concurrency or max(counts) * 2
+    paths = [path for path in args.paths.split(",") if path]
+    seed_path, _ = seeded_database(parse_size(args.size), args)
+
+    results = {"cpu_count": os.cpu_count(), "concurrency": concurrency, "paths": paths, "workers": {}}
+    for workers in counts:
+        with tempfile.TemporaryDirectory(dir=args.data_dir) as tmp:
+            db_path = os.path.join(tmp, "bench.db")
+            shutil.copyfile(seed_path, db_path)
+            port = _free_port()
+            processes = start_cluster(db_path, os.path.join(tmp, "run"), port, workers, args)
+            try:
+                # 预热：每个进程的连接池、字典和去重缓存
+                measure(port, paths, 2, concurrency)
+                results["workers"][workers] = measure(port, paths, args.seconds, concurrency)
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        base = results["workers"][counts[0]]["throughput_rps"]
+        stats = results["workers"][workers]
+        stats["speedup"] = round(stats["throughput_rps"] / base, 2) if base else 0.0
+        print(f"{workers} 个工作进程: {stats['throughput_rps']} 次/秒（{stats['speedup']}x），"
+              f"p50 {stats['p50_ms']}ms，p95 {stats['p95_ms']}ms", file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
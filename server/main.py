@@ -2,33 +2,60 @@
 FastAPI 服务器主文件
 用于接收和存储 APP 收集的数据，并托管前端页面
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 from contextlib import asynccontextmanager
+import asyncio
 import uvicorn
 import os
 from pathlib import Path
 from app.database import init_db, cleanup_expired_data
-from app.routers import data, dashboard
+from app.routers import data, dashboard, export, stream, admin
 from app.scheduler import start_scheduler, stop_scheduler
+from app.ingest import start_ingest_queue, stop_ingest_queue
+from app.cache import ResponseCacheMiddleware
+from app.decompress import RequestDecompressionMiddleware
+from app.responses import ContentNegotiationMiddleware, FastResponse
+from app.pubsub import broker
+from app.executor import start_executors, stop_executors
+from app.static import StaticSite
+from app import cluster, profiling, telemetry
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时初始化数据库和调度器
     init_db()
-    start_scheduler()
+    start_executors()
+    if STATIC_WEB_DIR.exists():
+        static_site.start()
+    start_ingest_queue()
+    if cluster.CLUSTER_MODE:
+        # 多进程模式：写入交给写入进程，只有当选的主进程运行调度器
+        cluster.start_cluster(on_elected=start_scheduler, on_resigned=stop_scheduler)
+    else:
+        start_scheduler()
     yield
-    # 关闭时停止调度器
-    stop_scheduler()
+    # 关闭时停止调度器，并写完写入队列中剩余的数据，最后断开实时推送连接
+    # （多进程模式下队列经事件循环发给写入进程，不能在事件循环中阻塞等待）
+    if cluster.CLUSTER_MODE:
+        await asyncio.to_thread(stop_ingest_queue)
+        await cluster.stop_cluster()
+    else:
+        stop_scheduler()
+        stop_ingest_queue()
+    stop_executors()
+    static_site.stop()
+    broker.close()
 
 app = FastAPI(
     title="WhatUDoing Data Server",
     description="接收和存储 APP 收集的数据",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # 默认用 orjson 序列化响应，客户端 Accept: application/msgpack 时返回 msgpack
+    default_response_class=FastResponse
 )
 
 # 配置 CORS，允许跨域请求
@@ -38,8 +65,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Cache"],
 )
 
+# 数据大屏接口响应缓存（写入新数据时失效，支持 ETag / If-None-Match），实时推送不经过缓存
+app.add_middleware(ResponseCacheMiddleware, prefix="/api/dashboard/", exclude=("/api/dashboard/stream",))
+
+# 数据提交接口接受 gzip / zstd 压缩的请求体
+app.add_middleware(RequestDecompressionMiddleware, prefix="/api/submit")
+
+# 按 Accept 请求头选择响应格式（JSON / msgpack）
+app.add_middleware(ContentNegotiationMiddleware)
+
+# 管理员请求的采样分析，放在响应缓存外层
+if profiling.ADMIN_TOKEN:
+    app.add_middleware(profiling.ProfilerMiddleware, prefix="/api/dashboard/", exclude=("/api/dashboard/stream",))
+
+# 请求耗时和 SQL 次数统计，放在最外层（最后添加）
+if telemetry.METRICS_ENABLED:
+    app.add_middleware(telemetry.MetricsMiddleware)
+
 # 获取 web 目录路径（相对于 server 目录）
 BASE_DIR = Path(__file__).resolve().parent
 WEB_DIR = BASE_DIR.parent / "web"
@@ -55,65 +100,58 @@ else:
     STATIC_WEB_DIR = WEB_DIR
     print(f"使用源目录: {STATIC_WEB_DIR}")
 
+# 前端文件的内存清单（预压缩、ETag、缓存头）
+static_site = StaticSite(STATIC_WEB_DIR)
+
 # 注册 API 路由（必须在静态文件路由之前）
 app.include_router(data.router, prefix="/api", tags=["data"])
 app.include_router(dashboard.router, prefix="/api/dashboard", tags=["dashboard"])
+app.include_router(export.router, prefix="/api", tags=["export"])
+app.include_router(stream.router, prefix="/api/dashboard", tags=["stream"])
+app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
 @app.get("/health")
 async def health():
     """健康检查"""
     return {"status": "healthy"}
 
-# 如果 web 目录存在，配置静态文件服务
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """运行指标（Prometheus 文本格式）"""
+    return Response(telemetry.render(), media_type=telemetry.CONTENT_TYPE)
+
+# 如果 web 目录存在，从内存中的静态文件清单提供前端页面（启动时生成）
 if STATIC_WEB_DIR.exists():
-    # 挂载静态资源目录
-    static_dir = STATIC_WEB_DIR / "static"
-    if static_dir.exists():
-        app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
-    
     @app.get("/")
-    async def root():
+    async def root(request: Request):
         """根路径 - 返回前端首页"""
-        index_path = STATIC_WEB_DIR / "index.html"
-        if index_path.exists():
-            return FileResponse(str(index_path))
+        entry = static_site.lookup("index.html")
+        if entry is not None:
+            return static_site.respond(entry, request.headers)
         return {"message": "WhatUDoing Data Server", "status": "running", "web_dir": "not found"}
     
     # SPA 路由支持 - 所有非 API 路由都返回 index.html
     @app.get("/{path:path}")
-    async def serve_spa(path: str):
+    async def serve_spa(path: str, request: Request):
         """
         处理前端路由（SPA）
         如果请求的不是 API 路径且文件不存在，返回 index.html
         """
-        # 排除 API 路径和已挂载的静态路径
-        if path.startswith("api/") or path.startswith("static/") or path == "health":
+        # 排除 API 路径
+        if path.startswith("api/") or path == "health":
             raise HTTPException(status_code=404, detail="Not found")
         
-        # 尝试查找文件
-        file_path = STATIC_WEB_DIR / path
-        
-        # 如果是文件且存在，返回文件
-        if file_path.is_file() and file_path.exists():
-            # 检查文件是否在 web 目录内（安全）
-            try:
-                file_path.resolve().relative_to(STATIC_WEB_DIR.resolve())
-            except ValueError:
-                raise HTTPException(status_code=403, detail="Access denied")
-            return FileResponse(str(file_path))
-        
-        # 如果是目录，尝试查找 index.html
-        if file_path.is_dir():
-            index_in_dir = file_path / "index.html"
-            if index_in_dir.exists():
-                return FileResponse(str(index_in_dir))
+        # 清单中的文件或目录下的 index.html（清单只包含 web 目录内的文件）
+        entry = static_site.lookup(path)
         
-        # 对于 SPA 路由，返回主 index.html
-        index_path = STATIC_WEB_DIR / "index.html"
-        if index_path.exists():
-            return FileResponse(str(index_path))
+        # 静态资源不存在时返回 404，不返回首页
+        if entry is None and not path.startswith("static/"):
+            # 对于 SPA 路由，返回主 index.html
+            entry = static_site.lookup("index.html")
         
-        raise HTTPException(status_code=404, detail="File not found")
+        if entry is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        return static_site.respond(entry, request.headers)
 else:
     @app.get("/")
     async def root():
@@ -121,5 +159,9 @@ else:
         return {"message": "WhatUDoing Data Server", "status": "running", "web_dir": "not found"}
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if cluster.WORKERS > 1:
+        # 多进程：一个写入进程加 WORKERS 个工作进程（不支持 reload）
+        cluster.run_workers("main:app", host="0.0.0.0", port=8000, workers=cluster.WORKERS)
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
 
@@ -0,0 +1,119 @@
+"""
+管理命令
+
+用法：
+    python manage.py backfill-metrics [--batch-size 1000]
+    python manage.py rebuild-rollups [--days N]
+    python manage.py rebuild-devices
+    python manage.py rebuild-sessions
+    python manage.py enable-incremental-vacuum
+    python manage.py archive-old-data
+    python manage.py train-payload-dictionary [--samples 5000] [--dict-size 16384]
+    python manage.py migrate-payloads [--batch-size 1000] [--all]
+"""
+import argparse
+from datetime import datetime, timedelta
+from app.database import init_db
+
+
+def backfill_metrics(args):
+    """为历史数据补齐指标列"""
+    from app.extractors import backfill_metrics as run_backfill
+    count = run_backfill(batch_size=args.batch_size)
+    print(f"指标列补齐完成，共处理 {count} 条记录")
+
+
+def rebuild_rollups(args):
+    """从原始数据重建预聚合"""
+    from app.rollups import rebuild_rollups as run_rebuild
+    start = datetime.utcnow() - timedelta(days=args.days) if args.days else None
+    count = run_rebuild(start)
+    print(f"预聚合重建完成，共重放 {count} 条记录")
+
+
+def rebuild_devices(args):
+    """从原始数据重建设备登记表"""
+    from app.devices import rebuild_devices as run_rebuild
+    count = run_rebuild()
+    print(f"设备登记表重建完成，共 {count} 个设备")
+
+
+def rebuild_sessions(args):
+    """从原始数据重建应用会话"""
+    from app.sessions import rebuild_sessions as run_rebuild
+    count = run_rebuild()
+    print(f"应用会话重建完成，共 {count} 个会话")
+
+
+def enable_incremental_vacuum(args):
+    """为已有数据库开启增量空间回收（完整 VACUUM 一次，需停机执行）"""
+    from app.database import enable_incremental_vacuum as run_vacuum
+    mode = run_vacuum()
+    print("已开启增量空间回收" if mode == 2 else f"开启失败，当前 auto_vacuum={mode}")
+
+
+def archive_old_data(args):
+    """把超过 ARCHIVE_AFTER_DAYS 天的数据移入归档文件"""
+    from app.archive import archive_old_data as run_archive, ARCHIVE_AFTER_DAYS
+    if ARCHIVE_AFTER_DAYS <= 0:
+        print("未设置 ARCHIVE_AFTER_DAYS，不进行归档")
+        return
+    count = run_archive()
+    print(f"冷数据归档完成，共归档 {count} 条记录")
+
+
+def train_payload_dictionary(args):
+    """用最近的数据训练原始数据压缩字典"""
+    from app.codec import train_dictionary
+    dict_id = train_dictionary(samples=args.samples, dict_size=args.dict_size)
+    print(f"字典训练完成，字典ID {dict_id}（PAYLOAD_CODEC=zstd 时新数据使用该字典）")
+
+
+def migrate_payloads(args):
+    """把已有数据转换为当前 PAYLOAD_CODEC 编码"""
+    from app.codec import migrate_payloads as run_migrate, PAYLOAD_CODEC
+    count = run_migrate(batch_size=args.batch_size, all_rows=args.all)
+    print(f"数据编码转换完成（{PAYLOAD_CODEC}），共转换 {count} 条记录")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WhatUDoing 服务器管理命令")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_backfill = subparsers.add_parser("backfill-metrics", help="为历史数据补齐指标列")
+    parser_backfill.add_argument("--batch-size", type=int, default=1000, help="每批处理的记录数")
+    parser_backfill.set_defaults(func=backfill_metrics)
+
+    parser_rollups = subparsers.add_parser("rebuild-rollups", help="从原始数据重建预聚合")
+    parser_rollups.add_argument("--days", type=int, default=None, help="只重建最近N天（默认全部）")
+    parser_rollups.set_defaults(func=rebuild_rollups)
+
+    parser_devices = subparsers.add_parser("rebuild-devices", help="从原始数据重建设备登记表")
+    parser_devices.set_defaults(func=rebuild_devices)
+
+    parser_sessions = subparsers.add_parser("rebuild-sessions", help="从原始数据重建应用会话")
+    parser_sessions.set_defaults(func=rebuild_sessions)
+
+    parser_vacuum = subparsers.add_parser("enable-incremental-vacuum", help="为已有数据库开启增量空间回收（需停机）")
+    parser_vacuum.set_defaults(func=enable_incremental_vacuum)
+
+    parser_archive = subparsers.add_parser("archive-old-data", help="把超过 ARCHIVE_AFTER_DAYS 天的数据移入归档文件")
+    parser_archive.set_defaults(func=archive_old_data)
+
+    parser_train = subparsers.add_parser("train-payload-dictionary", help="用最近的数据训练原始数据压缩字典")
+    parser_train.add_argument("--samples", type=int, default=None, help="样本数（默认 PAYLOAD_DICT_SAMPLES）")
+    parser_train.add_argument("--dict-size", type=int, default=None, help="字典大小（字节，默认 PAYLOAD_DICT_SIZE）")
+    parser_train.set_defaults(func=train_payload_dictionary)
+
+    parser_migrate = subparsers.add_parser("migrate-payloads", help="把已有数据转换为当前 PAYLOAD_CODEC 编码")
+    parser_migrate.add_argument("--batch-size", type=int, default=1000, help="每批转换的记录数")
+    parser_migrate.add_argument("--all", action="store_true", help="重新编码所有记录（训练新字典或对旧数据去重时使用）")
+    parser_migrate.set_defaults(func=migrate_payloads)
+
+    args = parser.parse_args()
+    init_db()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""测试使用临时目录中的数据库和归档目录，需要在导入 app 之前设置环境变量"""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="collector-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("ARCHIVE_DIR", os.path.join(_tmp, "archive"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app.database import init_db, SessionLocal
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    init_db()
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
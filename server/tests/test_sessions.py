@@ -0,0 +1,74 @@
+"""应用会话的增量维护与全量重建结果一致"""
+import random
+from app.database import AppSession
+from app.ingest import store_submissions, delete_record
+from app.schemas import DataSubmission
+from app import sessions
+
+
+def _submission(device_id, timestamp, app=None):
+    data = {"foregroundApp": {"packageName": app}} if app else {"battery": {"level": 50}}
+    return DataSubmission(device_id=device_id, timestamp=timestamp, data=data)
+
+
+def _dump(db, device_ids):
+    db.expire_all()
+    return sorted(
+        (s.device_id, s.app, s.start_ts, s.last_ts, s.end_ts, s.sample_count)
+        for s in db.query(AppSession).filter(AppSession.device_id.in_(device_ids))
+    )
+
+
+def test_delete_newest_sample_recomputes_end(db):
+    ids = store_submissions(db, [
+        _submission("end-1", 0, "x"),
+        _submission("end-1", 60_000, "x"),
+        _submission("end-1", 120_000, "y"),
+    ])
+    delete_record(db, ids[2])
+    assert _dump(db, ["end-1"]) == [("end-1", "x", 0, 60_000, 60_000, 2)]
+
+    incremental = _dump(db, ["end-1"])
+    sessions.rebuild_sessions()
+    assert _dump(db, ["end-1"]) == incremental
+
+
+def test_delete_last_sample_of_middle_session(db):
+    ids = store_submissions(db, [
+        _submission("end-2", 0, "x"),
+        _submission("end-2", 60_000, "y"),
+        _submission("end-2", 60_000 + sessions.SESSION_GAP_MS * 3, "z"),
+    ])
+    delete_record(db, ids[1])
+    assert _dump(db, ["end-2"]) == [
+        ("end-2", "x", 0, 0, 0, 1),
+        ("end-2", "z", 60_000 + sessions.SESSION_GAP_MS * 3, 60_000 + sessions.SESSION_GAP_MS * 3,
+         60_000 + sessions.SESSION_GAP_MS * 3, 1),
+    ]
+
+
+def test_random_inserts_and_deletes_match_rebuild(db):
+    rng = random.Random(7)
+    devices = ["rand-1", "rand-2", ""]
+    data = []
+    for device_id in devices:
+        timestamp, app = 0, "a"
+        for _ in range(300):
+            timestamp += rng.choice([60_000, 300_000, 300_000, 900_000])
+            if rng.random() < 0.3:
+                app = rng.choice(["a", "b", "c"])
+            data.append(_submission(device_id or None, timestamp, app if rng.random() < 0.9 else None))
+    rng.shuffle(data)
+
+    ids = []
+    index = 0
+    while index < len(data):
+        size = rng.randint(1, 40)
+        ids += store_submissions(db, data[index:index + size])
+        index += size
+    for record_id in rng.sample(ids, 120):
+        delete_record(db, record_id)
+
+    incremental = _dump(db, devices)
+    sessions.rebuild_sessions()
+    assert _dump(db, devices) == incremental